@@ -13,10 +13,11 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
-import os, popen2, pwd, re, sys, time, socket
+import httplib, os, popen2, pwd, re, sys, time, socket, threading, types, xmlrpclib
 import PAM # From PyPAM module
 
 from XSConsoleBases import *
+from XSConsoleConfig import *
 from XSConsoleLang import *
 from XSConsoleLog import *
 from XSConsoleState import *
@@ -35,6 +36,7 @@ class Auth:
         self.testingHost = None
         self.authTimestampSeconds = None
         self.masterConnectionBroken = False
+        self.sessionPool = SessionPool(self.OpenSession, Config.Inst().XAPIMaxSessions())
         socket.setdefaulttimeout(15)
         
         self.testMode = False
@@ -206,9 +208,85 @@ class Auth:
     
     def NewSession(self):
         return self.OpenSession()
+    
+    def BorrowSession(self, inWait = True):
+        # Returns a logged in session from the pool, or None if one couldn't be opened.  Hand it back with
+        # ReturnSession when finished with, or ReleaseSession if a call on it has raised an exception
+        return self.sessionPool.Borrow(inWait)
+    
+    def ReturnSession(self, inSession):
+        if inSession is not None:
+            if not self.sessionPool.Return(inSession):
+                # Not from the pool
+                inSession.logout()
+        return None
+    
+    def IsSessionError(self, inException):
+        # Returns True if inException shows that the session it came from can't be used again, because its
+        # connection has failed or xapi no longer recognises it.  Other failures, e.g. xapi rejecting a call,
+        # leave the session usable
+        if isinstance(inException, XenAPI.Failure):
+            retVal = (len(inException.details) > 0 and inException.details[0] == 'SESSION_INVALID')
+        else:
+            retVal = isinstance(inException, (socket.error, xmlrpclib.ProtocolError, httplib.HTTPException))
+        return retVal
+    
+    def ReleaseSession(self, inSession, inException = None):
+        # Hands back a borrowed session after a call on it raised inException.  The session is returned to the
+        # pool unless the exception shows that it has failed, in which case it's discarded
+        if inSession is not None:
+            if inException is not None and self.IsSessionError(inException):
+                self.DiscardSession(inSession)
+            else:
+                self.ReturnSession(inSession)
+        return None
+    
+    def PooledCall(self, inProc):
+        # Returns inProc(session), using a session borrowed from the pool.  If xapi no longer recognises the
+        # session, e.g. because it has restarted, the session is dropped and the call retried once on a new one
+        retVal = None
+        for attempt in range(2):
+            session = self.BorrowSession()
+            if session is None:
+                raise Exception(Lang('Could not connect to xapi'))
+            failure = None
+            retry = False
+            try:
+                try:
+                    retVal = inProc(session)
+                except Exception, e:
+                    failure = e
+                    if attempt > 0 or not isinstance(e, XenAPI.Failure) or e.details[0] != 'SESSION_INVALID':
+                        raise
+                    XSLog('Replacing invalid xapi session')
+                    retry = True
+            finally:
+                self.ReleaseSession(session, failure)
+            if not retry:
+                break
+        return retVal
+    
+    def DiscardSession(self, inSession):
+        # Removes a failed session from the pool.  Only for sessions that can't be used again (see IsSessionError),
+        # as logging out ends any tasks that the session has started.  The logout runs on a thread of its own,
+        # as the connection may hang, and is only so that xapi doesn't keep the session until it expires
+        if inSession is not None:
+            self.sessionPool.Discard(inSession)
+            def logout():
+                try:
+                    inSession.logout()
+                except Exception, e:
+                    pass # The session is probably already invalid
+            thread = threading.Thread(target = logout)
+            thread.setDaemon(True)
+            thread.start()
+        return None
         
     def CloseSession(self, inSession):
-        inSession.logout()
+        try:
+            inSession.logout()
+        finally:
+            self.sessionPool.Discard(inSession)
         return None
 
     def IsPasswordSet(self):
@@ -253,3 +331,210 @@ class Auth:
     def IsXenAPIConnectionBroken(self):
        return self.masterConnectionBroken
 
+class SessionPool:
+    # Logged in xapi sessions for reuse, so that callers don't pay for a login and logout each time.  A session
+    # is used by one thread at a time: Borrow takes an idle session or logs in a new one, and Return puts it back.
+    # The number of sessions, in use or idle, is capped so that bulk operations can't exhaust xapi's session
+    # limit.  Sessions that have been idle for a while are checked before reuse and replaced if xapi has
+    # forgotten them.  Sessions are identified by id() as XenAPI.Session turns comparisons into xapi calls
+    HEALTH_CHECK_SECS = 60
+    WAIT_SECS = 30
+    
+    def __init__(self, inOpener, inMaxSessions):
+        self.opener = inOpener
+        self.maxSessions = inMaxSessions
+        self.numSessions = 0 # Including sessions being opened
+        self.idle = [] # (session, time returned)
+        self.borrowed = {} # id(session) : session
+        self.condition = threading.Condition()
+    
+    def Borrow(self, inWait):
+        session = None
+        idleSince = None
+        self.condition.acquire()
+        try:
+            deadline = time.time() + self.WAIT_SECS
+            while len(self.idle) == 0 and self.numSessions >= self.maxSessions:
+                remaining = deadline - time.time()
+                if not inWait or remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            if len(self.idle) > 0:
+                session, idleSince = self.idle.pop() # The most recently used, so the least likely to have expired
+            elif self.numSessions < self.maxSessions:
+                self.numSessions += 1 # Reserve a place for the session we're about to open
+            else:
+                if inWait:
+                    XSLogError('All '+str(self.maxSessions)+' xapi sessions are in use')
+                return None
+        finally:
+            self.condition.release()
+        
+        if session is not None and time.time() - idleSince > self.HEALTH_CHECK_SECS:
+            try:
+                session.xenapi.session.get_this_host(session._session)
+            except Exception, e:
+                # Usually SESSION_INVALID because xapi has restarted, so log in again
+                XSLog('Replacing pooled xapi session: ', e)
+                try:
+                    session.logout()
+                except Exception, e:
+                    pass # The session is probably already invalid
+                session = None
+        if session is None:
+            try:
+                session = self.opener()
+            finally:
+                if session is None:
+                    self.Release()
+        
+        if session is not None:
+            self.condition.acquire()
+            try:
+                self.borrowed[id(session)] = session
+            finally:
+                self.condition.release()
+        return session
+    
+    def Return(self, inSession):
+        # Returns False if inSession isn't from this pool
+        retVal = False
+        self.condition.acquire()
+        try:
+            if id(inSession) in self.borrowed:
+                del self.borrowed[id(inSession)]
+                self.idle.append( (inSession, time.time()) )
+                self.condition.notify()
+                retVal = True
+        finally:
+            self.condition.release()
+        return retVal
+    
+    def Discard(self, inSession):
+        self.condition.acquire()
+        try:
+            if id(inSession) in self.borrowed:
+                del self.borrowed[id(inSession)]
+                self.numSessions -= 1
+                self.condition.notify()
+        finally:
+            self.condition.release()
+    
+    def Release(self):
+        self.condition.acquire()
+        try:
+            self.numSessions -= 1
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+class MultiCallResult:
+    # The result of a call queued on a MultiCall.  Value() is available once the MultiCall has executed
+    def __init__(self):
+        self.done = False
+        self.value = None
+        self.failure = None
+        self.followUps = []
+    
+    def Value(self):
+        if not self.done:
+            raise Exception('MultiCall result used before MultiCall.Execute')
+        if self.failure is not None:
+            raise self.failure
+        return self.value
+    
+    def Then(self, inFollowUp):
+        # inFollowUp(value) is called if this call succeeds, and may queue further calls on the same MultiCall.
+        # Those are sent together in the next round trip
+        self.followUps.append(inFollowUp)
+        return self
+
+class MultiCallMethod:
+    def __init__(self, inMultiCall, inName):
+        self.multiCall = inMultiCall
+        self.name = inName
+        
+    def __getattr__(self, inName):
+        if self.name is None:
+            name = inName
+        else:
+            name = self.name+'.'+inName
+        return MultiCallMethod(self.multiCall, name)
+        
+    def __call__(self, *inParams):
+        return self.multiCall.Queue(self.name, inParams)
+
+class MultiCall:
+    # Queues xapi calls and sends them as one system.multicall request, so that a string of small calls costs
+    # one round trip.  Calls are made as they would be on session.xenapi, e.g.
+    #   batch = MultiCall(session)
+    #   uuid = batch.xenapi.host.get_uuid(hostRef)
+    #   batch.Execute()
+    #   uuid.Value() # Raises XenAPI.Failure if the call failed
+    # If xapi doesn't support system.multicall, the calls are made one at a time
+    isSupported = True
+    
+    def __init__(self, inSession):
+        self.session = inSession
+        self.queue = []
+    
+    def __getattr__(self, inName):
+        if inName != 'xenapi':
+            raise AttributeError(inName)
+        return MultiCallMethod(self, None)
+    
+    def Queue(self, inName, inParams):
+        if inName is None:
+            raise Exception('MultiCall requires a class and method name')
+        result = MultiCallResult()
+        self.queue.append( (inName, inParams, result) )
+        return result
+        
+    def Execute(self):
+        while len(self.queue) > 0:
+            calls = self.queue
+            self.queue = []
+            if len(calls) > 1 and MultiCall.isSupported:
+                self.SendMultiCall(calls)
+            else:
+                self.SendSingly(calls)
+            for name, params, result in calls:
+                if result.failure is None:
+                    for followUp in result.followUps:
+                        followUp(result.value)
+
+    def SendMultiCall(self, inCalls):
+        request = [ { 'methodName' : name, 'params' : (self.session._session, ) + params } for name, params, result in inCalls ]
+        try:
+            responses = self.session.system.multicall(request)
+        except (XenAPI.Failure, xmlrpclib.Fault), e:
+            responses = e
+        if not isinstance(responses, types.ListType):
+            # xapi has rejected system.multicall, so don't try it again
+            XSLog('system.multicall not available, so making xapi calls singly: ', responses)
+            MultiCall.isSupported = False
+            self.SendSingly(inCalls)
+            return
+        
+        for i in range(len(inCalls)):
+            result = inCalls[i][2]
+            response = responses[i]
+            if isinstance(response, types.ListType) and isinstance(response[0], types.DictType) and response[0].get('Status', None) == 'Success':
+                result.value = response[0].get('Value', None)
+            elif isinstance(response, types.ListType) and isinstance(response[0], types.DictType):
+                result.failure = XenAPI.Failure(response[0].get('ErrorDescription', ['Unknown error']))
+            else:
+                # An XML-RPC fault for this call
+                result.failure = XenAPI.Failure([str(response)])
+            result.done = True
+    
+    def SendSingly(self, inCalls):
+        for name, params, result in inCalls:
+            method = self.session.xenapi
+            for element in name.split('.'):
+                method = getattr(method, element)
+            try:
+                result.value = method(*params)
+            except XenAPI.Failure, e:
+                result.failure = e
+            result.done = True
@@ -82,6 +82,53 @@ class Config:
     def BMCName(self):
         return 'BMC'
         
+    def HotDataUseEvents(self):
+        # Keep HotData up to date using the xapi event stream rather than refetching expired entries
+        return True
+    
+    def HotDataLifetimes(self):
+        # Overrides for HotData cache lifetimes in seconds, keyed by fetcher name, e.g. { 'vm' : 10 }
+        return {}
+    
+    def HotDataStaleSecs(self):
+        # How long after expiry HotData may serve an entry whilst refetching it in the background.  0 disables this
+        return 60
+    
+    def HotDataMaxEntries(self):
+        # Above this number of entries, HotData evicts the least recently used entries for individual objects
+        return 100000
+    
+    def HotDataMaxBytes(self):
+        # As HotDataMaxEntries, but for the estimated size of the entries for individual objects
+        return 64 * 1024 * 1024
+        
+    def DataUpdateEngine(self):
+        # How Data.Update fetches the host's details.  'bulk' fetches each class of object once and joins the records,
+        # and 'parallel' fetches each object separately
+        return 'bulk'
+    
+    def DataUpdateThreads(self):
+        # The number of threads, each with its own xapi session, that Data.Update uses to fetch the host's details
+        return 4
+    
+    def BulkOperationConcurrency(self):
+        # The most tasks that a bulk operation, e.g. on several VMs, runs at once.  See VMBulkOperation
+        return 8
+    
+    def XAPIMaxSessions(self):
+        # The most xapi sessions, in use or idle in the pool, that xsconsole keeps open at once.  See SessionPool
+        return 16
+        
+    def HardwareCacheFile(self):
+        # Where Data keeps the results of probing the hardware, so that restarts within a boot needn't reprobe.
+        # Empty to disable
+        return '/var/run/xsconsole-hardware.pickle'
+    
+    def CatalogueCacheFile(self):
+        # Where Data keeps its lists of timezones and keymaps, so that startup needn't search the directories.
+        # Empty to disable
+        return '/var/cache/xsconsole-catalogues.pickle'
+    
     def FirstBootEULAs(self):
         # Subclasses in XSConsoleConfigOEM can add their EULAs to this array
         return ['/EULA']
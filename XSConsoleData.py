@@ -15,11 +15,12 @@
 
 import XenAPI
 
-import commands, re, shutil, sys, tempfile, socket, os
+import bisect, commands, pickle, re, shutil, sys, tempfile, threading, socket, os
 from pprint import pprint
 from simpleconfig import SimpleConfigFile
 
 from XSConsoleAuth import *
+from XSConsoleHotData import *
 from XSConsoleKeymaps import *
 from XSConsoleLang import *
 from XSConsoleLog import *
@@ -39,11 +40,28 @@ class DataMethod:
 
 class Data:
     DISK_TIMEOUT_SECONDS = 60
+    PROBE_TIMEOUT_SECONDS = 30
+    BMC_PROBE_TIMEOUT_SECONDS = 15
+    HARDWARE_CACHE_VERSION = 1
+    # Sections that can't change without a reboot, or a change to the files in HardwareCacheKey
+    HARDWARE_SECTIONS = ['dmi', 'lspci', 'bmc', 'cpuinfo', 'sslfingerprint', 'sshfingerprint']
+    CATALOGUE_CACHE_VERSION = 1
+    # Attributes that Update changes, other than self.data and self.session
+    UPDATE_STATE = ['dom0Cache', 'fileStamps']
+    # Sections of self.data whose contents Update changes in place, rather than replacing the whole section
+    UPDATE_NESTED_SECTIONS = ['timezones', 'keyboard', 'sysconfig', 'ntp']
     instance = None
     
     def __init__(self):
         self.data = {}
         self.session = None
+        self.dom0Cache = None
+        self.fileStamps = {}
+        self.probes = {}
+        self.hardwareCacheKey = None
+        self.catalogues = {}
+        self.backgroundUpdate = None
+        self.updateRequested = False
     
     @classmethod
     def Inst(cls):
@@ -55,14 +73,20 @@ class Data:
     @classmethod
     def Reset(cls):
         if cls.instance is not None:
+            cls.instance.session = Auth.Inst().ReturnSession(cls.instance.session)
             del cls.instance
             cls.instance = None
     
     def DataCache(self):
         # Not for general use
+        self.CollectProbes()
         return self.data
     
     def GetData(self, inNames, inDefault = None):
+        if len(inNames) > 0 and inNames[0] in self.probes:
+            self.CollectProbe(inNames[0])
+        if len(inNames) > 1 and (inNames[0], inNames[1]) in self.catalogues:
+            self.RequireCatalogue(inNames[0], inNames[1])
         data = self.data
         for name in inNames:
             if name is '__repr__':
@@ -88,55 +112,134 @@ class Data:
     
     def RequireSession(self):
         if self.session is None:
-            self.session = Auth.Inst().OpenSession()
+            self.session = Auth.Inst().BorrowSession()
         return self.session
     
     def Create(self):
         # Create fills in data that never changes.  Update fills volatile data
         self.data = {}
+        self.fileStamps = {}
+        self.probes = {}
+        self.catalogues = {}
         
         self.ReadTimezones()
         self.ReadKeymaps()
         
-        (status, output) = commands.getstatusoutput("dmidecode")
-        if status != 0:
-            # Use test dmidecode file if there's no real output
-            (status, output) = commands.getstatusoutput("/bin/cat ./dmidecode.txt")
-        
-        if status == 0:
-            self.ScanDmiDecode(output.split("\n"))
-     
-        (status, output) = commands.getstatusoutput("/sbin/lspci -m")
-        if status != 0:
-            (status, output) = commands.getstatusoutput("/usr/bin/lspci -m")
+        self.hardwareCacheKey = self.HardwareCacheKey()
+        if not self.LoadHardwareCache():
+            self.ProbeHardware()
 
-        if status == 0:
-            self.ScanLspci(output.split("\n"))
-     
+        self.Update()
+    
+    def ProbeHardware(self):
+        # The probes run in parallel in the background, and each section is filled in when first used, so that
+        # a slow probe (e.g. ipmitool with a slow BMC) only delays the panes that show its results
+        self.StartProbe('dmi', self.PROBE_TIMEOUT_SECONDS, self.ScanDmiDecode,
+            [ ['dmidecode'], ['/bin/cat', './dmidecode.txt'] ]) # Use test dmidecode file if there's no real output
+        self.StartProbe('lspci', self.PROBE_TIMEOUT_SECONDS, self.ScanLspci,
+            [ ['/sbin/lspci', '-m'], ['/usr/bin/lspci', '-m'] ])
         if os.path.isfile("/usr/bin/ipmitool"):
-            (status, output) = commands.getstatusoutput("/usr/bin/ipmitool mc info")
-            if status == 0:
-                self.ScanIpmiMcInfo(output.split("\n"))
+            self.StartProbe('bmc', self.BMC_PROBE_TIMEOUT_SECONDS, self.ScanIpmiMcInfo,
+                [ ['/usr/bin/ipmitool', 'mc', 'info'] ])
+        self.StartProbe('sslfingerprint', self.PROBE_TIMEOUT_SECONDS, self.ScanSSLFingerprint,
+            [ ['/usr/bin/openssl', 'x509', '-in', Config.Inst().XCPConfigDir()+'/xapi-ssl.pem', '-fingerprint', '-noout'] ])
+        self.StartProbe('sshfingerprint', self.PROBE_TIMEOUT_SECONDS, self.ScanSSHFingerprint,
+            [ ['/usr/bin/ssh-keygen', '-lf', '/etc/ssh/ssh_host_rsa_key.pub'] ], True)
         
         # /proc/cpuinfo has details of the virtual CPUs exposed to DOM-0, not necessarily the real CPUs
-        (status, output) = commands.getstatusoutput("/bin/cat /proc/cpuinfo")
-        if status == 0:
-            self.ScanCPUInfo(output.split("\n"))
-
-        (status, output) = commands.getstatusoutput("/usr/bin/openssl x509 -in %s/xapi-ssl.pem -fingerprint -noout" % (Config.Inst().XCPConfigDir()))
-        if status == 0:
-            fp = output.split("=")
-            if len(fp) >= 2:
-                self.data['sslfingerprint'] = fp[1]
-            else:
-                self.data['sslfingerprint'] = "<Unknown>"
- 
+        lines = self.ReadFileLines('/proc/cpuinfo')
+        if lines is not None:
+            self.ScanCPUInfo(lines)
+    
+    def HardwareCacheKey(self):
+        # The cached hardware sections are valid for this boot, unless the certificate or key are regenerated
+        bootID = self.ReadFileLines('/proc/sys/kernel/random/boot_id')
+        if bootID is None or Config.Inst().HardwareCacheFile() == '':
+            retVal = None # Can't tell when the cache is out of date, so don't use it
+        else:
+            retVal = [ bootID[0],
+                self.FileStamp(Config.Inst().XCPConfigDir()+'/xapi-ssl.pem'),
+                self.FileStamp('/etc/ssh/ssh_host_rsa_key.pub') ]
+        return retVal
+    
+    def LoadCacheFile(self, inFilename):
+        # Returns the object saved by SaveCacheFile, or None if there isn't one
         try:
-            self.data['sshfingerprint'] = ShellPipe('/usr/bin/ssh-keygen', '-lf', '/etc/ssh/ssh_host_rsa_key.pub').AllOutput()[0].split(' ')[1]
-        except:
-            self.data['sshfingerprint'] = Lang('<Unknown>')
+            file = open(inFilename, 'rb')
+            try:
+                retVal = pickle.load(file)
+            finally:
+                file.close()
+        except Exception, e:
+            retVal = None # No cache file, or it's unreadable
+        return retVal
+    
+    def SaveCacheFile(self, inFilename, inObject):
+        try:
+            # Write and rename, so that another instance never reads a partial file
+            file = open(inFilename+'.tmp', 'wb')
+            try:
+                pickle.dump(inObject, file, pickle.HIGHEST_PROTOCOL)
+            finally:
+                file.close()
+            os.rename(inFilename+'.tmp', inFilename)
+        except Exception, e:
+            XSLogError('Failed to save cache file '+inFilename+': ', e)
+    
+    def LoadHardwareCache(self):
+        # Returns True if the hardware sections were loaded from the cache file
+        retVal = False
+        if self.hardwareCacheKey is not None:
+            cache = self.LoadCacheFile(Config.Inst().HardwareCacheFile())
+            try:
+                if cache['version'] == self.HARDWARE_CACHE_VERSION and cache['key'] == self.hardwareCacheKey:
+                    self.data.update(cache['sections'])
+                    retVal = True
+            except Exception, e:
+                pass # No cache file, or an old format
+        return retVal
+    
+    def SaveHardwareCache(self):
+        cache = {
+            'version' : self.HARDWARE_CACHE_VERSION,
+            'key' : self.hardwareCacheKey,
+            'sections' : {}
+        }
+        for name in self.HARDWARE_SECTIONS:
+            if name in self.data:
+                cache['sections'][name] = self.data[name]
         
-        self.Update()
+        self.SaveCacheFile(Config.Inst().HardwareCacheFile(), cache)
+    
+    def StartProbe(self, inName, inTimeoutSecs, inScanner, inCommands, inScanFailure = False):
+        # inScanner fills in self.data[inName] from the output of the first of inCommands to succeed.  It's
+        # called on the thread that first reads inName, and is passed None on failure if inScanFailure is True
+        self.probes[inName] = Struct(shellProbe = ShellProbe(inTimeoutSecs, *inCommands), scanner = inScanner,
+            scanFailure = inScanFailure)
+    
+    def CollectProbe(self, inName):
+        # Waits for the probe for inName to finish, and merges its results into self.data
+        probe = self.probes[inName]
+        del self.probes[inName]
+        lines = probe.shellProbe.Lines()
+        if lines is not None or probe.scanFailure:
+            probe.scanner(lines)
+        if probe.shellProbe.timedOut:
+            # Next time might be quicker, so don't cache the missing section
+            self.hardwareCacheKey = None
+        if len(self.probes) == 0 and self.hardwareCacheKey is not None:
+            self.SaveHardwareCache()
+    
+    def CollectFinishedProbes(self):
+        # Merges the results of probes that have finished, without waiting for the others
+        for name, probe in self.probes.items():
+            if probe.shellProbe.IsDone():
+                self.CollectProbe(name)
+    
+    def CollectProbes(self):
+        # Merges the results of all probes, waiting for any that are still running
+        for name in self.probes.keys():
+            self.CollectProbe(name)
     
     def FakeMetrics(self, inPIF):
         retVal = {
@@ -149,12 +252,409 @@ class Data:
     def CloseSession(self):
         if self.session is not None:
             self.session = Auth.Inst().CloseSession(self.session)
+
+    def RunParallel(self, inJobs):
+        # Runs ThreadPool jobs, passing each a session of its own borrowed from the pool.  Only sessions
+        # available without waiting are used, falling back to running the jobs one at a time on self.session
+        sessions = []
+        while len(sessions) < min(len(inJobs), Config.Inst().DataUpdateThreads()):
+            session = Auth.Inst().BorrowSession(False)
+            if session is None:
+                break
+            sessions.append(session)
+        failure = None
+        try:
+            try:
+                if len(sessions) == 0:
+                    retVal = ThreadPool([ self.session ]).Run(inJobs)
+                else:
+                    retVal = ThreadPool(sessions).Run(inJobs)
+            except Exception, e:
+                failure = e
+                raise
+        finally:
+            for session in sessions:
+                # Sessions that have failed are replaced next time
+                Auth.Inst().ReleaseSession(session, failure)
+        return retVal
+    
+    def UpdateHostParallel(self):
+        # Expands the items we need in the host record.  These depend only on the host record, so are
+        # fetched in parallel, each thread using its own session
+        def getMetrics(inSession, inMetrics):
+            return inSession.xenapi.host_metrics.get_record(inMetrics)
+        
+        def getSR(inSession, inSR):
+            try:
+                retVal = inSession.xenapi.SR.get_record(inSR)
+            except:
+                # NULL or dangling reference
+                retVal = None
+            return retVal
+        
+        def convertCPU(inSession, inCPU):
+            return inSession.xenapi.host_cpu.get_record(inCPU)
+        
+        def convertPIF(inSession, inPIF):
+            retVal = inSession.xenapi.PIF.get_record(inPIF)
+            try:
+                retVal['metrics'] = inSession.xenapi.PIF_metrics.get_record(retVal['metrics'])
+            except XenAPI.Failure:
+                retVal['metrics' ] = self.FakeMetrics(inPIF)
+            
+            try:
+                retVal['network'] = inSession.xenapi.network.get_record(retVal['network'])
+            except XenAPI.Failure, e:
+                XSLogError('Missing network record: ', e)
+                
+            retVal['opaqueref'] = inPIF
+            return retVal
+
+        def convertVBD(inSession, inVBD):
+            retVBD = inSession.xenapi.VBD.get_record(inVBD)
+            retVBD['opaqueref'] = inVBD
+            return retVBD
+            
+        def convertVDI(inSession, inVDI):
+            retVDI = inSession.xenapi.VDI.get_record(inVDI)
+            retVDI['VBDs'] = [ convertVBD(inSession, vbd) for vbd in retVDI['VBDs'] ]
+            retVDI['opaqueref'] = inVDI
+            return retVDI
+            
+        def convertPBD(inSession, inPBD):
+            retPBD = inSession.xenapi.PBD.get_record(inPBD)
+            srRef = retPBD['SR']
+            try:
+                retPBD['SR'] = inSession.xenapi.SR.get_record(retPBD['SR'])
+            except:
+                retPBD['SR'] = None # retPBD['SR'] is OpaqueRef:NULL
+            
+            # Get VDIs for udev SRs only - a pool may have thousands of non-udev VDIs
+            if retPBD['SR'] is not None:
+                retPBD['SR']['opaqueref'] = srRef
+                if retPBD['SR'].get('type', '') == 'udev':
+                    retPBD['SR']['VDIs'] = [ convertVDI(inSession, vdi) for vdi in retPBD['SR']['VDIs'] ]
+                    for vdi in retPBD['SR']['VDIs']:
+                        vdi['SR'] = retPBD['SR']
+            
+            retPBD['opaqueref'] = inPBD
+            return retPBD
+        
+        host = self.data['host']
+        jobs = [ (getMetrics, host['metrics']), (getSR, host['suspend_image_sr']), (getSR, host['crash_dump_sr']) ]
+        jobs += [ (convertCPU, cpu) for cpu in host['host_CPUs'] ]
+        jobs += [ (convertPIF, pif) for pif in host['PIFs'] ]
+        jobs += [ (convertPBD, pbd) for pbd in host['PBDs'] ]
+        jobs.append( (self.FetchPools, ) )
+        changeCount = HotData.Inst().DomainChangeCount()
+        jobs.append( (self.FetchDom0, self.CachedDom0Ref()) )
+        
+        results = iter(self.RunParallel(jobs)) # Results are in the same order as the jobs
+        host['metrics'] = results.next()
+        host['suspend_image_sr'] = results.next()
+        host['crash_dump_sr'] = results.next()
+        host['host_CPUs'] = [ results.next() for cpu in host['host_CPUs'] ]
+        host['PIFs'] = [ results.next() for pif in host['PIFs'] ]
+        host['PBDs'] = [ results.next() for pbd in host['PBDs'] ]
+        self.data['pools'] = results.next()
+        self.SetDom0(results.next(), changeCount)
+
+    def UpdateHostBulk(self):
+        # Expands the items we need in the host record by fetching each class with one call and joining the records
+        # by reference, so that the number of calls doesn't grow with the number of CPUs, PIFs and PBDs.  The calls
+        # are independent so run in parallel.  Returns the SR records, which Update reuses for self.data['sr']
+        host = self.data['host']
+        hostRef = host['opaqueref']
+        
+        jobs = [
+            (lambda inSession: inSession.xenapi.host_metrics.get_record(host['metrics']), ),
+            (self.GetAllRecordsWhere, 'host_cpu', 'host', hostRef),
+            (self.GetAllRecordsWhere, 'PIF', 'host', hostRef),
+            (lambda inSession: inSession.xenapi.PIF_metrics.get_all_records(), ),
+            (lambda inSession: inSession.xenapi.network.get_all_records(), ),
+            (self.GetAllRecordsWhere, 'PBD', 'host', hostRef),
+            (lambda inSession: inSession.xenapi.SR.get_all_records(), ),
+            (self.FetchPools, ),
+            (self.FetchDom0, self.CachedDom0Ref())
+        ]
+        changeCount = HotData.Inst().DomainChangeCount()
+        results = iter(self.RunParallel(jobs)) # Results are in the same order as the jobs
+        host['metrics'] = results.next()
+        cpus = results.next()
+        pifs = results.next()
+        pifMetrics = results.next()
+        networks = results.next()
+        pbds = results.next()
+        srs = results.next()
+        self.data['pools'] = results.next()
+        self.SetDom0(results.next(), changeCount)
+
+        def convertSR(inSR):
+            # Copy the record, as srs is also used for self.data['sr']
+            if inSR in srs:
+                retVal = srs[inSR].copy()
+            else:
+                # NULL or dangling reference
+                retVal = None
+            return retVal
+        
+        host['suspend_image_sr'] = convertSR(host['suspend_image_sr'])
+        host['crash_dump_sr'] = convertSR(host['crash_dump_sr'])
+        # Objects can be created or destroyed between fetching the host record and the classes, so references
+        # missing from the fetched records are skipped
+        host['host_CPUs'] = [ cpus[cpu] for cpu in host['host_CPUs'] if cpu in cpus ]
+        
+        def convertPIF(inPIF):
+            retVal = pifs[inPIF]
+            if retVal['metrics'] in pifMetrics:
+                retVal['metrics'] = pifMetrics[retVal['metrics']]
+            else:
+                retVal['metrics' ] = self.FakeMetrics(inPIF)
+            
+            if retVal['network'] in networks:
+                retVal['network'] = networks[retVal['network']]
+            else:
+                XSLogError('Missing network record: ', retVal['network'])
+                
+            retVal['opaqueref'] = inPIF
+            return retVal
+        
+        host['PIFs'] = [ convertPIF(pif) for pif in host['PIFs'] if pif in pifs ]
+        
+        udevSRs = []
+        def convertPBD(inPBD):
+            retPBD = pbds[inPBD]
+            srRef = retPBD['SR']
+            retPBD['SR'] = convertSR(srRef)
+            if retPBD['SR'] is not None:
+                retPBD['SR']['opaqueref'] = srRef
+                if retPBD['SR'].get('type', '') == 'udev':
+                    udevSRs.append(retPBD['SR'])
+            retPBD['opaqueref'] = inPBD
+            return retPBD
+        
+        host['PBDs'] = [ convertPBD(pbd) for pbd in host['PBDs'] if pbd in pbds ]
+        
+        # Get VDIs for udev SRs only - a pool may have thousands of non-udev VDIs
+        if len(udevSRs) > 0:
+            self.RunParallel([ (self.FetchUDevVDIs, sr) for sr in udevSRs ])
+        
+        return srs
+
+    def FetchUDevVDIs(self, inSession, ioSR):
+        # Replaces the VDI references in the udev SR record ioSR with VDI records, each with its VBD records
+        vdis = self.GetAllRecordsWhere(inSession, 'VDI', 'SR', ioSR['opaqueref'])
+        batch = MultiCall(inSession)
+        vbdResults = {}
+        for vdi in vdis.values():
+            for vbd in vdi['VBDs']:
+                vbdResults[vbd] = batch.xenapi.VBD.get_record(vbd)
+        batch.Execute()
+        
+        def convertVDI(inVDI):
+            retVDI = vdis[inVDI]
+            vbds = []
+            for vbd in retVDI['VBDs']:
+                if vbdResults[vbd].failure is None: # VBDs destroyed since the VDI was fetched are skipped
+                    retVBD = vbdResults[vbd].Value()
+                    retVBD['opaqueref'] = vbd
+                    vbds.append(retVBD)
+            retVDI['VBDs'] = vbds
+            retVDI['opaqueref'] = inVDI
+            retVDI['SR'] = ioSR
+            return retVDI
+        
+        ioSR['VDIs'] = [ convertVDI(vdi) for vdi in ioSR['VDIs'] if vdi in vdis ]
+        
+    def GetAllRecordsWhere(self, inSession, inClass, inField, inValue):
+        # Returns the records of class inClass whose field inField is inValue
+        xapiClass = getattr(inSession.xenapi, inClass)
+        try:
+            retVal = xapiClass.get_all_records_where('field "%s" = "%s"' % (inField, inValue))
+        except XenAPI.Failure, e:
+            if e.details[0] != 'MESSAGE_METHOD_UNKNOWN':
+                raise
+            # This xapi doesn't have get_all_records_where, so filter here
+            retVal = {}
+            for opaqueRef, record in xapiClass.get_all_records().iteritems():
+                if record.get(inField, None) == inValue:
+                    retVal[opaqueRef] = record
+        return retVal
+
+    def CachedDom0Ref(self):
+        # Returns the reference to the DOM-0 VM found by a previous update, or None if it must be looked up again.
+        # It's kept for the life of the session unless HotData sees an event that could change which VM is DOM-0
+        retVal = None
+        cache = self.dom0Cache
+        if cache is not None and cache.session is self.session and cache.changeCount == HotData.Inst().DomainChangeCount():
+            if cache.ref in self.data['host']['resident_VMs']:
+                retVal = cache.ref
+        return retVal
+    
+    def FindDom0Ref(self, inSession):
+        hostRef = self.data['host']['opaqueref']
+        retVal = None
+        try:
+            vms = inSession.xenapi.VM.get_all_records_where(
+                'field "is_control_domain" = "true" and field "resident_on" = "%s"' % hostRef)
+            for opaqueRef, vm in vms.iteritems():
+                # Driver domains are also control domains
+                if vm['domid'] == '0' and vm['resident_on'] == hostRef:
+                    retVal = opaqueRef
+        except XenAPI.Failure, e:
+            if e.details[0] != 'MESSAGE_METHOD_UNKNOWN':
+                raise
+            # This xapi doesn't have get_all_records_where, so check each resident VM's domid in one multicall
+            batch = MultiCall(inSession)
+            domIDs = [ (vm, batch.xenapi.VM.get_domid(vm)) for vm in self.data['host']['resident_VMs'] ]
+            batch.Execute()
+            for vm, domID in domIDs:
+                if domID.Value() == '0':
+                    retVal = vm
+        return retVal
+    
+    def FetchDom0(self, inSession, inDom0Ref):
+        # Only load the DOM-0 VM to save time.  inDom0Ref is the result of CachedDom0Ref
+        dom0Ref = inDom0Ref
+        if dom0Ref is None:
+            dom0Ref = self.FindDom0Ref(inSession)
+        if dom0Ref is None:
+            retVal = None
+        else:
+            batch = MultiCall(inSession)
+            record = batch.xenapi.VM.get_record(dom0Ref)
+            allowedVBDDevices = batch.xenapi.VM.get_allowed_VBD_devices(dom0Ref)
+            batch.Execute()
+            retVal = record.Value()
+            retVal['allowed_VBD_devices'] = allowedVBDDevices.Value()
+            retVal['opaqueref'] = dom0Ref
+        return retVal
+    
+    def SetDom0(self, inDom0, inChangeCount):
+        # Replaces DOM-0's reference in host['resident_VMs'] with its record, and caches the reference.
+        # inChangeCount is HotData's DomainChangeCount from before the lookup
+        if inDom0 is None:
+            XSLogError('Could not find the DOM-0 VM')
+            self.dom0Cache = None
+        else:
+            self.dom0Cache = Struct(session = self.session, changeCount = inChangeCount, ref = inDom0['opaqueref'])
+            residentVMs = self.data['host']['resident_VMs']
+            for i in range(len(residentVMs)):
+                if residentVMs[i] == inDom0['opaqueref']:
+                    residentVMs[i] = inDom0
+
+    def FetchPools(self, inSession):
+        # The pool records and the uuid lookups that follow them cost two round trips in total
+        batch = MultiCall(inSession)
+        uuidCalls = {}
+        def queueUUIDs(inPools):
+            for id, pool in inPools.iteritems():
+                # SRs in the pool record are often apparently valid but dangling references.
+                # We fetch the uuid to determine whether the SRs are real.
+                uuidCalls[id] = [
+                    ('master_uuid', batch.xenapi.host.get_uuid(pool['master'])),
+                    ('default_SR_uuid', batch.xenapi.SR.get_uuid(pool['default_SR'])),
+                    ('suspend_image_SR_uuid', batch.xenapi.SR.get_uuid(pool['suspend_image_SR'])),
+                    ('crash_dump_SR_uuid', batch.xenapi.SR.get_uuid(pool['crash_dump_SR']))
+                ]
+        pools = batch.xenapi.pool.get_all_records().Then(queueUUIDs)
+        batch.Execute()
+        
+        retVal = {}
+        for id, pool in pools.Value().iteritems():
+            pool['opaqueref'] = id
+            for name, result in uuidCalls[id]:
+                if result.failure is None:
+                    pool[name] = result.Value()
+                else:
+                    pool[name] = None
+            retVal[id] = pool
+        return retVal
+
+    def StartUpdate(self):
+        # Starts an update on a background thread, unless one is already running.  The update fills in a copy of
+        # self.data, and FinishUpdate swaps it in when complete, so the UI keeps using the current data meanwhile.
+        # If an update is already running it may predate the caller's change, so another follows it
+        if self.backgroundUpdate is not None:
+            self.updateRequested = True
+        else:
+            builder = Data()
+            builder.data = self.data.copy()
+            for name in self.UPDATE_NESTED_SECTIONS:
+                if name in builder.data:
+                    builder.data[name] = builder.data[name].copy()
+            for name in self.UPDATE_STATE:
+                setattr(builder, name, getattr(self, name))
+            # The builder borrows a session of its own for the length of the update, as sessions can't be used
+            # by two threads at once, and works on its own copy of fileStamps
+            builder.fileStamps = self.fileStamps.copy()
+            
+            update = Struct(builder = builder, startFileStamps = self.fileStamps.keys(), localChanges = [], succeeded = False)
+            def run():
+                try:
+                    try:
+                        builder.Update()
+                        update.succeeded = True
+                    except Exception, e:
+                        XSLogError('Background data update failed: ', e)
+                finally:
+                    # Returned here rather than in FinishUpdate, which isn't called if Reset discards this instance
+                    builder.session = Auth.Inst().ReturnSession(builder.session)
+            update.thread = threading.Thread(target = run)
+            update.thread.setDaemon(True)
+            self.backgroundUpdate = update
+            update.thread.start()
+    
+    def IsUpdating(self):
+        return self.backgroundUpdate is not None
+    
+    def FinishUpdate(self, inWait = False):
+        # Swaps in the data from a background update if it has finished.  Returns True if the data has changed
+        retVal = False
+        update = self.backgroundUpdate
+        if update is not None:
+            if inWait:
+                update.thread.join()
+            if not update.thread.isAlive():
+                self.backgroundUpdate = None
+                builder = update.builder
+                # Keep the effect of any FilesWritten calls made on this thread whilst the update ran
+                for key in update.startFileStamps:
+                    if key not in self.fileStamps and key in builder.fileStamps:
+                        del builder.fileStamps[key]
+                for name in self.UPDATE_STATE:
+                    setattr(self, name, getattr(builder, name))
+                
+                if update.succeeded:
+                    newData = builder.data
+                    # Keep anything added on this thread whilst the update ran, e.g. the results of probes
+                    for name, value in self.data.iteritems():
+                        if name not in newData:
+                            newData[name] = value
+                        elif name in self.UPDATE_NESTED_SECTIONS:
+                            for key, nestedValue in value.iteritems():
+                                newData[name].setdefault(key, nestedValue)
+                    self.data = newData
+                    # Reapply changes made by SetData whilst the update ran
+                    for names, value in update.localChanges:
+                        self.SetData(names, value)
+                    retVal = True
+                self.CollectFinishedProbes()
+                if self.updateRequested:
+                    self.updateRequested = False
+                    self.StartUpdate()
+        return retVal
     
     def Update(self):
+        # Wait for any background update, so that the two don't use the session at the same time.  This update
+        # supersedes any requested whilst that one ran
+        self.updateRequested = False
+        self.FinishUpdate(True)
         self.data['host'] = {}
 
         self.RequireSession()
         if self.session is not None:
+            srMap = None
             try:
                 try:
                     thisHost = self.session.xenapi.session.get_this_host(self.session._session)
@@ -170,40 +670,10 @@ class Data:
                 self.data['host'] = hostRecord
                 self.data['host']['opaqueref'] = thisHost
                 
-                # Expand the items we need in the host record
-                self.data['host']['metrics'] = self.session.xenapi.host_metrics.get_record(self.data['host']['metrics'])
-                
-                try:
-                    self.data['host']['suspend_image_sr'] = self.session.xenapi.SR.get_record(self.data['host']['suspend_image_sr'])
-                except:
-                    # NULL or dangling reference
-                    self.data['host']['suspend_image_sr'] = None
-                    
-                try:
-                    self.data['host']['crash_dump_sr'] = self.session.xenapi.SR.get_record(self.data['host']['crash_dump_sr'])
-                except:
-                    # NULL or dangling reference
-                    self.data['host']['crash_dump_sr'] = None
-                
-                convertCPU = lambda cpu: self.session.xenapi.host_cpu.get_record(cpu)
-                self.data['host']['host_CPUs'] = map(convertCPU, self.data['host']['host_CPUs'])
-                
-                def convertPIF(inPIF):
-                    retVal = self.session.xenapi.PIF.get_record(inPIF)
-                    try:
-                        retVal['metrics'] = self.session.xenapi.PIF_metrics.get_record(retVal['metrics'])
-                    except XenAPI.Failure:
-                        retVal['metrics' ] = self.FakeMetrics(inPIF)
-                    
-                    try:
-                        retVal['network'] = self.session.xenapi.network.get_record(retVal['network'])
-                    except XenAPI.Failure, e:
-                        XSLogError('Missing network record: ', e)
-                        
-                    retVal['opaqueref'] = inPIF
-                    return retVal
-    
-                self.data['host']['PIFs'] = map(convertPIF, self.data['host']['PIFs'])
+                if Config.Inst().DataUpdateEngine() == 'bulk':
+                    srMap = self.UpdateHostBulk()
+                else:
+                    self.UpdateHostParallel()
     
                 # Create missing PIF names
                 for pif in self.data['host']['PIFs']:
@@ -217,93 +687,18 @@ class Data:
                 # Sort PIFs by device name for consistent order
                 self.data['host']['PIFs'].sort(lambda x, y : cmp(x['device'], y['device']))
 
-                def convertVBD(inVBD):
-                    retVBD = self.session.xenapi.VBD.get_record(inVBD)
-                    retVBD['opaqueref'] = inVBD
-                    return retVBD
-                    
-                def convertVDI(inVDI):
-                    retVDI = self.session.xenapi.VDI.get_record(inVDI)
-                    retVDI['VBDs'] = map(convertVBD, retVDI['VBDs'])
-                    retVDI['opaqueref'] = inVDI
-                    return retVDI
-                    
-                def convertPBD(inPBD):
-                    retPBD = self.session.xenapi.PBD.get_record(inPBD)
-                    srRef = retPBD['SR']
-                    try:
-                        retPBD['SR'] = self.session.xenapi.SR.get_record(retPBD['SR'])
-                    except:
-                        retPBD['SR'] = None # retPBD['SR'] is OpaqueRef:NULL
-                    
-                    # Get VDIs for udev SRs only - a pool may have thousands of non-udev VDIs
-                    if retPBD['SR'] is not None:
-                        retPBD['SR']['opaqueref'] = srRef
-                        if retPBD['SR'].get('type', '') == 'udev':
-                            retPBD['SR']['VDIs'] = map(convertVDI, retPBD['SR']['VDIs'])
-                            for vdi in retPBD['SR']['VDIs']:
-                                vdi['SR'] = retPBD['SR']
-                    
-                    retPBD['opaqueref'] = inPBD
-                    return retPBD
-                    
-                self.data['host']['PBDs'] = map(convertPBD, self.data['host']['PBDs'])
-
-                # Only load the to DOM-0 VM to save time
-                vmList = self.data['host']['resident_VMs']
-                for i in range(len(vmList)):
-                    vm = vmList[i]
-                    domID = self.session.xenapi.VM.get_domid(vm)
-                    if domID == '0':
-                        vmList[i] = self.session.xenapi.VM.get_record(vm)
-                        vmList[i]['allowed_VBD_devices'] = self.session.xenapi.VM.get_allowed_VBD_devices(vm)
-                        vmList[i]['opaqueref'] = vm
-                
-                pools = self.session.xenapi.pool.get_all_records()
-                
-                def convertPool(inID, inPool):
-                    retPool = inPool
-                    retPool['opaqueref'] = inID
-                    try:
-                        retPool['master_uuid'] = self.session.xenapi.host.get_uuid(inPool['master'])
-                    except:
-                        retPool['master_uuid'] = None
-
-                    # SRs in the pool record are often apparently valid but dangling references.
-                    # We fetch the uuid to determine whether the SRs are real.
-                    try:
-                        retPool['default_SR_uuid'] = self.session.xenapi.SR.get_uuid(inPool['default_SR'])
-                    except:
-                        retPool['default_SR_uuid'] = None
-
-                    try:
-                        retPool['suspend_image_SR_uuid'] = self.session.xenapi.SR.get_uuid(inPool['suspend_image_SR'])
-                    except:
-                        retPool['suspend_image_SR_uuid'] = None
-                        
-                    try:
-                        retPool['crash_dump_SR_uuid'] = self.session.xenapi.SR.get_uuid(inPool['crash_dump_SR'])
-                    except:
-                        retPool['crash_dump_SR_uuid'] = None
-                    return retPool
-                
-                self.data['pools'] = {}
-                for id, pool in pools.iteritems():
-                   self.data['pools'][id] = convertPool(id, pool)
-
             except socket.timeout:
-                self.session = None
+                self.session = Auth.Inst().DiscardSession(self.session)
             except Exception, e:
                 XSLogError('Data update failed: ', e)
 
             try:
                 self.data['sr'] = []
 
-                pbdRefs = []
-                for pbd in self.data['host'].get('PBDs', []):
-                    pbdRefs.append(pbd['opaqueref'])
+                pbdRefs = set([ pbd['opaqueref'] for pbd in self.data['host'].get('PBDs', []) ])
                     
-                srMap= self.session.xenapi.SR.get_all_records()
+                if srMap is None:
+                    srMap = self.session.xenapi.SR.get_all_records()
                 for opaqueRef, values in srMap.iteritems():
                     values['opaqueref'] = opaqueRef
                     values['islocal'] = False
@@ -316,13 +711,15 @@ class Data:
             except Exception, e:
                 XSLogError('SR data update failed: ', e)
 
+        self.CollectFinishedProbes() # So that the hardware cache is saved even if some sections are never read
         self.UpdateFromResolveConf()
         self.UpdateFromSysconfig()
         self.UpdateFromNTPConf()
         self.UpdateFromTimezone()
         self.UpdateFromKeymap()
         
-        if os.path.isfile("/sbin/chkconfig"):
+        # chkconfig changes the links in these directories, so only run it if they have changed
+        if os.path.isfile("/sbin/chkconfig") and self.FilesChanged('chkconfig', '/etc/rc.d/rc5.d', '/etc/systemd/system/multi-user.target.wants'):
             (status, output) = commands.getstatusoutput("/sbin/chkconfig --list sshd && /sbin/chkconfig --list ntpd")
             if status == 0:
                 self.ScanChkConfig(output.split("\n"))
@@ -380,6 +777,7 @@ class Data:
         self.data['derived']['brand'] = brand
 
     def Dump(self):
+        self.CollectProbes()
         pprint(self.data)
 
     def HostnameSet(self, inHostname):
@@ -398,11 +796,21 @@ class Data:
         self.RequireSession()
         self.session.xenapi.host.set_name_label(self.host.opaqueref(), inNameLabel)
 
+    def SetData(self, inNames, inValue):
+        # Sets an item of self.data from this thread, e.g. SetData(['dns', 'nameservers'], servers).  Changes made
+        # whilst a background update runs are reapplied to the data it produces
+        data = self.data
+        for name in inNames[:-1]:
+            data = data.setdefault(name, {})
+        data[inNames[-1]] = inValue
+        if self.backgroundUpdate is not None:
+            self.backgroundUpdate.localChanges.append( (inNames, inValue) )
+
     def NameserversSet(self, inServers):
-        self.data['dns']['nameservers'] = inServers
+        self.SetData(['dns', 'nameservers'], inServers)
 
     def NTPServersSet(self, inServers):
-        self.data['ntp']['servers'] = inServers
+        self.SetData(['ntp', 'servers'], inServers)
 
     def LoggingDestinationSet(self, inDestination):
         Auth.Inst().AssertAuthenticated()
@@ -413,20 +821,62 @@ class Data:
         self.session.xenapi.host.add_to_logging(self.host.opaqueref(), 'syslog_destination', inDestination)
         self.session.xenapi.host.syslog_reconfigure(self.host.opaqueref())
     
+    def FileStamp(self, inPath):
+        # Identifies the version of a file or directory, or is None if it doesn't exist
+        try:
+            stat = os.stat(inPath)
+            retVal = (stat.st_mtime, stat.st_ino, stat.st_size)
+        except OSError:
+            retVal = None
+        return retVal
+    
+    def FilesChanged(self, inKey, *inPaths):
+        # Returns True if any of inPaths has changed since the last call for inKey, so that updates don't
+        # reread and reparse files that haven't changed
+        stamps = [ self.FileStamp(path) for path in inPaths ]
+        retVal = (self.fileStamps.get(inKey, None) != stamps)
+        self.fileStamps[inKey] = stamps
+        return retVal
+    
+    def FilesWritten(self, inKey):
+        # Forces the next update to reread the files for inKey.  Called after we change the files, as mtime may
+        # only have a resolution of one second and a rewritten file can have the same inode and size
+        if inKey in self.fileStamps:
+            del self.fileStamps[inKey]
+    
+    def ReadFileLines(self, inPath):
+        # Returns the lines of inPath as '/bin/cat' would give them, or None if it can't be read
+        try:
+            file = open(inPath)
+            try:
+                text = file.read()
+            finally:
+                file.close()
+        except IOError:
+            retVal = None
+        else:
+            if text.endswith('\n'):
+                text = text[:-1]
+            retVal = text.split('\n')
+        return retVal
+    
     def UpdateFromResolveConf(self):
-        (status, output) = commands.getstatusoutput("/bin/cat /etc/resolv.conf")
-        if status == 0:
-            self.ScanResolvConf(output.split("\n"))
+        if self.FilesChanged('resolv.conf', '/etc/resolv.conf'):
+            lines = self.ReadFileLines('/etc/resolv.conf')
+            if lines is not None:
+                self.ScanResolvConf(lines)
     
     def UpdateFromSysconfig(self):
-        (status, output) = commands.getstatusoutput("/bin/cat /etc/sysconfig/network")
-        if status == 0:
-            self.ScanSysconfigNetwork(output.split("\n"))
+        if self.FilesChanged('sysconfig', '/etc/sysconfig/network'):
+            lines = self.ReadFileLines('/etc/sysconfig/network')
+            if lines is not None:
+                self.ScanSysconfigNetwork(lines)
     
     def UpdateFromNTPConf(self):
-        (status, output) = commands.getstatusoutput("/bin/cat /etc/ntp.conf")
-        if status == 0:
-            self.ScanNTPConf(output.split("\n"))
+        if self.FilesChanged('ntp.conf', '/etc/ntp.conf'):
+            lines = self.ReadFileLines('/etc/ntp.conf')
+            if lines is not None:
+                self.ScanNTPConf(lines)
             
     def StringToBool(self, inString):
         return inString.lower().startswith('true')
@@ -461,6 +911,7 @@ class Data:
             file.write("HOSTNAME="+self.sysconfig.network.hostname('')+"\n")
         finally:
             if file is not None: file.close()
+            self.FilesWritten('sysconfig')
             self.UpdateFromSysconfig()
     
     def SaveToNTPConf(self):
@@ -476,6 +927,7 @@ class Data:
                 file.write("server "+server+"\n")
         finally:
             if file is not None: file.close()
+            self.FilesWritten('ntp.conf')
             self.UpdateFromNTPConf()
     
     def ScanDmiDecode(self, inLines):
@@ -668,6 +1120,19 @@ class Data:
             else:
                 self.data['ntp']['othercontents'].append(line)
                 
+    def ScanSSLFingerprint(self, inLines):
+        fp = "\n".join(inLines).split("=")
+        if len(fp) >= 2:
+            self.data['sslfingerprint'] = fp[1]
+        else:
+            self.data['sslfingerprint'] = "<Unknown>"
+    
+    def ScanSSHFingerprint(self, inLines):
+        try:
+            self.data['sshfingerprint'] = inLines[0].split(' ')[1]
+        except:
+            self.data['sshfingerprint'] = Lang('<Unknown>')
+    
     def ScanCPUInfo(self, inLines):
         self.data['cpuinfo'] = {}
         for line in inLines:
@@ -690,22 +1155,24 @@ class Data:
                 Lang('Pacific Ocean') : 'Pacific',
                 Lang('Other') : 'Etc'
             },
-            'cities' : {} 
         }
         
         filterExp = re.compile('('+'|'.join(self.data['timezones']['continents'].values())+')')
 
         zonePath = '/usr/share/zoneinfo'
-        for root, dirs, files in os.walk(zonePath):
-            for filename in files:
-                filePath = os.path.join(root, filename)
-                localPath = filePath[len(zonePath)+1:] # Just the path after /usr/share/zoneinfo/
-                if filterExp.match(localPath):
-                    # Store only those entries starting with one of our known prefixes
-                    self.data['timezones']['cities'][localPath] = filePath
+        def cityName(inRoot, inFilename):
+            localPath = os.path.join(inRoot, inFilename)[len(zonePath)+1:] # Just the path after /usr/share/zoneinfo/
+            if filterExp.match(localPath):
+                # Store only those entries starting with one of our known prefixes
+                retVal = localPath
+            else:
+                retVal = None
+            return retVal
+        
+        self.AddCatalogue('timezones', 'cities', zonePath, cityName)
 
     def UpdateFromTimezone(self):
-        if os.path.isfile('/etc/timezone'):
+        if self.FilesChanged('timezone', '/etc/timezone') and os.path.isfile('/etc/timezone'):
             file = open('/etc/timezone')
             self.data['timezones']['current'] = file.readline().rstrip()
             file.close()
@@ -719,6 +1186,7 @@ class Data:
         file = open('/etc/timezone', 'w')
         file.write(inTimezone+"\n")
         file.close()
+        self.FilesWritten('timezone')
 
         if os.path.exists('/etc/sysconfig/clock'):
             cfg = SimpleConfigFile()
@@ -730,27 +1198,98 @@ class Data:
         return commands.getoutput('/bin/date -R')
 
     def ReadKeymaps(self):
-        self.data['keyboard'] = {
-            'keymaps' : {} 
-        }
+        self.data['keyboard'] = {}
 
         keymapsPath = '/lib/kbd/keymaps/i386'
         excludeExp = re.compile(re.escape(keymapsPath)+r'/include')
         
         filterExp = re.compile(r'(.*).map.gz$')
 
-        for root, dirs, files in os.walk(keymapsPath):
-            for filename in files:
-                if not excludeExp.match(root):
-                    match = filterExp.match(filename)
-                    if match:
-                        filePath = os.path.join(root, filename)
-                        self.data['keyboard']['keymaps'][match.group(1)] = filePath
+        def keymapName(inRoot, inFilename):
+            retVal = None
+            if not excludeExp.match(inRoot):
+                match = filterExp.match(inFilename)
+                if match:
+                    retVal = match.group(1)
+            return retVal
+        
+        def checkKeymaps():
+            for value in self.data['keyboard']['namestomaps'].values():
+                if not value in self.data['keyboard']['keymaps']:
+                    XSLogError("Warning: Missing keymap " + value)
         
+        self.AddCatalogue('keyboard', 'keymaps', keymapsPath, keymapName, checkKeymaps)
         self.data['keyboard']['namestomaps'] = Keymaps.NamesToMaps()
-        for value in self.data['keyboard']['namestomaps'].values():
-            if not value in self.data['keyboard']['keymaps']:
-                XSLogError("Warning: Missing keymap " + value)
+    
+    def AddCatalogue(self, inSection, inName, inPath, inEntryName, inOnLoad = None):
+        # Registers self.data[inSection][inName], a dictionary of the files below inPath.  inEntryName(dir, filename)
+        # returns the key for each file, or None to leave it out.  The dictionary is built on first use, and saved
+        # with an index for prefix searches in Config.CatalogueCacheFile(), which is reused until one of the
+        # directories below inPath changes
+        self.catalogues[(inSection, inName)] = Struct(path = inPath, entryName = inEntryName, onLoad = inOnLoad,
+            index = None)
+    
+    def RequireCatalogue(self, inSection, inName):
+        catalogue = self.catalogues[(inSection, inName)]
+        if catalogue.index is None:
+            cacheFile = Config.Inst().CatalogueCacheFile()
+            cache = None
+            if cacheFile != '':
+                cache = self.LoadCacheFile(cacheFile)
+            try:
+                if cache['version'] != self.CATALOGUE_CACHE_VERSION:
+                    raise Exception('Old format')
+            except Exception, e:
+                cache = { 'version' : self.CATALOGUE_CACHE_VERSION, 'catalogues' : {} }
+            
+            key = inSection+'.'+inName
+            entry = cache['catalogues'].get(key, None)
+            if entry is not None and entry['path'] == catalogue.path:
+                for path, stamp in entry['dirs']:
+                    if self.FileStamp(path) != stamp:
+                        entry = None
+                        break
+            else:
+                entry = None
+
+            if entry is None:
+                entry = { 'path' : catalogue.path, 'dirs' : [], 'files' : {} }
+                for root, dirs, files in os.walk(catalogue.path):
+                    # Adding or removing a file or directory changes the mtime of its parent directory
+                    entry['dirs'].append( (root, self.FileStamp(root)) )
+                    for filename in files:
+                        name = catalogue.entryName(root, filename)
+                        if name is not None:
+                            entry['files'][name] = os.path.join(root, filename)
+                # Lower case names, sorted for prefix searches
+                entry['index'] = [ (name.lower(), name) for name in entry['files'].keys() ]
+                entry['index'].sort()
+                if cacheFile != '':
+                    cache['catalogues'][key] = entry
+                    self.SaveCacheFile(cacheFile, cache)
+            
+            self.data[inSection][inName] = entry['files']
+            catalogue.index = entry['index']
+            if catalogue.onLoad is not None:
+                catalogue.onLoad()
+        return catalogue
+    
+    def CatalogueSearch(self, inSection, inName, inPrefix):
+        # Returns the sorted keys of self.data[inSection][inName] that start with inPrefix, ignoring case
+        index = self.RequireCatalogue(inSection, inName).index
+        prefix = inPrefix.lower()
+        retVal = []
+        i = bisect.bisect_left(index, (prefix, ''))
+        while i < len(index) and index[i][0].startswith(prefix):
+            retVal.append(index[i][1])
+            i += 1
+        return retVal
+    
+    def TimezoneSearch(self, inPrefix):
+        return self.CatalogueSearch('timezones', 'cities', inPrefix)
+    
+    def KeymapSearch(self, inPrefix):
+        return self.CatalogueSearch('keyboard', 'keymaps', inPrefix)
     
     def KeymapSet(self, inKeymap):
         # mapFile = self.keyboard.keymaps().get(inKeymap, None)
@@ -899,6 +1438,7 @@ class Data:
             status, output = commands.getstatusoutput("/sbin/chkconfig sshd on")
         else:
             status, output = commands.getstatusoutput("/sbin/chkconfig sshd off")
+        self.FilesWritten('chkconfig')
         
         if status != 0:
             raise Exception(output)
@@ -1085,12 +1625,14 @@ class Data:
     def EnableNTP(self):
         status, output = commands.getstatusoutput(
             "(export TERM=xterm && /sbin/chkconfig ntpd on && /etc/init.d/ntpd start)")
+        self.FilesWritten('chkconfig')
         if status != 0:
             raise Exception(output)
         
     def DisableNTP(self):
         status, output = commands.getstatusoutput(
             "(export TERM=xterm && /sbin/chkconfig ntpd off && /etc/init.d/ntpd stop)")
+        self.FilesWritten('chkconfig')
         if status != 0:
             raise Exception(output)
 
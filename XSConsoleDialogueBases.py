@@ -52,6 +52,11 @@ class Dialogue:
             
     def UpdateFields(self):
         pass        
+    
+    def HotDataChanges(self):
+        # Returns a list of the HotData classes (e.g. 'vm') and HotOpaqueRefs that this dialogue may have changed,
+        # for Layout.PopDialogue to invalidate.  None means unknown, so the whole cache is refetched
+        return None
             
     def NeedsCursor(self):
         retVal = False
@@ -102,6 +107,9 @@ class InfoDialogue(Dialogue):
             })
 
         pane.AddKeyHelpField( helpKeys )
+    
+    def HotDataChanges(self):
+        return []
         
     def HandleKey(self, inKey):
         handled = True
@@ -129,6 +137,9 @@ class BannerDialogue(Dialogue):
         
         pane.AddWrappedCentredBoldTextField(self.text)
 
+    def HotDataChanges(self):
+        return []
+
 class QuestionDialogue(Dialogue):
     def __init__(self, inText, inHandler):
         Dialogue.__init__(self,)
@@ -183,6 +194,9 @@ class LoginDialogue(Dialogue):
             Lang("<Enter>") : Lang("Next/OK"),
             Lang("<Tab>") : Lang("Next")
         })
+    
+    def HotDataChanges(self):
+        return [] # The function called on success pushes its own dialogue
         
     def HandleKey(self, inKey):
         handled = True
@@ -717,6 +731,9 @@ class ProgressDialogue(Dialogue):
     def LiveUpdateFields(self):
         self.UpdateFields()
     
+    def HotDataChanges(self):
+        return [] # The task invalidates HotData when it completes
+    
     def ChangeState(self, inState):
         self.state = inState
         self.BuildPane()
@@ -15,7 +15,7 @@
 
 import XenAPI
 
-import commands, re, shutil, sys, socket
+import commands, re, shutil, sys, socket, threading, Queue
 from pprint import pprint
 
 from XSConsoleAuth import *
@@ -23,93 +23,361 @@ from XSConsoleLang import *
 from XSConsoleState import *
 from XSConsoleUtils import *
 
-class HotOpaqueRef:
-    def __init__(self, inOpaqueRef, inType):
-        self.opaqueRef = inOpaqueRef
-        self.type = inType
-        self.hash = hash(inOpaqueRef)
+class HotOpaqueRef(str):
+    # An OpaqueRef string tagged with the type of the object it refers to.  The type is held by a subclass per
+    # type, so instances have no __dict__, and hashing and comparison are the C string implementations.  As
+    # before, two HotOpaqueRefs are equal if their OpaqueRefs are equal, whatever their types.  Instances are
+    # interned, so that the many records referring to one object share a single HotOpaqueRef
+    __slots__ = ()
+    INTERN_LIMIT = 200000 # The intern table is emptied when it reaches this size, so that it can't grow without limit
+    typeClasses = {}
+    interned = {}
+    
+    def __new__(cls, inOpaqueRef, inType):
+        retVal = cls.interned.get( (inOpaqueRef, inType), None)
+        if retVal is None:
+            typeClass = cls.typeClasses.get(inType, None)
+            if typeClass is None:
+                typeClass = type('HotOpaqueRef', (HotOpaqueRef,), { '__slots__' : (), 'type' : inType })
+                cls.typeClasses[inType] = typeClass
+            if len(cls.interned) >= cls.INTERN_LIMIT:
+                cls.interned.clear()
+            retVal = str.__new__(typeClass, inOpaqueRef)
+            cls.interned[ (inOpaqueRef, inType) ] = retVal
+        return retVal
     
     def __repr__(self):
-        return str(self.__dict__)
+        return str({ 'opaqueRef' : self.OpaqueRef(), 'type' : self.type })
         
-    # __hash__ and __cmp__ allow this object to be used as a dictionary key
-    def __hash__(self):
-        return self.hash
-    
-    def __cmp__(self, inOther):
-        if not isinstance(inOther, HotOpaqueRef):
-            return 1
-        if self.opaqueRef == inOther.opaqueRef:
-            return 0
-        if self.opaqueRef < inOther.opaqueRef:
-            return -1
-        return 1
-    
-    def OpaqueRef(self): return self.opaqueRef
+    def OpaqueRef(self): return str.__str__(self)
     def Type(self): return self.type
         
-class HotAccessor:
-    def __init__(self, inName = None, inRefs = None):
-        self.name = FirstValue(inName, [])
-        self.refs = FirstValue(inRefs, [])
+class HotAccessor(object):
+    # A path into HotData, e.g. HotAccessor().vm[vmRef].name_label.  Each step links to the previous one
+    # rather than copying the path, and the path is compiled into lists of names and refs once, on first use.
+    # The attribute names are chosen so as not to hide xapi field names
+    __slots__ = ('hotParent', 'hotName', 'hotRef', 'hotPath')
+    
+    def __init__(self, inParent = None, inName = None, inRef = None):
+        self.hotParent = inParent
+        self.hotName = inName
+        self.hotRef = inRef
+        self.hotPath = None
         
     def __getattr__(self, inName):
-        retVal = HotAccessor(self.name[:], self.refs[:]) # [:] copies the array
-        retVal.name.append(inName)
-        retVal.refs.append(None)
-        return retVal
+        if inName.startswith('__'):
+            # Don't treat python's special method lookups, e.g. from copy or pickle, as field names
+            raise AttributeError(inName)
+        return HotAccessor(self, inName, None)
 
     def __iter__(self):
-        iterData = HotData.Inst().GetData(self.name, {}, self.refs)
+        names, refs = self.HotPath()
+        iterData = HotData.Inst().GetData(names, {}, refs)
         if isinstance(iterData, types.DictType):
-            self.iterKeys = iterData.keys()
+            iterKeys = iterData.keys()
         elif isinstance(iterData, (types.ListType, types.TupleType)):
-            self.iterKeys = iterData[:] # [:] copy is necessary
+            iterKeys = iterData
         else:
             raise Exception(Lang("Cannot iterate over type '")+str(type(iterData))+"'")
-        return self
+        return iter([ HotAccessor(self.hotParent, self.hotName, key) for key in iterKeys ])
         
-    # This method will hide fields called 'next' in the xapi database.  If any appear, __iter__ will need to
-    # return a new object type and this method will need to be moved into that
-    def next(self):
-        if len(self.iterKeys) <= 0:
-            raise StopIteration
-        retVal = HotAccessor(self.name[:], self.refs[:]) # [:] copies the array
-        retVal.refs[-1] = self.iterKeys.pop(0)
-        return retVal
-
     def __getitem__(self, inParam):
         # These are square brackets selecting a particular item from a dict using its OpaqueRef
         if not isinstance(inParam, (types.IntType, HotOpaqueRef)):
             raise Exception('Use of HotAccessor[param] requires param of type int or HotOpaqueRef, but got '+str(type(inParam)))
-        retVal = HotAccessor(self.name[:], self.refs[:])
-        retVal.refs[-1] = inParam
-        return retVal
+        return HotAccessor(self.hotParent, self.hotName, inParam)
 
     def __call__(self, inParam = None):
         # These are the brackets on the end of the statement, with optional default value.
         # That makes it a request to fetch the data
         if isinstance(inParam, HotOpaqueRef):
             raise Exception('Use [] to pass HotOpaqueRefs to HotAccessors')
-        return HotData.Inst().GetData(self.name, inParam, self.refs)
+        names, refs = self.HotPath()
+        return HotData.Inst().GetData(names, inParam, refs)
+    
+    def HotPath(self):
+        # Returns the lists of names and refs that HotData.GetData navigates
+        if self.hotPath is None:
+            if self.hotName is None:
+                self.hotPath = ([], [])
+            else:
+                # Extend the parent's path, which is compiled once however many children it has
+                names, refs = self.hotParent.HotPath()
+                self.hotPath = (names + [self.hotName], refs + [self.hotRef])
+        return self.hotPath
     
     def HotOpaqueRef(self):
-        return self.refs[-1]
+        return self.hotRef
     
     def __str__(self):
-        return str(self.__dict__)
+        return str(self.HotPath())
     
     def __repr__(self):
-        return str(self.__dict__)
+        return str(self.HotPath())
+
+    # The query methods below apply to whole collections, e.g. HotAccessor().vm.  They use indexes
+    # maintained by HotData, so cost O(result) rather than a scan of the collection
+    def Where(self, **inFields):
+        # Returns HotAccessors to the objects whose fields have the given values, e.g. Where(power_state='Running').
+        # Fields holding references are matched against HotOpaqueRefs
+        return [ self[ref] for ref in self.QueryRefs(inFields) ]
+
+    def ByUUID(self, inUUID):
+        # Returns a HotAccessor to the object with the given uuid, or None
+        refs = self.QueryRefs({ 'uuid' : inUUID })
+        if len(refs) == 0:
+            retVal = None
+        else:
+            retVal = self[refs[0]]
+        return retVal
+
+    def ByNameLabel(self, inNameLabel):
+        # Returns a list, as name_labels needn't be unique
+        return self.Where(name_label = inNameLabel)
+
+    def GroupBy(self, inField):
+        # Returns a dictionary mapping each value of inField to a list of HotAccessors to the objects having that value
+        name = self.CollectionName()
+        try:
+            index = HotData.Inst().Index(name, inField)
+        except Exception, e:
+            index = {} # Data not present/fetchable
+        retVal = {}
+        for value, refs in index.iteritems():
+            retVal[value] = [ self[ref] for ref in refs ]
+        return retVal
+
+    def QueryRefs(self, inFields):
+        name = self.CollectionName()
+        try:
+            retVal = HotData.Inst().Query(name, inFields)
+        except Exception, e:
+            # Data not present/fetchable, so nothing matches
+            retVal = []
+        return retVal
+
+    def CollectionName(self):
+        names, refs = self.HotPath()
+        if len(names) != 1 or refs[0] is not None:
+            raise Exception("HotAccessor queries apply only to top-level collections, not '"+'.'.join(names)+"'")
+        return names[0]
+
+class HotEventWatcher(threading.Thread):
+    # Receives xapi events on a dedicated session and queues them for HotData.  HotData applies
+    # them on the UI thread (in PumpEvents) so that cached dictionaries are never changed under a reader.
+    # If HotData falls MAX_QUEUED_BATCHES behind, e.g. whilst the console is idle, the queued batches are
+    # dropped and the watcher pauses until HotData next reads, then starts again with a full snapshot
+    EVENT_TIMEOUT_SECS = 10.0 # Must be shorter than the socket timeout set in Auth
+    RETRY_SECS = 30
+    MAX_QUEUED_BATCHES = 32
+    
+    def __init__(self, inClasses):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.classes = inClasses
+        self.queue = Queue.Queue()
+        self.wanted = threading.Event()
+        self.wanted.set()
+        self.stopped = False
+    
+    def Stop(self):
+        self.stopped = True
+        self.wanted.set()
+    
+    def Get(self):
+        # Returns the next batch of events without blocking, or None if the queue is empty
+        self.wanted.set()
+        try:
+            retVal = self.queue.get_nowait()
+        except Queue.Empty:
+            retVal = None
+        return retVal
+    
+    def run(self):
+        while not self.stopped:
+            session = None
+            failure = None
+            try:
+                try:
+                    session = Auth.Inst().BorrowSession()
+                    if session is None:
+                        raise Exception('Could not open a session for event watching')
+                    token = ''
+                    while not self.stopped:
+                        # event.from is called via getattr because 'from' is a python keyword
+                        result = getattr(session.xenapi.event, 'from')(self.classes, token, self.EVENT_TIMEOUT_SECS)
+                        # An empty token means that this batch is a snapshot of every object in self.classes
+                        self.queue.put(Struct(events = result['events'], resync = (token == '')))
+                        token = result['token']
+                        if self.queue.qsize() >= self.MAX_QUEUED_BATCHES:
+                            self.Overflow()
+                            token = ''
+                except XenAPI.Failure, e:
+                    failure = e
+                    if e.details[0] == 'MESSAGE_METHOD_UNKNOWN':
+                        XSLog('xapi does not support event.from - HotData will use polling only')
+                        self.stopped = True
+                    else:
+                        XSLogError('HotData event watcher failed - falling back to polling: ', e)
+                except Exception, e:
+                    failure = e
+                    XSLogError('HotData event watcher failed - falling back to polling: ', e)
+            finally:
+                # A batch of None tells HotData that events are no longer arriving
+                self.queue.put(Struct(events = None, resync = False))
+                # The session is shared through the pool, so is only discarded if it has failed
+                session = Auth.Inst().ReleaseSession(session, failure)
+            if not self.stopped:
+                time.sleep(self.RETRY_SECS)
+
+    def Overflow(self):
+        # Replaces the queued batches with one telling HotData that events have stopped, so that it falls back
+        # to cache lifetimes, and waits for HotData to read it
+        self.wanted.clear()
+        while True:
+            try:
+                self.queue.get_nowait()
+            except Queue.Empty:
+                break
+        self.queue.put(Struct(events = None, resync = False))
+        XSLog('HotData event queue overflowed - pausing event watching')
+        self.wanted.wait()
+
+class HotRefreshWorker(threading.Thread):
+    # Refetches expired HotData entries on a dedicated session whilst HotData serves the stale values.
+    # Results are queued and applied by HotData on the UI thread, as for HotEventWatcher
+    def __init__(self, inHotData):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.hotData = inHotData
+        self.requests = Queue.Queue()
+        self.results = Queue.Queue()
+        self.session = None
+        self.stopped = False
+
+    def Stop(self):
+        self.stopped = True
+        self.requests.put(None) # Wake the thread
+    
+    def Request(self, inName, inRef, inGeneration):
+        # inGeneration is HotData's invalidation count when the request is made
+        self.requests.put(Struct(name = inName, ref = inRef, generation = inGeneration))
+    
+    def Get(self):
+        # Returns the next result without blocking, or None if there are none
+        try:
+            retVal = self.results.get_nowait()
+        except Queue.Empty:
+            retVal = None
+        return retVal
+    
+    def Session(self):
+        if self.session is None:
+            self.session = Auth.Inst().BorrowSession()
+        return self.session
+    
+    def GetBatch(self):
+        # Wait for one request, then take any others that are already queued
+        retVal = [ self.requests.get() ]
+        while True:
+            try:
+                retVal.append(self.requests.get_nowait())
+            except Queue.Empty:
+                break
+        return [ request for request in retVal if request is not None ]
+    
+    def run(self):
+        while not self.stopped:
+            batch = self.GetBatch()
+            
+            # Group requests for referenced objects by type, so that large groups can use a bulk fetch
+            byType = {}
+            singles = []
+            for request in batch:
+                if isinstance(request.ref, HotOpaqueRef) and request.ref.Type() in self.hotData.bulkFetchers:
+                    byType.setdefault(request.ref.Type(), []).append(request)
+                else:
+                    singles.append(request)
+            for refType, requests in byType.iteritems():
+                bulk = self.hotData.bulkFetchers[refType]
+                if len(requests) > HotData.BULK_THRESHOLD:
+                    self.Refresh(requests, lambda: self.BulkEntries(bulk))
+                elif len(requests) > 1:
+                    self.Refresh(requests, lambda: self.MultiCallEntries(bulk, requests))
+                else:
+                    singles += requests
+            
+            for request in singles:
+                fetcher = self.hotData.fetchers[request.name]
+                self.Refresh([request], lambda: { FirstValue(request.ref, request.name) : fetcher.fetcher(request.ref) })
+
+    def BulkEntries(self, inBulk):
+        records = inBulk.fetcher()
+        retVal = records.copy()
+        if inBulk.collection is not None:
+            retVal[inBulk.collection] = records
+        return retVal
+
+    def MultiCallEntries(self, inBulk, inRequests):
+        # Fetches each object with its own get_record call, but sends them all in one round trip
+        batch = MultiCall(self.Session())
+        results = [ (request.ref, batch.Queue(inBulk.recordCall, (request.ref.OpaqueRef(), ))) for request in inRequests ]
+        batch.Execute()
+        retVal = {}
+        for ref, result in results:
+            if result.failure is None: # Objects that have gone are left for the next foreground fetch to report
+                record = result.Value()
+                if inBulk.converter is not None:
+                    record = inBulk.converter(record)
+                retVal[ref] = record
+        return retVal
+
+    def Refresh(self, inRequests, inProc):
+        try:
+            entries = inProc()
+        except Exception, e:
+            XSLogError('HotData background refresh failed: ', e)
+            entries = {}
+            if Auth.Inst().IsSessionError(e):
+                self.session = Auth.Inst().DiscardSession(self.session) # Open another session next time
+        self.results.put(Struct(
+            done = [ FirstValue(request.ref, request.name) for request in inRequests ],
+            entries = entries,
+            generation = min([ request.generation for request in inRequests ]),
+            timestamp = time.time()))
 
 class HotData:
+    # When more than BULK_THRESHOLD objects of one type miss the cache within BULK_WINDOW_SECS,
+    # the whole class is fetched in one call rather than one get_record per object
+    BULK_THRESHOLD = 8
+    BULK_WINDOW_SECS = 5
+    SHARED_ENTRY_BYTES = 100
     instance = None
     
     def __init__(self):
         self.data = {}
         self.timestamps = {}
         self.session = None
+        self.eventWatcher = None
+        self.eventsLive = False
+        self.refMisses = {}
+        self.refreshWorker = None
+        self.refreshPending = {}
+        # The Invalidate call count, and the count at the last Invalidate of each entry and class, so that
+        # background refreshes requested before an Invalidate don't restore what it dropped
+        self.invalidateCount = 0
+        self.invalidatedRefs = {}
+        self.invalidatedNames = {}
+        self.dependencyStack = []
+        self.refBytes = 0 # Estimated size of the per-reference entries
+        self.useCount = 0
+        self.maxEntries = Config.Inst().HotDataMaxEntries()
+        self.maxBytes = Config.Inst().HotDataMaxBytes()
+        self.indexes = {}
+        self.domainChangeCount = 0
         self.InitialiseFetchers()
+        self.InitialiseBulkFetchers()
+        self.InitialiseEventClasses()
 
     @classmethod
     def Inst(cls):
@@ -120,32 +388,345 @@ class HotData:
     @classmethod
     def Reset(cls):
         if cls.instance is not None:
+            cls.instance.EventWatcherStop()
+            cls.instance.RefreshWorkerStop()
             del cls.instance
             cls.instance = None
     
     def DeleteCache(self):
-        self.data = {}
+        if self.eventsLive:
+            # Entries fed by the event stream are already up to date, so keep them
+            newData = {}
+            for key, value in self.data.iteritems():
+                if self.IsEventFed(key):
+                    newData[key] = value
+            self.data = newData
+        else:
+            self.data = {}
+        self.refBytes = 0
+        for key, value in self.data.iteritems():
+            if isinstance(key, HotOpaqueRef):
+                self.refBytes += value.size
         self.timestamps = {}
+        self.indexes = {}
+    
+    def Invalidate(self, *inChanges):
+        # Drops the cache entries affected by a change.  Each of inChanges is either a HotOpaqueRef, for a change
+        # to one object, or a fetcher name or HotOpaqueRef type (e.g. 'vm', 'metrics') for a change to any object
+        # of that class.  Derived entries are always dropped as they may depend on anything
+        if len(inChanges) == 0:
+            return
+        names = {}
+        refs = {}
+        self.invalidateCount += 1
+        for change in inChanges:
+            if isinstance(change, HotOpaqueRef):
+                refs[change] = True
+                self.invalidatedRefs[change] = self.invalidateCount
+                bulk = self.bulkFetchers.get(change.Type(), None)
+                if bulk is not None and bulk.collection is not None:
+                    # RefreshRef updates the collection, so an older fetch of the collection is out of date too
+                    self.invalidatedNames[bulk.collection] = self.invalidateCount
+            else:
+                names[change] = True
+                self.invalidatedNames[change] = self.invalidateCount
+
+        for key in self.data.keys():
+            if isinstance(key, HotOpaqueRef):
+                if key in refs or key.Type() in names or key.Type().split('::')[-1] in names:
+                    self.DropEntry(key)
+            elif key in names or (key in self.fetchers and self.fetchers[key].isDerived):
+                self.DropEntry(key)
+        
+        for ref in refs.keys():
+            self.RefreshRef(ref)
+    
+    def RefreshRef(self, inRef):
+        # Refetches one object within its cached collection, so that a change to one VM doesn't cause
+        # every VM to be refetched
+        bulk = self.bulkFetchers.get(inRef.Type(), None)
+        if bulk is None or bulk.collection is None:
+            return
+        cacheEntry = self.data.get(bulk.collection, None)
+        if cacheEntry is None:
+            return
+        # Copy rather than modify in place, as callers may be iterating over the old dictionary
+        collection = cacheEntry.value.copy()
+        try:
+            record = self.fetchers[bulk.collection].fetcher(inRef)
+            collection[inRef] = record
+            self.StoreEntry(inRef, Struct(timestamp = time.time(), value = record))
+        except XenAPI.Failure, e:
+            if e.details[0] != 'HANDLE_INVALID':
+                self.DropEntry(bulk.collection)
+                return
+            # The object has been destroyed
+            if inRef in collection:
+                del collection[inRef]
+        except Exception, e:
+            if Auth.Inst().IsSessionError(e):
+                self.session = Auth.Inst().DiscardSession(self.session)
+            self.DropEntry(bulk.collection)
+            return
+        self.StoreEntry(bulk.collection, Struct(timestamp = cacheEntry.timestamp, value = collection))
     
     def Fetch(self, inName, inRef):
+        # Record what a derived fetcher reads, so that its result can be reused until one of its sources changes
+        try:
+            retVal = self.FetchEntry(inName, inRef)
+        except:
+            if len(self.dependencyStack) > 0:
+                self.dependencyStack[-1].failed = True
+            raise
+        if len(self.dependencyStack) > 0:
+            self.dependencyStack[-1].dependencies.append( (inName, inRef, retVal) )
+        return retVal
+
+    def FetchEntry(self, inName, inRef):
+        self.PumpEvents()
+        self.PumpRefreshes()
         # Top-level object are cached by name, referenced objects by reference
         cacheName = FirstValue(inRef, inName)
         cacheEntry = self.data.get(cacheName, None)
         fetcher = self.fetchers[inName]
         timeNow = time.time()
         # If inRef is an array index, the result can't be cached
-        if not isinstance(inRef, types.IntType) and cacheEntry is not None and timeNow - cacheEntry.timestamp < fetcher.lifetimeSecs:
+        if inRef is None and fetcher.isDerived:
+            retVal = self.FetchDerived(inName, cacheEntry, fetcher, timeNow)
+        elif not isinstance(inRef, types.IntType) and self.IsFresh(cacheName, cacheEntry, fetcher.lifetimeSecs, timeNow):
+            self.Touch(cacheName, cacheEntry)
+            retVal = cacheEntry.value
+        elif not isinstance(inRef, types.IntType) and self.IsStaleUsable(cacheEntry, fetcher, timeNow):
+            # Serve the stale value now and refetch it in the background
+            self.RefreshInBackground(inName, inRef, cacheName)
+            self.Touch(cacheName, cacheEntry)
             retVal = cacheEntry.value
         else:
+            failure = None
             try:
-                retVal = fetcher.fetcher(inRef)
-                # Save in the cache
-                self.data[cacheName] = Struct(timestamp = timeNow, value = retVal)
-            except socket.timeout:
-                self.session = None
-                raise socket.timeout
+                try:
+                    if isinstance(inRef, HotOpaqueRef) and self.Prefetch(inRef, timeNow):
+                        retVal = self.data[cacheName].value
+                    else:
+                        retVal = fetcher.fetcher(inRef)
+                        # Save in the cache
+                        self.StoreEntry(cacheName, Struct(timestamp = timeNow, value = retVal))
+                except Exception, e:
+                    failure = e
+                    raise
+            finally:
+                if failure is not None and Auth.Inst().IsSessionError(failure):
+                    # Open another session next time
+                    self.session = Auth.Inst().DiscardSession(self.session)
+        if len(self.data) > self.maxEntries or self.refBytes > self.maxBytes:
+            self.EnforceBudget()
         return retVal    
     
+    def StoreEntry(self, inCacheName, inEntry, inShared = False):
+        # All cache writes come through here, so that the size and use of per-reference entries are tracked.
+        # inShared means that the value is also held by a collection, so evicting the entry wouldn't free it
+        if isinstance(inCacheName, HotOpaqueRef):
+            self.DropEntry(inCacheName)
+            if inShared:
+                inEntry.size = self.SHARED_ENTRY_BYTES
+            else:
+                inEntry.size = self.EstimateSize(inEntry.value)
+            self.refBytes += inEntry.size
+            self.Touch(inCacheName, inEntry)
+        self.data[inCacheName] = inEntry
+    
+    def DropEntry(self, inCacheName):
+        cacheEntry = self.data.pop(inCacheName, None)
+        if cacheEntry is not None and isinstance(inCacheName, HotOpaqueRef):
+            self.refBytes -= cacheEntry.size
+    
+    def Touch(self, inCacheName, inCacheEntry):
+        if isinstance(inCacheName, HotOpaqueRef):
+            self.useCount += 1
+            inCacheEntry.lastUsed = self.useCount
+    
+    def EnforceBudget(self):
+        # Evicts the least recently used per-reference entries once the cache exceeds Config.HotDataMaxEntries()
+        # or Config.HotDataMaxBytes().  Top-level collections are never evicted.  Evicting down to 90% of the
+        # budget means that the sort below happens rarely
+        entries = [ (entry.lastUsed, key) for key, entry in self.data.iteritems() if isinstance(key, HotOpaqueRef) ]
+        entries.sort()
+        for lastUsed, key in entries:
+            if len(self.data) <= self.maxEntries * 0.9 and self.refBytes <= self.maxBytes * 0.9:
+                break
+            self.DropEntry(key)
+    
+    @classmethod
+    def EstimateSize(cls, inValue):
+        # A rough estimate of the memory used by a cached value, counting strings and container slots.  Dictionary
+        # keys are interned, so aren't counted
+        if isinstance(inValue, types.DictType):
+            retVal = 140 + 24 * len(inValue)
+            for value in inValue.itervalues():
+                retVal += cls.EstimateSize(value)
+        elif isinstance(inValue, (types.ListType, types.TupleType)):
+            retVal = 72 + 8 * len(inValue)
+            for value in inValue:
+                retVal += cls.EstimateSize(value)
+        elif isinstance(inValue, types.StringTypes):
+            retVal = 40 + len(inValue)
+        else:
+            retVal = 24
+        return retVal
+    
+    def FetchDerived(self, inName, inCacheEntry, inFetcher, inTimeNow):
+        if inCacheEntry is not None and self.IsDerivedValid(inCacheEntry, inFetcher, inTimeNow):
+            retVal = inCacheEntry.value
+        else:
+            self.dependencyStack.append(Struct(dependencies = [], failed = False))
+            try:
+                retVal = inFetcher.fetcher(None)
+            finally:
+                frame = self.dependencyStack.pop()
+            if frame.failed:
+                # A source couldn't be fetched and the result used a default in its place, so fall back to the fetcher lifetime
+                dependencies = None
+            else:
+                dependencies = frame.dependencies
+            self.StoreEntry(inName, Struct(timestamp = inTimeNow, value = retVal, dependencies = dependencies))
+        return retVal
+
+    def IsDerivedValid(self, inCacheEntry, inFetcher, inTimeNow):
+        if inCacheEntry.dependencies is None:
+            retVal = inTimeNow - inCacheEntry.timestamp < inFetcher.lifetimeSecs
+        else:
+            retVal = True
+            for name, ref, value in inCacheEntry.dependencies:
+                # Fetch refreshes the source if needed.  Cache updates always replace values rather than
+                # modifying them, so an unchanged source returns the identical object
+                try:
+                    if self.Fetch(name, ref) is not value:
+                        retVal = False
+                except Exception:
+                    retVal = False
+                if not retVal:
+                    break
+        return retVal
+
+    def Index(self, inName, inField):
+        # Returns a dictionary mapping each value of inField to a list of HotOpaqueRefs to the objects in collection
+        # inName having that value.  Cache updates always replace the collection rather than modifying it, so the
+        # index is rebuilt on first use after the collection is refetched or changed by an event
+        collection = self.Fetch(inName, None)
+        index = self.indexes.get( (inName, inField), None)
+        if index is None or index.source is not collection:
+            values = {}
+            for ref, record in collection.iteritems():
+                if isinstance(record, types.DictType):
+                    try:
+                        values.setdefault(record.get(inField, None), []).append(ref)
+                    except TypeError:
+                        pass # Unhashable values, i.e. lists and dictionaries, aren't indexed
+            index = Struct(source = collection, values = values)
+            self.indexes[ (inName, inField) ] = index
+        return index.values
+    
+    def Query(self, inName, inFields):
+        # Returns a list of HotOpaqueRefs to the objects in collection inName whose fields match the dictionary inFields
+        if len(inFields) == 0:
+            retVal = self.Fetch(inName, None).keys()
+        else:
+            matches = [ self.Index(inName, field).get(value, []) for field, value in inFields.iteritems() ]
+            # Start from the smallest match, and filter it using the others
+            matches.sort(key = len)
+            retVal = matches[0][:]
+            for match in matches[1:]:
+                matchSet = set(match)
+                retVal = [ ref for ref in retVal if ref in matchSet ]
+        return retVal
+    
+    def IsFresh(self, inCacheName, inCacheEntry, inLifetimeSecs, inTimeNow):
+        if inCacheEntry is None:
+            retVal = False
+        else:
+            retVal = self.IsEventFed(inCacheName) or inTimeNow - inCacheEntry.timestamp < inLifetimeSecs
+        return retVal
+    
+    def IsStaleUsable(self, inCacheEntry, inFetcher, inTimeNow):
+        if inCacheEntry is None or inFetcher.isDerived:
+            # Derived entries are cheap to recompute from their (possibly stale) sources, so aren't refreshed in the background
+            retVal = False
+        else:
+            retVal = inTimeNow - inCacheEntry.timestamp < inFetcher.lifetimeSecs + Config.Inst().HotDataStaleSecs()
+        return retVal
+    
+    def RefreshInBackground(self, inName, inRef, inCacheName):
+        if inCacheName not in self.refreshPending:
+            if self.refreshWorker is None:
+                self.refreshWorker = HotRefreshWorker(self)
+                self.refreshWorker.start()
+            self.refreshPending[inCacheName] = True
+            self.refreshWorker.Request(inName, inRef, self.invalidateCount)
+
+    def RefreshWorkerStop(self):
+        if self.refreshWorker is not None:
+            self.refreshWorker.Stop()
+            self.refreshWorker = None
+        self.refreshPending = {}
+    
+    def PumpRefreshes(self):
+        if self.refreshWorker is not None:
+            while True:
+                result = self.refreshWorker.Get()
+                if result is None:
+                    break
+                for cacheName, value in result.entries.iteritems():
+                    # Events supersede background refreshes, and values fetched before an Invalidate are out of date
+                    if not self.IsEventFed(cacheName) and not self.IsInvalidatedSince(cacheName, result.generation):
+                        self.StoreEntry(cacheName, Struct(timestamp = result.timestamp, value = value))
+                for cacheName in result.done:
+                    if cacheName in self.refreshPending:
+                        del self.refreshPending[cacheName]
+            if len(self.refreshPending) == 0:
+                # No refreshes are outstanding, so no results can predate the invalidations recorded
+                self.invalidatedRefs = {}
+                self.invalidatedNames = {}
+    
+    def IsInvalidatedSince(self, inCacheName, inGeneration):
+        # Returns True if Invalidate has dropped inCacheName since the invalidation count was inGeneration
+        if isinstance(inCacheName, HotOpaqueRef):
+            refType = inCacheName.Type()
+            retVal = max(self.invalidatedRefs.get(inCacheName, 0), self.invalidatedNames.get(refType, 0),
+                self.invalidatedNames.get(refType.split('::')[-1], 0)) > inGeneration
+        else:
+            retVal = self.invalidatedNames.get(inCacheName, 0) > inGeneration
+        return retVal
+    
+    def Prefetch(self, inRef, inTimeNow):
+        # Fills the cache entry for inRef from a bulk fetch if possible.  Returns True if the entry was filled
+        bulk = self.bulkFetchers.get(inRef.Type(), None)
+        if bulk is None:
+            return False
+        
+        if bulk.collection is not None:
+            # If the whole collection is already cached, take the object from there
+            cacheEntry = self.data.get(bulk.collection, None)
+            if self.IsFresh(bulk.collection, cacheEntry, self.fetchers[bulk.collection].lifetimeSecs, inTimeNow):
+                if inRef in cacheEntry.value:
+                    self.StoreEntry(inRef, Struct(timestamp = cacheEntry.timestamp, value = cacheEntry.value[inRef]), True)
+                    return True
+        
+        misses = self.refMisses.get(inRef.Type(), None)
+        if misses is None or inTimeNow - misses.windowStart > self.BULK_WINDOW_SECS:
+            misses = Struct(windowStart = inTimeNow, count = 0)
+            self.refMisses[inRef.Type()] = misses
+        misses.count += 1
+        if misses.count <= self.BULK_THRESHOLD:
+            return False
+        
+        del self.refMisses[inRef.Type()]
+        records = bulk.fetcher()
+        for ref, record in records.iteritems():
+            self.StoreEntry(ref, Struct(timestamp = inTimeNow, value = record), bulk.collection is not None)
+        if bulk.collection is not None:
+            self.StoreEntry(bulk.collection, Struct(timestamp = inTimeNow, value = records))
+        return inRef in records
+    
     def FetchByRef(self, inRef):
         retVal = self.Fetch(inRef.Type(), inRef)
         return retVal
@@ -204,36 +785,188 @@ class HotData:
         if inName[0].isupper():
             # Don't expect elements to start with upper case, so probably an unknown method name
             raise Exception("Unknown method HotData."+inName)
-        return HotAccessor([inName], [None])
+        return HotAccessor(HotAccessor(), inName, None)
+
+    def AddEventClass(self, inClass, inName, inRefType, inConverter, inIsCollection):
+        self.eventClasses[inClass] = Struct(name = inName, refType = inRefType, converter = inConverter,
+            isCollection = inIsCollection)
+        self.eventRefTypes[inRefType] = True
+        if inIsCollection:
+            self.eventCollections[inName] = True
+    
+    def InitialiseEventClasses(self):
+        # Maps xapi event classes to the HotData entries that they keep up to date
+        self.eventClasses = {}
+        self.eventRefTypes = {}
+        self.eventCollections = {}
+        self.AddEventClass('host', 'host', 'host', HotData.ConvertHost, True)
+        self.AddEventClass('host_cpu', 'host_cpu', 'host_cpu', HotData.ConvertHostCPU, True)
+        self.AddEventClass('host_metrics', 'metrics', 'host::metrics', None, False)
+        self.AddEventClass('pbd', 'pbd', 'pbd', HotData.ConvertPBD, True)
+        self.AddEventClass('pool', 'pool', 'pool', HotData.ConvertPool, True)
+        self.AddEventClass('sr', 'sr', 'sr', HotData.ConvertSR, True)
+        self.AddEventClass('vm', 'vm', 'vm', HotData.ConvertVM, True)
+        self.AddEventClass('vm_guest_metrics', 'guest_metrics', 'guest_metrics', None, False)
+        self.AddEventClass('vm_metrics', 'metrics', 'vm::metrics', None, False)
+
+    def DomainChangeCount(self):
+        # Incremented by events that may change which VMs are control domains, and when events may have been missed,
+        # so that callers can cache the results of searching for DOM-0
+        return self.domainChangeCount
+    
+    def EventWatcherStart(self):
+        if self.eventWatcher is None:
+            self.eventWatcher = HotEventWatcher(self.eventClasses.keys())
+            self.eventWatcher.start()
+    
+    def EventWatcherStop(self):
+        if self.eventWatcher is not None:
+            self.eventWatcher.Stop()
+            self.eventWatcher = None
+        self.eventsLive = False
+    
+    def IsEventFed(self, inCacheName):
+        # While events are arriving, entries for the classes in self.eventClasses never expire
+        if not self.eventsLive:
+            retVal = False
+        elif isinstance(inCacheName, HotOpaqueRef):
+            retVal = inCacheName.Type() in self.eventRefTypes
+        else:
+            retVal = inCacheName in self.eventCollections
+        return retVal
+    
+    def PumpEvents(self):
+        if self.eventWatcher is not None:
+            while True:
+                batch = self.eventWatcher.Get()
+                if batch is None:
+                    break
+                if batch.events is None:
+                    # The watcher has lost its connection, so fall back to cache lifetimes
+                    self.eventsLive = False
+                    self.domainChangeCount += 1 # Events may have been missed
+                else:
+                    self.ApplyEvents(batch.events, batch.resync)
+    
+    def ApplyEvents(self, inEvents, inResync):
+        timeNow = time.time()
+        collections = {}
+        if inResync:
+            # This batch contains every object, so discard entries for objects that may have gone
+            for key in self.data.keys():
+                if isinstance(key, HotOpaqueRef) and key.Type() in self.eventRefTypes:
+                    self.DropEntry(key)
+            for name in self.eventCollections.keys():
+                collections[name] = {}
+
+        for event in inEvents:
+            eventClass = self.eventClasses.get(event['class'].lower(), None)
+            if eventClass is None:
+                continue
+            hotRef = HotOpaqueRef(event['ref'], eventClass.refType)
+            if eventClass.name == 'vm' and (event['operation'] != 'mod' or event['snapshot'].get('is_control_domain', False)):
+                self.domainChangeCount += 1
+            if event['operation'] == 'del':
+                record = None
+                self.DropEntry(hotRef)
+            else:
+                record = event['snapshot']
+                if eventClass.converter is not None:
+                    record = eventClass.converter(record)
+                self.StoreEntry(hotRef, Struct(timestamp = timeNow, value = record),
+                    eventClass.isCollection and eventClass.name in self.data)
+            
+            if eventClass.isCollection:
+                collection = collections.get(eventClass.name, None)
+                if collection is None:
+                    cacheEntry = self.data.get(eventClass.name, None)
+                    if cacheEntry is None:
+                        continue # Collection not cached, so it will be fetched in full when needed
+                    # Copy rather than modify in place, as callers may be iterating over the old dictionary
+                    collection = cacheEntry.value.copy()
+                    collections[eventClass.name] = collection
+                if record is None:
+                    if hotRef in collection:
+                        del collection[hotRef]
+                else:
+                    collection[hotRef] = record
+        
+        for name, collection in collections.iteritems():
+            self.StoreEntry(name, Struct(timestamp = timeNow, value = collection))
+        
+        if inResync:
+            self.eventsLive = True
+            self.domainChangeCount += 1
+            XSLog('HotData is now updated by xapi events')
+
+    def AddFetcher(self, inKey, inFetcher, inLifetimeSecs, inIsDerived = False):
+        # inIsDerived fetchers read other HotData entries, so mustn't run on the background refresh thread.  Their
+        # results are reused until an entry they read changes, and inLifetimeSecs only applies if a read failed
+        lifetimeSecs = Config.Inst().HotDataLifetimes().get(inKey, inLifetimeSecs)
+        self.fetchers[inKey] = Struct( fetcher = inFetcher, lifetimeSecs = lifetimeSecs, isDerived = inIsDerived ) 
 
-    def AddFetcher(self, inKey, inFetcher, inLifetimeSecs):
-        self.fetchers[inKey] = Struct( fetcher = inFetcher, lifetimeSecs = inLifetimeSecs ) 
+    def AddBulkFetcher(self, inRefType, inFetcher, inCollection, inRecordCall, inConverter = None):
+        # inCollection is the name of the fetcher that caches the whole class, if there is one.  inRecordCall is
+        # the xapi get_record call for one object, which the background refresh uses to fetch several objects in
+        # one system.multicall, and inConverter converts the records that it returns
+        self.bulkFetchers[inRefType] = Struct( fetcher = inFetcher, collection = inCollection,
+            recordCall = inRecordCall, converter = inConverter )
+
+    def InitialiseBulkFetchers(self):
+        self.bulkFetchers = {}
+        self.AddBulkFetcher('guest_metrics', self.FetchAllVMGuestMetrics, None, 'VM_guest_metrics.get_record')
+        self.AddBulkFetcher('host', lambda: self.FetchHost(None), 'host', 'host.get_record', HotData.ConvertHost)
+        self.AddBulkFetcher('host::metrics', self.FetchAllHostMetrics, None, 'host_metrics.get_record')
+        self.AddBulkFetcher('host_cpu', lambda: self.FetchHostCPUs(None), 'host_cpu', 'host_cpu.get_record', HotData.ConvertHostCPU)
+        self.AddBulkFetcher('pbd', lambda: self.FetchPBD(None), 'pbd', 'PBD.get_record', HotData.ConvertPBD)
+        self.AddBulkFetcher('pool', lambda: self.FetchPool(None), 'pool', 'pool.get_record', HotData.ConvertPool)
+        self.AddBulkFetcher('sr', lambda: self.FetchSR(None), 'sr', 'SR.get_record', HotData.ConvertSR)
+        self.AddBulkFetcher('vm', lambda: self.FetchVM(None), 'vm', 'VM.get_record', HotData.ConvertVM)
+        self.AddBulkFetcher('vm::metrics', self.FetchAllVMMetrics, None, 'VM_metrics.get_record')
 
     def InitialiseFetchers(self):
         self.fetchers = {}
         self.AddFetcher('guest_metrics', self.FetchVMGuestMetrics, 5)
-        self.AddFetcher('guest_vm', self.FetchGuestVM, 5)
-        self.AddFetcher('guest_vm_derived', self.FetchGuestVMDerived, 5)
+        self.AddFetcher('guest_vm', self.FetchGuestVM, 5, True)
+        self.AddFetcher('guest_vm_derived', self.FetchGuestVMDerived, 5, True)
         self.AddFetcher('host', self.FetchHost, 5)
-        self.AddFetcher('host_cpu', self.FetchHostCPUs, 5)
-        self.AddFetcher('local_host', self.FetchLocalHost, 5) # Derived
+        self.AddFetcher('host_cpu', self.FetchHostCPUs, 300) # Changes only when hosts join or leave the pool
+        self.AddFetcher('local_host', self.FetchLocalHost, 5, True)
         self.AddFetcher('local_host_ref', self.FetchLocalHostRef, 60) # Derived
-        self.AddFetcher('local_pool', self.FetchLocalPool, 5) # Derived
+        self.AddFetcher('local_pool', self.FetchLocalPool, 30) # Derived
         self.AddFetcher('metrics', self.FetchMetrics, 5)
         self.AddFetcher('pbd', self.FetchPBD, 5)
-        self.AddFetcher('pool', self.FetchPool, 5)
+        self.AddFetcher('pool', self.FetchPool, 30)
         self.AddFetcher('sr', self.FetchSR, 5)
-        self.AddFetcher('visible_sr', self.FetchVisibleSR, 5) # Derived
+        self.AddFetcher('visible_sr', self.FetchVisibleSR, 5, True)
         self.AddFetcher('vm', self.FetchVM, 5)
     
     def FetchVMGuestMetrics(self, inOpaqueRef):
         retVal = self.Session().xenapi.VM_guest_metrics.get_record(inOpaqueRef.OpaqueRef())
         return retVal    
 
+    def FetchAllVMGuestMetrics(self):
+        retVal = {}
+        for key, value in self.Session().xenapi.VM_guest_metrics.get_all_records().iteritems():
+            retVal[HotOpaqueRef(key, 'guest_metrics')] = value
+        return retVal
+
+    def FetchAllVMMetrics(self):
+        retVal = {}
+        for key, value in self.Session().xenapi.VM_metrics.get_all_records().iteritems():
+            retVal[HotOpaqueRef(key, 'vm::metrics')] = value
+        return retVal
+
+    def FetchAllHostMetrics(self):
+        retVal = {}
+        for key, value in self.Session().xenapi.host_metrics.get_all_records().iteritems():
+            retVal[HotOpaqueRef(key, 'host::metrics')] = value
+        return retVal
+
     def FetchGuestVM(self, inOpaqueRef):
         if inOpaqueRef is not None:
             # Don't need to filter, so can use the standard VM fetch
-            retVal = self.FetchVM(inOpaqueRef)
+            retVal = self.Fetch('vm', inOpaqueRef)
         else:
             retVal = {}
             for key, value in self.vm().iteritems():
@@ -241,20 +974,21 @@ class HotData:
                     retVal[key] = value
         return retVal
 
+    @classmethod
+    def ConvertHostCPU(cls, inCPU):
+        return cls.ConvertOpaqueRefs(inCPU,
+            host='host'
+            )
+
     def FetchHostCPUs(self, inOpaqueRef):
-        def LocalConverter(inCPU):
-            return HotData.ConvertOpaqueRefs(inCPU,
-                host='host'
-                )
-            
         if inOpaqueRef is not None:
             cpu = self.Session().xenapi.host_cpu.get_record(inOpaqueRef.OpaqueRef())
-            retVal = LocalConverter(cpu)
+            retVal = HotData.ConvertHostCPU(cpu)
         else:    
             cpus = self.Session().xenapi.host_cpu.get_all_records()
             retVal = {}
             for key, cpu in cpus.iteritems():
-                cpu = LocalConverter(cpu)
+                cpu = HotData.ConvertHostCPU(cpu)
                 retVal[HotOpaqueRef(key, 'host_cpu')] = cpu
         return retVal
 
@@ -284,7 +1018,10 @@ class HotData:
         return retVal
 
     def FetchLocalHost(self, inOpaqueRef):
-        retVal = self.FetchHost(self.FetchLocalHostRef(inOpaqueRef))
+        if inOpaqueRef is not None:
+            raise Exception("Request for local host must not be passed an OpaqueRef")
+        # Go through the cache so that the host record can be kept up to date by events
+        retVal = self.Fetch('host', self.Fetch('local_host_ref', None))
         return retVal
         
     def FetchLocalHostRef(self, inOpaqueRef):
@@ -298,37 +1035,39 @@ class HotData:
         if inOpaqueRef is not None:
             raise Exception("Request for local pool must not be passed an OpaqueRef")
 
-        pools = self.Session().xenapi.pool.get_all()
+        # One call for the whole record, rather than pool.get_all followed by pool.get_record
+        pools = self.Session().xenapi.pool.get_all_records()
         if len(pools) != 1:
-            raise Exception("Unexpected number of pools "+str(pools))
+            raise Exception("Unexpected number of pools "+str(pools.keys()))
 
-        retVal = self.FetchPool(HotOpaqueRef(pools[0], 'pool'))
+        retVal = HotData.ConvertPool(pools.values()[0])
         return retVal
         
-    def FetchHost(self, inOpaqueRef):
-        def LocalConverter(inHost):
-            return HotData.ConvertOpaqueRefs(inHost,
-                crash_dump_sr = 'sr',
-                consoles = 'console',
-                current_operations = 'task',
-                host_CPUs = 'host_cpu',
-                metrics = 'host::metrics',
-                PBDs = 'pbd',
-                PIFs='pif',
-                resident_VMs = 'vm',
-                suspend_image_sr = 'sr',
-                VBDs = 'vbd',
-                VIFs = 'vif'
-                )
+    @classmethod
+    def ConvertHost(cls, inHost):
+        return cls.ConvertOpaqueRefs(inHost,
+            crash_dump_sr = 'sr',
+            consoles = 'console',
+            current_operations = 'task',
+            host_CPUs = 'host_cpu',
+            metrics = 'host::metrics',
+            PBDs = 'pbd',
+            PIFs='pif',
+            resident_VMs = 'vm',
+            suspend_image_sr = 'sr',
+            VBDs = 'vbd',
+            VIFs = 'vif'
+            )
         
+    def FetchHost(self, inOpaqueRef):
         if inOpaqueRef is not None:
             host = self.Session().xenapi.host.get_record(inOpaqueRef.OpaqueRef())
-            retVal = LocalConverter(host)
+            retVal = HotData.ConvertHost(host)
         else:
             hosts = self.Session().xenapi.host.get_all_records()
             retVal = {}
             for key, host in hosts.iteritems():
-                host = LocalConverter(host)
+                host = HotData.ConvertHost(host)
                 retVal[HotOpaqueRef(key, 'host')] = host
         return retVal
         
@@ -343,104 +1082,104 @@ class HotData:
             raise Exception("Unknown metrics type '"+inOpaqueRef.Type()+"'")
         return retVal
 
-    def FetchPBD(self, inOpaqueRef):
-        def LocalConverter(inPBD):
-            return HotData.ConvertOpaqueRefs(inPBD,
-                host='host',
-                SR='sr'
-            )
+    @classmethod
+    def ConvertPBD(cls, inPBD):
+        return cls.ConvertOpaqueRefs(inPBD,
+            host='host',
+            SR='sr'
+        )
                 
+    def FetchPBD(self, inOpaqueRef):
         if inOpaqueRef is not None:
             pbd = self.Session().xenapi.PBD.get_record(inOpaqueRef.OpaqueRef())
-            retVal = LocalConverter(pbd)
+            retVal = HotData.ConvertPBD(pbd)
         else:
             pbds = self.Session().xenapi.PBD.get_all_records()
             retVal = {}
             for key, pbd in pbds.iteritems():
-                pbd = LocalConverter(pbd)
+                pbd = HotData.ConvertPBD(pbd)
                 retVal[HotOpaqueRef(key, 'pbd')] = pbd
         return retVal
 
-    def FetchPool(self, inOpaqueRef):
-        def LocalConverter(inPool):
-            return HotData.ConvertOpaqueRefs(inPool,
-                crash_dump_SR='sr',
-                default_SR='sr',
-                master='host',
-                suspend_image_SR='sr'
-            )
+    @classmethod
+    def ConvertPool(cls, inPool):
+        return cls.ConvertOpaqueRefs(inPool,
+            crash_dump_SR='sr',
+            default_SR='sr',
+            master='host',
+            suspend_image_SR='sr'
+        )
                 
+    def FetchPool(self, inOpaqueRef):
         if inOpaqueRef is not None:
             pool = self.Session().xenapi.pool.get_record(inOpaqueRef.OpaqueRef())
-            retVal = LocalConverter(pool)
+            retVal = HotData.ConvertPool(pool)
         else:
             pools = self.Session().xenapi.pool.get_all_records()
             retVal = {}
             for key, pool in pools.iteritems():
-                pool = LocalConverter(pool)
+                pool = HotData.ConvertPool(pool)
                 retVal[HotOpaqueRef(key, 'pool')] = pool
         return retVal
         
-    def FetchSR(self, inOpaqueRef):
-        def LocalConverter(inSR):
-            return HotData.ConvertOpaqueRefs(inSR,
-                current_operations = 'task',
-                PBDs = 'pbd',
-                VDIs = 'vdi')
+    @classmethod
+    def ConvertSR(cls, inSR):
+        return cls.ConvertOpaqueRefs(inSR,
+            current_operations = 'task',
+            PBDs = 'pbd',
+            VDIs = 'vdi')
                 
+    def FetchSR(self, inOpaqueRef):
         if inOpaqueRef is not None:
             sr = self.Session().xenapi.SR.get_record(inOpaqueRef.OpaqueRef())
-            retVal = LocalConverter(sr)
+            retVal = HotData.ConvertSR(sr)
         else:
             srs = self.Session().xenapi.SR.get_all_records()
             retVal = {}
             for key, sr in srs.iteritems():
-                sr = LocalConverter(sr)
+                sr = HotData.ConvertSR(sr)
                 retVal[HotOpaqueRef(key, 'sr')] = sr
         return retVal
     
     def FetchVisibleSR(self, inOpaqueRef):
         if inOpaqueRef is not None:
             # Make sr[ref] and visible_sr[ref] do the same thing, i.e. don't check the the SR is visible
-            retVal = self.FetchSR(inOpaqueRef) 
+            retVal = self.Fetch('sr', inOpaqueRef)
         else:
             retVal = {}
-            for sr in HotAccessor().sr: # Iterates through HotAccessors to SRs
-                visible = False
-                if len(sr.PBDs()) == 0:
-                    visible = True # This is a detached SR so list it as visible
-                else:
-                    for pbd in sr.PBDs(): # Iterates through HotOpaqueRefs to PBDs
-                        if pbd in HotAccessor().local_host.PBDs(): # host.PBDs() is a list of HotOpaqueRefs
-                            visible = True
-                if visible:
-                    retVal[sr.HotOpaqueRef()] = sr
+            localPBDs = set(self.local_host.PBDs([])) # Set of HotOpaqueRefs to the local host's PBDs
+            for srRef, sr in self.sr({}).iteritems():
+                pbds = sr.get('PBDs', [])
+                # Detached SRs (with no PBDs) are listed as visible
+                if len(pbds) == 0 or len(localPBDs.intersection(pbds)) > 0:
+                    retVal[srRef] = HotAccessor().sr[srRef]
                     
         return retVal
 
-    def FetchVM(self, inOpaqueRef):
-        def LocalConverter(inVM):
-            return HotData.ConvertOpaqueRefs(inVM,
-                affinity='host',
-                consoles='console',
-                current_operations = 'task',
-                guest_metrics='guest_metrics',
-                metrics='vm::metrics',
-                PIFs='pif',
-                resident_on='host',
-                suspend_VDI='vdi',
-                snapshot_of='snapshot',
-                VBDs = 'vbd',
-                VIFs = 'vif')
+    @classmethod
+    def ConvertVM(cls, inVM):
+        return cls.ConvertOpaqueRefs(inVM,
+            affinity='host',
+            consoles='console',
+            current_operations = 'task',
+            guest_metrics='guest_metrics',
+            metrics='vm::metrics',
+            PIFs='pif',
+            resident_on='host',
+            suspend_VDI='vdi',
+            snapshot_of='snapshot',
+            VBDs = 'vbd',
+            VIFs = 'vif')
                 
+    def FetchVM(self, inOpaqueRef):
         if inOpaqueRef is not None:
             vm = self.Session().xenapi.VM.get_record(inOpaqueRef.OpaqueRef())
-            retVal = LocalConverter(vm)
+            retVal = HotData.ConvertVM(vm)
         else:
             vms = self.Session().xenapi.VM.get_all_records()
             retVal = {}
             for key, vm in vms.iteritems():
-                vm = LocalConverter(vm)
+                vm = HotData.ConvertVM(vm)
                 retVal[HotOpaqueRef(key, 'vm')] = vm
         return retVal
 
@@ -448,11 +1187,16 @@ class HotData:
     def ConvertOpaqueRefs(cls, *inArgs, **inKeywords):
         if len(inArgs) != 1:
             raise Exception('ConvertOpaqueRef requires a dictionary object as the first argument')
-        ioObj = inArgs[0]
+        # Rebuild the dictionary with interned keys, as xapi sends a separate copy of every field name in every record
+        ioObj = {}
+        for key, value in inArgs[0].iteritems():
+            if type(key) is str:
+                key = intern(key)
+            ioObj[key] = value
         for keyword, value in inKeywords.iteritems():
             obj = ioObj.get(keyword, None)
             if obj is not None:
-                if isinstance(obj, str):
+                if isinstance(obj, str): # Includes HotOpaqueRefs, which are re-tagged with this type
                     ioObj[keyword] = HotOpaqueRef(obj, value)
                 elif isinstance(obj, types.ListType):
                     ioObj[keyword] = [ HotOpaqueRef(x, value) for x in obj ]
@@ -464,24 +1208,27 @@ class HotData:
                     
         if Auth.Inst().IsTestMode(): # Tell the caller what they've missed, when in test mode
             for key,value in ioObj.iteritems():
-                if isinstance(value, str) and value.startswith('OpaqueRef'):
+                if isinstance(value, str) and not isinstance(value, HotOpaqueRef) and value.startswith('OpaqueRef'):
                     print('Missed OpaqueRef string in HotData item: '+key)
                 elif isinstance(value, types.ListType):
                     for item in value:
-                        if isinstance(item, str) and item.startswith('OpaqueRef'):
+                        if isinstance(item, str) and not isinstance(item, HotOpaqueRef) and item.startswith('OpaqueRef'):
                             print('Missed OpaqueRef List in HotData item: '+key)
                             break
                 elif isinstance(value, types.DictType):
                     for item in value.keys():
-                        if isinstance(item, str) and item.startswith('OpaqueRef'):
+                        if isinstance(item, str) and not isinstance(item, HotOpaqueRef) and item.startswith('OpaqueRef'):
                             print('Missed OpaqueRef Dict in HotData item: '+key)
                             break
 
         return ioObj
 
     def Session(self):
+        if isinstance(threading.currentThread(), HotRefreshWorker):
+            # Sessions aren't thread-safe, so the background refresh thread has its own
+            return threading.currentThread().Session()
         if self.session is None:
-            self.session = Auth.Inst().OpenSession()
+            self.session = Auth.Inst().BorrowSession()
         return self.session
         
     def Dump(self):
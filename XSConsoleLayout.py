@@ -32,6 +32,7 @@ class Layout:
         self.exitCommand = None # Not layout, but keep with layout for convenience
         self.exitBanner = None # Not layout, but keep with layout for convenience
         self.exitCommandIsExec = True # Not layout, but keep with layout for convenience
+        self.unknownChanges = False
 
     def AssertScreenSize(self):
         consoleXSize = self.parent.XSize()
@@ -89,12 +90,17 @@ class Layout:
     def PopDialogue(self):
         if len(self.dialogues) < 1:
             raise Exception("Stack underflow in PopDialogue")
+        changes = self.TopDialogue().HotDataChanges()
         self.TopDialogue().Destroy()
         self.dialogues.pop()
-        if len(self.dialogues) == 1:
-            # When the display returns to the root screen, it's possible that data has changed, so
-            # delete the HotData cache to force a refetch
+        if changes is None:
+            # The dialogue doesn't declare what it may have changed, so refetch everything on return to the root screen
+            self.unknownChanges = True
+        else:
+            HotData.Inst().Invalidate(*changes)
+        if len(self.dialogues) == 1 and self.unknownChanges:
             HotData.Inst().DeleteCache()
+            self.unknownChanges = False
         self.TopDialogue().UpdateFields()
         self.Refresh()
     
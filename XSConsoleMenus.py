@@ -153,6 +153,107 @@ class Menu:
                         break
         
         return handled
+
+class FilterMenu(Menu):
+    # A menu that the user narrows down by typing.  inSearch(text) returns the handles of the choices that
+    # match the text typed so far, and by default matches choice names that start with it
+    def __init__(self, inOwner = None, inParent = None, inTitle = None, inChoiceDefs = None, inSearch = None):
+        Menu.__init__(self, inOwner, inParent, inTitle, inChoiceDefs)
+        self.allChoiceDefs = self.choiceDefs
+        self.search = inSearch
+        self.filterText = ''
+    
+    def FilterText(self): return self.filterText
+    
+    def FilterTextSet(self, inText):
+        # Returns False, leaving the filter unchanged, if nothing matches inText
+        if inText == '':
+            choiceDefs = self.allChoiceDefs
+        elif self.search is None:
+            choiceDefs = [ choiceDef for choiceDef in self.allChoiceDefs if choiceDef.name.lower().startswith(inText.lower()) ]
+        else:
+            matches = set(self.search(inText))
+            choiceDefs = [ choiceDef for choiceDef in self.allChoiceDefs if choiceDef.handle in matches ]
+        
+        if len(choiceDefs) == 0:
+            retVal = False
+        else:
+            self.filterText = inText
+            self.choiceDefs = choiceDefs
+            self.choiceIndex = 0
+            retVal = True
+        return retVal
+    
+    def HandleKey(self, inKey):
+        if inKey == 'KEY_BACKSPACE':
+            handled = self.FilterTextSet(self.filterText[:-1])
+        elif len(inKey) == 1 and inKey[0] >= ' ':
+            self.FilterTextSet(self.filterText + inKey)
+            handled = True # Ignore keys that match nothing
+        else:
+            handled = Menu.HandleKey(self, inKey)
+        return handled
+
+class MultiSelectMenu(Menu):
+    # A menu where <Space> selects and deselects choices, which are marked with SELECTED_MARK.  Whilst any
+    # choices are selected, <Enter> calls inMultiAction with the list of their handles instead of the current
+    # choice's onAction.  Selections persist in copies of the menu, e.g. those made by menu regenerators
+    SELECTED_MARK = ' *'
+    
+    def __init__(self, inOwner = None, inParent = None, inTitle = None, inChoiceDefs = None, inMultiAction = None):
+        Menu.__init__(self, inOwner, inParent, inTitle, inChoiceDefs)
+        self.multiAction = inMultiAction
+        self.selected = set()
+    
+    def Selected(self):
+        # Returns the handles of the selected choices, in menu order
+        return [ choiceDef.handle for choiceDef in self.choiceDefs if choiceDef.handle in self.selected ]
+    
+    def SelectedSet(self, inHandles):
+        # Handles without a choice in the menu are dropped
+        handles = set(inHandles)
+        self.selected = set([ choiceDef.handle for choiceDef in self.choiceDefs if choiceDef.handle in handles ])
+        for choiceDef in self.choiceDefs:
+            self.MarkChoice(choiceDef)
+    
+    def AddChoiceDef(self, inChoiceDef, inPriority = None):
+        inChoiceDef.unmarkedName = inChoiceDef.name
+        self.MarkChoice(inChoiceDef)
+        Menu.AddChoiceDef(self, inChoiceDef, inPriority)
+    
+    def MarkChoice(self, inChoiceDef):
+        if inChoiceDef.handle is not None and inChoiceDef.handle in self.selected:
+            inChoiceDef.name = inChoiceDef.unmarkedName + self.SELECTED_MARK
+        else:
+            inChoiceDef.name = inChoiceDef.unmarkedName
+    
+    def ToggleSelection(self):
+        choiceDef = self.CurrentChoiceDef()
+        if choiceDef.handle is None:
+            retVal = False # Not selectable, e.g. a '<No Virtual Machines Present>' choice
+        else:
+            if choiceDef.handle in self.selected:
+                self.selected.remove(choiceDef.handle)
+            else:
+                self.selected.add(choiceDef.handle)
+            self.MarkChoice(choiceDef)
+            retVal = True
+        return retVal
+    
+    def HandleSelect(self):
+        if len(self.selected) > 0 and self.multiAction is not None:
+            self.multiAction(self.Selected())
+            retVal = True
+        else:
+            retVal = Menu.HandleSelect(self)
+        return retVal
+    
+    def HandleKey(self, inKey):
+        if inKey == ' ':
+            handled = self.ToggleSelection()
+        else:
+            handled = Menu.HandleKey(self, inKey)
+        return handled
         
 class RootMenu:
     def __init__(self, inDialogue):
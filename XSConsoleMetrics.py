@@ -14,16 +14,149 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 import XenAPI
-import urllib
-import xml.dom.minidom
+import array, urllib
+import xml.parsers.expat
 
 from XSConsoleAuth import *
 from XSConsoleBases import *
 from XSConsoleLang import *
 
+class RRDUpdatesParser:
+    # Streaming parser for the XML from rrd_updates.  Keeps the legend and only the most recent row of values,
+    # rather than building a DOM of the whole document, which is large for a host with many VMs.  If inKeepRows
+    # is True, self.rows also holds every row as (time, list of values)
+    READ_BYTES = 65536
+    
+    def __init__(self, inKeepRows = False):
+        self.entries = []
+        self.end = None
+        if inKeepRows:
+            self.rows = []
+        else:
+            self.rows = None
+        self.mostRecentTime = None
+        self.mostRecentValues = []
+        self.rowTime = None
+        self.rowValues = None
+        self.text = None # The text of the current element, if it's one we want
+        self.parser = xml.parsers.expat.ParserCreate()
+        self.parser.buffer_text = True
+        self.parser.StartElementHandler = self.HandleStart
+        self.parser.EndElementHandler = self.HandleEnd
+        self.parser.CharacterDataHandler = self.HandleText
+    
+    def HandleStart(self, inName, inAttrs):
+        if inName in ('entry', 'v', 't', 'end'):
+            self.text = []
+        elif inName == 'row':
+            self.rowTime = None
+            self.rowValues = []
+    
+    def HandleText(self, inText):
+        if self.text is not None:
+            self.text.append(inText)
+    
+    def HandleEnd(self, inName):
+        if self.text is not None:
+            text = ''.join(self.text).strip()
+            self.text = None
+            if inName == 'v':
+                self.rowValues.append(str(text))
+            elif inName == 'entry':
+                self.entries.append(str(text))
+            elif inName == 't':
+                self.rowTime = int(text)
+            elif inName == 'end' and self.rowValues is None: # <end> in <meta>, not in a row
+                self.end = int(text)
+        elif inName == 'row':
+            if self.mostRecentTime is None or self.mostRecentTime < self.rowTime:
+                self.mostRecentTime = self.rowTime
+                self.mostRecentValues = self.rowValues
+            if self.rows is not None:
+                self.rows.append( (self.rowTime, self.rowValues) )
+            self.rowValues = None
+    
+    def Feed(self, inText):
+        self.parser.Parse(inText, False)
+    
+    def ParseFile(self, inFile):
+        while True:
+            text = inFile.read(self.READ_BYTES)
+            if text == '':
+                break
+            self.parser.Parse(text, False)
+        return self.Result()
+    
+    def Result(self):
+        # Returns a dictionary of legend entry to value for the most recent row
+        self.parser.Parse('', True)
+        retVal = {}
+        for entry, value in zip(self.entries, self.mostRecentValues):
+            retVal[entry] = value
+        return retVal
+
+class MetricHistory:
+    # Ring buffers of recent metric values.  There is one ring of row times, and each series (keyed by
+    # (object type, uuid, metric name)) has a ring of values in the same slots, with NaN where it has no value
+    NAN = float('nan')
+    
+    def __init__(self, inRows, inStepSecs):
+        self.rows = inRows
+        self.stepSecs = inStepSecs
+        self.times = array.array('l', [0]) * inRows
+        self.next = 0 # The slot for the next row
+        self.count = 0
+        self.series = {}
+        self.lastSeen = {}
+    
+    def LastTime(self):
+        if self.count == 0:
+            retVal = None
+        else:
+            retVal = self.times[(self.next - 1) % self.rows]
+        return retVal
+    
+    def AddRow(self, inTime, inValues):
+        # inValues is a dictionary of series key to value for the row at inTime
+        slot = self.next
+        self.times[slot] = inTime
+        for key, series in self.series.items():
+            if key not in inValues:
+                if inTime - self.lastSeen[key] > self.rows * self.stepSecs:
+                    # Every value has gone from the ring, e.g. because the VM has been shut down
+                    del self.series[key]
+                    del self.lastSeen[key]
+                else:
+                    series[slot] = self.NAN
+        for key, value in inValues.iteritems():
+            series = self.series.get(key, None)
+            if series is None:
+                series = array.array('f', [self.NAN]) * self.rows # Single precision to halve the memory
+                self.series[key] = series
+            series[slot] = value
+            self.lastSeen[key] = inTime
+        self.next = (slot + 1) % self.rows
+        self.count = min(self.count + 1, self.rows)
+    
+    def Series(self, inKey):
+        # Returns the values of the series as a list of (time, value), oldest first
+        retVal = []
+        series = self.series.get(inKey, None)
+        if series is not None:
+            for i in range(self.next - self.count, self.next):
+                slot = i % self.rows
+                value = series[slot]
+                if value == value: # i.e. not NaN
+                    retVal.append( (self.times[slot], value) )
+        return retVal
+
 class HotMetrics:
     LIFETIME_SECS = 5 # The lifetime of objects in the cache before they are refetched
-    SNAPSHOT_SECS = 10 # The number of seconds of metric data to fetch
+    SNAPSHOT_SECS = 10 # The number of seconds of metric data to fetch when there's no previous fetch to follow on from
+    CATCHUP_SECS = 600 # rrd_updates keeps this long at its finest resolution, so don't follow on from an older fetch
+    HISTORY_STEP_SECS = 5 # The finest resolution of rrd_updates
+    HISTORY_ROWS = 720 # One hour of history
+    CPU_RE = re.compile(r'cpu[0-9]+')
     __instance = None
     
     @classmethod
@@ -33,121 +166,153 @@ class HotMetrics:
         return cls.__instance
         
     def __init__(self):
-        self.data = {}
+        self.data = {} # Metric values, keyed by (object type, uuid) then metric name
+        self.summaries = {} # The results of LocalHostMetrics and VMMetrics, keyed by (object type, uuid)
         self.timestamp = None
         self.thisHostUUID = None
+        self.lastEnd = None # The end time of the last rrd_updates reply
+        self.legend = []
+        self.legendKeys = []
+        self.history = MetricHistory(self.HISTORY_ROWS, self.HISTORY_STEP_SECS)
         
     def LocalHostMetrics(self):
         self.UpdateMetrics()
-        retVal = {}
-        hostPrefix = r'AVERAGE:host:'+self.thisHostUUID
-        cpuRE = re.compile(hostPrefix+r':cpu[0-9]+')
-        cpuValues = [ float(v) for k, v in self.data.iteritems() if cpuRE.match(k) ]
-        retVal['numcpus'] = len(cpuValues)
-        if len(cpuValues) == 0:
-            retVal['cpuusage'] = None
-        else:
-            retVal['cpuusage'] = sum(cpuValues) / len(cpuValues)
-        
-        try:
-            retVal['memory_total'] = float(self.data[hostPrefix +':memory_total_kib']) * 1024.0
-        except Exception, e:
-            retVal['memory_total'] = None
-        
-        try:
-            retVal['memory_free'] = float(self.data[hostPrefix +':memory_free_kib']) * 1024.0
-        except Exception, e:
-            retVal['memory_free'] = None
-
-        return retVal
+        return self.Summary('host', self.thisHostUUID)
 
     def VMMetrics(self, inUUID):
         self.UpdateMetrics()
-        retVal = {}
-        vmPrefix = r'AVERAGE:vm:' + inUUID
+        return self.Summary('vm', inUUID)
 
-        cpuRE = re.compile(vmPrefix+r':cpu[0-9]+')
-        cpuValues = [ float(v) for k, v in self.data.iteritems() if cpuRE.match(k) ]
+    def Metric(self, inType, inUUID, inName, inDefault = None):
+        # Returns the value of one metric as a float, e.g. Metric('vm', uuid, 'memory')
+        self.UpdateMetrics()
+        return self.data.get( (inType, inUUID), {}).get(inName, inDefault)
+
+    def History(self, inType, inUUID, inName):
+        # Returns the values of one metric over the last hour as a list of (time, value), oldest first.  The history
+        # is only complete for periods when the metrics were being read
+        self.UpdateMetrics()
+        return self.history.Series( (inType, inUUID, inName) )
+
+    def Summary(self, inType, inUUID):
+        retVal = self.summaries.get( (inType, inUUID), None)
+        if retVal is None:
+            retVal = self.Summarise(inType, {})
+        else:
+            retVal = retVal.copy() # Callers may change the dictionary
+        return retVal
+
+    def Summarise(self, inType, inMetrics):
+        retVal = {}
+        cpuValues = [ v for k, v in inMetrics.iteritems() if self.CPU_RE.match(k) ]
         retVal['numcpus'] = len(cpuValues)
         if len(cpuValues) == 0:
             retVal['cpuusage'] = None
         else:
             retVal['cpuusage'] = sum(cpuValues) / len(cpuValues)
-
-        try:
-            retVal['memory_total'] = float(self.data[vmPrefix +':memory']) # Not scaled
-        except Exception, e:
-            retVal['memory_total'] = None
         
-        try:
-            retVal['memory_free'] = float(self.data[vmPrefix +':memory_internal_free']) * 1024.0 # Value is in kiB
-        except Exception, e:
-            retVal['memory_free'] = None
-
+        if inType == 'host':
+            memoryTotal = inMetrics.get('memory_total_kib', None)
+            if memoryTotal is not None:
+                memoryTotal *= 1024.0
+            memoryFree = inMetrics.get('memory_free_kib', None)
+        else:
+            memoryTotal = inMetrics.get('memory', None) # Not scaled
+            memoryFree = inMetrics.get('memory_internal_free', None)
+        if memoryFree is not None:
+            memoryFree *= 1024.0 # Value is in kiB
+        retVal['memory_total'] = memoryTotal
+        retVal['memory_free'] = memoryFree
         return retVal
 
+    def AddRows(self, inEntries, inRows):
+        # Adds the rows from rrd_updates that are newer than those we have to the history, and indexes the newest
+        if inEntries != self.legend:
+            # Convert legend entries, e.g. 'AVERAGE:vm:<uuid>:memory', to keys, e.g. ('vm', <uuid>, 'memory')
+            self.legend = inEntries
+            self.legendKeys = []
+            for entry in inEntries:
+                fields = entry.split(':', 3)
+                if len(fields) == 4 and fields[0] == 'AVERAGE':
+                    self.legendKeys.append(tuple(fields[1:]))
+                else:
+                    self.legendKeys.append(None)
+        
+        newestRow = None
+        inRows.sort()
+        for rowTime, values in inRows:
+            lastTime = self.history.LastTime()
+            if lastTime is None or rowTime > lastTime:
+                row = {}
+                for key, value in zip(self.legendKeys, values):
+                    if key is not None:
+                        try:
+                            row[key] = float(value)
+                        except ValueError:
+                            pass # Ignore unparseable values
+                self.history.AddRow(rowTime, row)
+                newestRow = row
+        
+        if newestRow is not None:
+            self.IndexRow(newestRow)
+    
+    def IndexRow(self, inRow):
+        # Converts a row of values keyed by (object type, uuid, metric name) into self.data, and summarises each
+        # object once here rather than on every call to VMMetrics
+        data = {}
+        for key, value in inRow.iteritems():
+            objectKey = key[:2]
+            metrics = data.get(objectKey, None)
+            if metrics is None:
+                metrics = {}
+                data[objectKey] = metrics
+            metrics[key[2]] = value
+        
+        summaries = {}
+        for key, metrics in data.iteritems():
+            summaries[key] = self.Summarise(key[0], metrics)
+        self.data = data
+        self.summaries = summaries
+
     def UpdateMetrics(self):
         timeNow = time.time()
         if self.timestamp is None or abs(timeNow - self.timestamp) > self.LIFETIME_SECS:
-            # Refetch host metrics
-            self.data = self.FetchData()
+            # Fetch the rows since the last fetch
+            parser = self.FetchData()
+            self.AddRows(parser.entries, parser.rows)
+            if parser.end is not None:
+                self.lastEnd = parser.end
             self.timestamp = timeNow
         
     def ParseXML(self, inXML):
-        xmlDoc = xml.dom.minidom.parseString(inXML)
-        metaNode = xmlDoc.getElementsByTagName('meta')[0]
-        valuesNode = xmlDoc.getElementsByTagName('data')[0]
-        
-        meta = Struct()
-        # Values comments out below are currently not required
-        # for name in ('start', 'end', 'rows', 'columns'):
-        #     setattr(meta, name, int(metaNode.getElementsByTagName(name)[0].firstChild.nodeValue.strip()))
-        legendNode = metaNode.getElementsByTagName('legend')[0]
-        meta.entries = [ str(entry.firstChild.nodeValue.strip()) for entry in legendNode.getElementsByTagName('entry') ]
-        
-        # Find the most recent row in the values
-        mostRecentRow = None
-        mostRecentTime = None
-        for row in valuesNode.getElementsByTagName('row'):
-            rowTime = int(row.getElementsByTagName('t')[0].firstChild.nodeValue.strip())
-            if mostRecentTime is None or mostRecentTime < rowTime:
-                mostRecentRow = row
-                mostRecentTime = rowTime
-                
-        # Decode the row contents
-        if mostRecentRow is None:
-            values = []
-        else:
-            values = [ str(v.firstChild.nodeValue.strip()) for v in mostRecentRow.getElementsByTagName('v') ]
-    
-        retVal = {}
-        for entry, value in zip(meta.entries, values):
-            retVal[entry] = value
-            
-        return retVal
+        parser = RRDUpdatesParser()
+        parser.Feed(inXML)
+        return parser.Result()
 
     def FetchData(self):
-        retVal = None
-        session = Auth.Inst().OpenSession()
-        try:
-            sessionID = session._session
-            if self.thisHostUUID is None:
-                # Make use of this session to get the local host UUID
-                opaqueRef = session.xenapi.session.get_this_host(sessionID)
-                self.thisHostUUID = session.xenapi.host.get_uuid(opaqueRef)
-                
-            httpRequest = 'https://localhost/rrd_updates?session_id=%s&start=%s&host=true' % (sessionID, int(time.time()) - self.SNAPSHOT_SECS)
+        return Auth.Inst().PooledCall(self.FetchDataWithSession)
+    
+    def FetchDataWithSession(self, inSession):
+        sessionID = inSession._session
+        if self.thisHostUUID is None:
+            # Make use of this session to get the local host UUID
+            opaqueRef = inSession.xenapi.session.get_this_host(sessionID)
+            self.thisHostUUID = inSession.xenapi.host.get_uuid(opaqueRef)
             
-            socket = urllib.URLopener().open(httpRequest)
-            try:
-                content = socket.read()
-            finally:
-                socket.close()
-            retVal = self.ParseXML(content)    
-                
+        timeNow = int(time.time())
+        if self.lastEnd is None or timeNow - self.lastEnd > self.CATCHUP_SECS:
+            start = timeNow - self.SNAPSHOT_SECS
+        else:
+            start = self.lastEnd # Only rows that we haven't seen
+        httpRequest = 'https://localhost/rrd_updates?session_id=%s&start=%s&host=true' % (sessionID, start)
+        
+        socket = urllib.URLopener().open(httpRequest)
+        try:
+            # Parse as the document arrives, without holding all of it in memory
+            retVal = RRDUpdatesParser(True)
+            retVal.ParseFile(socket)
         finally:
-            if session is not None:
-                Auth.Inst().CloseSession(session)
+            socket.close()
         
         return retVal
         
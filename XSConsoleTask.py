@@ -18,36 +18,94 @@ from XSConsoleBases import *
 from XSConsoleHotData import *
 
 class TaskEntry:
-    def __init__(self, inHotOpaqueRef, inSession):
+    # The status of a task comes from the record that TaskWatcher publishes, so the UI polling a task costs
+    # no xapi calls.  Other calls for the task use sessions borrowed from the pool
+    STALE_SECS = 15 # Fetch the record directly if the watcher hasn't published for this long
+    WAIT_MIN_SECS = 0.5 # The first interval between checks in Wait, doubling up to WAIT_MAX_SECS
+    WAIT_MAX_SECS = 5.0
+    RECORD_FIELDS = ['status', 'progress', 'error_info', 'allowed_operations', 'created', 'finished']
+    
+    def __init__(self, inHotOpaqueRef):
         self.hotOpaqueRef = inHotOpaqueRef
-        self.session = inSession
         self.startTime = time.time()
         self.completed = False
         self.creationTime = None
         self.finishTime = None
+        self.hotDataChanges = []
+        self.record = None
+        self.recordTime = None
+        self.done = threading.Event() # Set when a record showing completion is published
+        self.lock = threading.Lock() # Guards completed, as any thread polling the task can see it finish
         
     def Completed(self):
         return self.completed
-        
+    
+    def HotDataChangesAdd(self, *inChanges):
+        # Classes and HotOpaqueRefs to invalidate in HotData when this task completes.  See HotData.Invalidate
+        self.hotDataChanges += inChanges
+    
+    def Publish(self, inRecord):
+        # Called from the TaskWatcher thread.  Replaces the record in one assignment so that readers see either
+        # the old record or the new one
+        record = {}
+        for name in self.RECORD_FIELDS:
+            record[name] = inRecord.get(name, None)
+        self.record = record
+        self.recordTime = time.time()
+        if not FirstValue(record['status'], 'pending').startswith('pending'):
+            self.done.set()
+    
+    def PublishDestroyed(self):
+        # The task has been destroyed, e.g. by another client, before we saw it complete
+        self.Publish({
+            'status' : 'failure',
+            'progress' : 1.0,
+            'error_info' : ['HANDLE_INVALID', 'task', self.hotOpaqueRef.OpaqueRef()],
+            'allowed_operations' : []
+        })
+    
+    def Record(self):
+        # Returns the latest published record, or None if the watcher has yet to publish it
+        if time.time() - FirstValue(self.recordTime, self.startTime) > self.STALE_SECS:
+            # The watcher has fallen behind or failed, so fetch the record ourselves
+            try:
+                self.Publish(Auth.Inst().PooledCall(lambda session: session.xenapi.task.get_record(self.hotOpaqueRef.OpaqueRef())))
+            except XenAPI.Failure, e:
+                if e.details[0] != 'HANDLE_INVALID':
+                    raise
+                self.PublishDestroyed()
+        return self.record
+    
     def HandleCompletion(self, inStatus):
-        if self.completed:
-            raise Exception('TaskEntry.HandleCompletion called more than once')
-        self.completed = True
-        self.completionStatus = inStatus
+        # Called by whichever thread first sees the task finish, so later calls, including those from threads
+        # that raced with it, have no effect
+        self.lock.acquire()
+        try:
+            if self.completed:
+                return
+            record = self.record
+            if record.get('created', None) is not None:
+                self.creationTime = TimeUtils.DateTimeToSecs(record['created'])
+            if record.get('finished', None) is not None:
+                self.finishTime = TimeUtils.DateTimeToSecs(record['finished'])
+            if inStatus.startswith('failure'):
+                self.errorInfo = record['error_info']
+            self.completionStatus = inStatus
+            self.completed = True # Set last so that other threads see the fields above once Completed is True
+        finally:
+            self.lock.release()
         
-        self.creationTime = TimeUtils.DateTimeToSecs(self.session.xenapi.task.get_created(self.hotOpaqueRef.OpaqueRef()))
-        self.finishTime = TimeUtils.DateTimeToSecs(self.session.xenapi.task.get_finished(self.hotOpaqueRef.OpaqueRef()))
-        if inStatus.startswith('failure'):
-            self.errorInfo = self.session.xenapi.task.get_error_info(self.hotOpaqueRef.OpaqueRef())
-
-        Auth.Inst().CloseSession(self.session)
-        self.session = None
+        Task.Inst().InvalidateHotData(self.hotDataChanges)
 
     def Status(self):
         if self.Completed():
             status = self.completionStatus
         else:
-            status = self.session.xenapi.task.get_status(self.hotOpaqueRef.OpaqueRef())
+            record = self.Record()
+            if record is None:
+                status = 'pending'
+            else:
+                status = record['status']
             if not status.startswith('pending'):
                 self.HandleCompletion(status)
         return status
@@ -56,15 +114,15 @@ class TaskEntry:
         if self.Completed():
             result = self.completionStatus
         else:
-            result= self.session.xenapi.task.get_status(self.hotOpaqueRef.OpaqueRef())
+            result = self.Status()
         return HotOpaqueRef(result, 'any')
     
     def CanCancel(self):
         if self.Completed():
             retVal = False
         else:
-            allowedOps = self.session.xenapi.task.get_allowed_operations(self.hotOpaqueRef.OpaqueRef())    
-            retVal = ('cancel' in allowedOps)
+            record = self.Record()
+            retVal = (record is not None and 'cancel' in record['allowed_operations'])
             
         return retVal
         
@@ -100,7 +158,11 @@ class TaskEntry:
         if self.Completed():
             retVal = 1.0
         else:
-            retVal = self.session.xenapi.task.get_progress(self.hotOpaqueRef.OpaqueRef())
+            record = self.Record()
+            if record is None:
+                retVal = 0.0
+            else:
+                retVal = record['progress']
         return retVal
     
     def DurationSecs(self):
@@ -110,15 +172,200 @@ class TaskEntry:
             retVal = time.time() - self.startTime
         return retVal
     
+    def Wait(self, inTimeoutSecs = None):
+        # Blocks until the task completes, and returns its status.  Sleeps until the watcher publishes the
+        # completion, checking the record with a growing interval in case the watcher has stalled.  Raises an
+        # exception if the task is still pending after inTimeoutSecs
+        if inTimeoutSecs is None:
+            deadline = None
+        else:
+            deadline = time.time() + inTimeoutSecs
+        intervalSecs = self.WAIT_MIN_SECS
+        while self.IsPending():
+            if deadline is not None:
+                remainingSecs = deadline - time.time()
+                if remainingSecs <= 0:
+                    raise Exception(Lang('Timed out waiting for the operation to complete'))
+                intervalSecs = min(intervalSecs, remainingSecs)
+            self.done.wait(intervalSecs)
+            intervalSecs = min(intervalSecs * 2, self.WAIT_MAX_SECS)
+        return self.Status()
+    
+    def WhenComplete(self, inCallback, inTimeoutSecs = None):
+        # Calls inCallback(self) on the UI thread, from Task.PumpCompletions, when the task completes or after
+        # inTimeoutSecs.  In the second case IsPending() is still True
+        Task.Inst().AddCompletionCallback(self, inCallback, inTimeoutSecs)
+    
     def Cancel(self):
         if not self.completed:
-            self.session.xenapi.task.cancel(self.hotOpaqueRef.OpaqueRef())
+            Auth.Inst().PooledCall(lambda session: session.xenapi.task.cancel(self.hotOpaqueRef.OpaqueRef()))
+
+class TaskWatcher(threading.Thread):
+    # Follows every outstanding task on one session, and publishes their records to the TaskEntry objects, so
+    # that xapi load doesn't grow with the number of tasks or progress dialogues.  Uses event.from on the task
+    # class, or one task.get_all_records per tick if xapi doesn't support event.from.  The thread waits for
+    # work whilst there are no outstanding tasks
+    EVENT_TIMEOUT_SECS = 1.0 # Also the delay before a new task's first record is published
+    POLL_SECS = 1.0
+    RETRY_SECS = 5
+    
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.condition = threading.Condition()
+        self.entries = {} # OpaqueRef : TaskEntry, for tasks not yet seen to complete
+        self.newEntries = []
+        self.useEvents = True
+        self.stopped = False
     
+    def Stop(self):
+        self.condition.acquire()
+        try:
+            self.stopped = True
+            self.condition.notify()
+        finally:
+            self.condition.release()
+    
+    def Add(self, inTaskEntry):
+        self.condition.acquire()
+        try:
+            self.newEntries.append(inTaskEntry)
+            self.condition.notify()
+        finally:
+            self.condition.release()
+    
+    def Remove(self, inTaskEntry):
+        self.condition.acquire()
+        try:
+            ref = inTaskEntry.hotOpaqueRef.OpaqueRef()
+            if ref in self.entries:
+                del self.entries[ref]
+            if inTaskEntry in self.newEntries:
+                self.newEntries.remove(inTaskEntry)
+        finally:
+            self.condition.release()
+    
+    def TakeNewEntries(self, inWait):
+        # Returns the entries added since the last call.  If inWait is True and there are no tasks, waits for one
+        self.condition.acquire()
+        try:
+            while inWait and not self.stopped and len(self.entries) == 0 and len(self.newEntries) == 0:
+                self.condition.wait()
+            retVal = self.newEntries
+            self.newEntries = []
+            for entry in retVal:
+                self.entries[entry.hotOpaqueRef.OpaqueRef()] = entry
+        finally:
+            self.condition.release()
+        return retVal
+    
+    def Publish(self, inRef, inRecord):
+        self.condition.acquire()
+        try:
+            entry = self.entries.get(inRef, None)
+            if entry is not None and inRecord is not None and not inRecord.get('status', 'pending').startswith('pending'):
+                del self.entries[inRef] # Complete, so stop following it
+        finally:
+            self.condition.release()
+        if entry is not None:
+            if inRecord is None:
+                entry.PublishDestroyed()
+            else:
+                entry.Publish(inRecord)
+    
+    def PublishNewEntries(self, inSession, inEntries):
+        # Records for new tasks may predate the event token, so fetch them directly, in one round trip
+        batch = MultiCall(inSession)
+        results = [ (entry, batch.xenapi.task.get_record(entry.hotOpaqueRef.OpaqueRef())) for entry in inEntries ]
+        batch.Execute()
+        for entry, result in results:
+            try:
+                record = result.Value()
+            except XenAPI.Failure, e:
+                if e.details[0] != 'HANDLE_INVALID':
+                    raise
+                record = None
+            self.Publish(entry.hotOpaqueRef.OpaqueRef(), record)
+    
+    def Touch(self):
+        # Records not republished this round are unchanged, so still current
+        timeNow = time.time()
+        self.condition.acquire()
+        try:
+            for entry in self.entries.values():
+                entry.recordTime = timeNow
+        finally:
+            self.condition.release()
+    
+    def IsIdle(self):
+        self.condition.acquire()
+        try:
+            retVal = (len(self.entries) == 0 and len(self.newEntries) == 0)
+        finally:
+            self.condition.release()
+        return retVal
+    
+    def Watch(self, inSession):
+        # Returns when there are no outstanding tasks
+        token = '' # The first batch is a snapshot of every task
+        while not self.stopped:
+            newEntries = self.TakeNewEntries(False)
+            if len(newEntries) > 0:
+                self.PublishNewEntries(inSession, newEntries)
+            if self.IsIdle():
+                break
+            if self.useEvents:
+                # event.from is called via getattr because 'from' is a python keyword
+                result = getattr(inSession.xenapi.event, 'from')(['task'], token, self.EVENT_TIMEOUT_SECS)
+                token = result['token']
+                for event in result['events']:
+                    if event['operation'] == 'del':
+                        self.Publish(event['ref'], None)
+                    elif 'snapshot' in event:
+                        self.Publish(event['ref'], event['snapshot'])
+            else:
+                records = inSession.xenapi.task.get_all_records()
+                for ref in self.entries.keys():
+                    self.Publish(ref, records.get(ref, None))
+                time.sleep(self.POLL_SECS)
+            self.Touch()
+    
+    def run(self):
+        while not self.stopped:
+            self.TakeNewEntries(True)
+            session = None
+            failure = None
+            try:
+                try:
+                    session = Auth.Inst().BorrowSession()
+                    if session is None:
+                        raise Exception('Could not open a session for task watching')
+                    self.Watch(session)
+                except XenAPI.Failure, e:
+                    failure = e
+                    if e.details[0] == 'MESSAGE_METHOD_UNKNOWN' and self.useEvents:
+                        XSLog('xapi does not support event.from - TaskWatcher will poll')
+                        self.useEvents = False
+                    else:
+                        XSLogError('TaskWatcher failed: ', e)
+                        time.sleep(self.RETRY_SECS)
+                except Exception, e:
+                    failure = e
+                    XSLogError('TaskWatcher failed: ', e)
+                    time.sleep(self.RETRY_SECS)
+            finally:
+                # The session is shared through the pool, so is only discarded if it has failed.  Logging it out
+                # otherwise would end the tasks that other users of the pool have started on it
+                session = Auth.Inst().ReleaseSession(session, failure)
+
 class Task:
     instance = None
     def __init__(self):
         self.taskList = {}
-        self.syncSession = None
+        self.watcher = None
+        self.completionCallbacks = []
+        self.invalidations = [] # HotData changes from tasks that completed on other threads
+        self.invalidationLock = threading.Lock()
             
     @classmethod
     def Inst(cls):
@@ -126,23 +373,24 @@ class Task:
             cls.instance = Task()
         return cls.instance
     
+    def Watcher(self):
+        if self.watcher is None:
+            self.watcher = TaskWatcher()
+            self.watcher.start()
+        return self.watcher
+    
     def Create(self, inProc):
-        session = None
-        try:
-            session = Auth.Inst().NewSession()
-            taskRef = inProc(session)
-        except:
-            if session is not None:
-                Auth.Inst().CloseSession(session)
-            raise
+        # Sessions from the pool aren't logged out, so xapi won't destroy the task with the session that created it
+        taskRef = Auth.Inst().PooledCall(inProc)
         
         hotTaskRef = HotOpaqueRef(taskRef, 'task')
-        taskEntry = TaskEntry(hotTaskRef, session)
+        taskEntry = TaskEntry(hotTaskRef)
         self.taskList[hotTaskRef] = taskEntry
+        self.Watcher().Add(taskEntry)
         return taskEntry
 
     def GarbageCollect(self):
-        # This may be expensive as it must fetch status from xapi for each incomplete task
+        # Status comes from the records published by the watcher, so this is cheap
         deleteKeys = []
         for key, value in self.taskList.iteritems():
             # Forget tasks that have of duration of greater than one day
@@ -151,15 +399,59 @@ class Task:
                 deleteKeys.append(key)
         
         for key in deleteKeys:
+            self.Watcher().Remove(self.taskList[key])
             del self.taskList[key]
 
-    def SyncSession(self):
-        if self.syncSession is None:
-            self.syncSession = Auth.Inst().NewSession()
-        return self.syncSession
+    def AddCompletionCallback(self, inTaskEntry, inCallback, inTimeoutSecs):
+        if inTimeoutSecs is None:
+            deadline = None
+        else:
+            deadline = time.time() + inTimeoutSecs
+        self.completionCallbacks.append(Struct(task = inTaskEntry, callback = inCallback, deadline = deadline))
+    
+    def InvalidateHotData(self, inChanges):
+        # HotData is only touched on the UI thread, so changes from tasks seen to complete on other threads
+        # wait for PumpCompletions
+        if threading.currentThread().getName() == 'MainThread':
+            HotData.Inst().Invalidate(*inChanges)
+        elif len(inChanges) > 0:
+            self.invalidationLock.acquire()
+            try:
+                self.invalidations += inChanges
+            finally:
+                self.invalidationLock.release()
+    
+    def PumpCompletions(self):
+        # Called from the main loop to apply the HotData changes and run the callbacks of completed tasks.
+        # Returns True if anything was done
+        retVal = False
+        self.invalidationLock.acquire()
+        try:
+            invalidations = self.invalidations
+            self.invalidations = []
+        finally:
+            self.invalidationLock.release()
+        if len(invalidations) > 0:
+            retVal = True
+            HotData.Inst().Invalidate(*invalidations)
+        
+        callbacks = self.completionCallbacks
+        self.completionCallbacks = []
+        timeNow = time.time()
+        for completion in callbacks:
+            try:
+                if completion.task.IsPending() and (completion.deadline is None or timeNow < completion.deadline):
+                    self.completionCallbacks.append(completion) # Keep waiting
+                else:
+                    retVal = True
+                    completion.callback(completion.task)
+            except Exception, e:
+                retVal = True
+                XSLogError('Task completion callback failed: ', e)
+        return retVal
 
     def SyncOperation(self, inProc):
-        retVal = inProc(self.SyncSession())
+        retVal = Auth.Inst().PooledCall(inProc)
         return retVal
 
     @classmethod
@@ -169,5 +461,3 @@ class Task:
     @classmethod
     def Sync(cls, inProc):
         return cls.Inst().SyncOperation(inProc)
-
-    
@@ -76,6 +76,9 @@ class App:
         
         RemoteTest.Inst().SetApp(self)
         
+        if Config.Inst().HotDataUseEvents():
+            HotData.Inst().EventWatcherStart()
+        
         # Reinstate keymap
         if State.Inst().Keymap() is not None:
             Data.Inst().KeymapSet(State.Inst().Keymap())
@@ -190,8 +193,7 @@ class App:
             self.layout.TopDialogue().Reset()
             self.needsRefresh = True
         elif inKeypress == 'KEY_F(5)':
-            Data.Inst().Update()
-            self.layout.UpdateRootFields()
+            Data.Inst().StartUpdate() # MainLoop redraws when it completes
             self.needsRefresh = True
         elif inKeypress == '\014': # Ctrl-L
             Layout.Inst().Clear() # Full redraw
@@ -264,9 +266,18 @@ class App:
                 # If the host doesn't yet have an IP, reload data occasionally to pick up DHCP updates
                 if secondsNow - lastDataUpdateSeconds >= 4:
                     lastDataUpdateSeconds = secondsNow
-                    data.Update()
-                    self.layout.UpdateRootFields()
-                    self.needsRefresh = True
+                    data.StartUpdate()
+            
+            if data.FinishUpdate():
+                self.layout.UpdateRootFields()
+                self.needsRefresh = True
+            
+            # Apply queued xapi events even if the current screen doesn't read HotData
+            HotData.Inst().PumpEvents()
+            
+            if Task.Inst().PumpCompletions():
+                self.layout.UpdateRootFields()
+                self.needsRefresh = True
     
             if secondsNow - lastScreenUpdateSeconds >= 4:
                 lastScreenUpdateSeconds = secondsNow
@@ -294,6 +305,8 @@ class App:
             version = data.host.software_version.product_version_text_short(data.host.software_version.platform_version(''))
 
             bannerStr = brand + ' ' + version
+            if data.IsUpdating():
+                bannerStr += ' ' + Lang('(refreshing)')
             
             if Auth.Inst().IsAuthenticated():
                 hostStr = Auth.Inst().LoggedInUsername()+'@'+data.host.hostname('')
@@ -13,7 +13,7 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
-import re, signal, string, subprocess, time, types
+import os, re, signal, string, subprocess, threading, time, types, Queue
 from pprint import pprint
 
 from XSConsoleBases import *
@@ -129,6 +129,109 @@ class ShellPipe:
         return self
 
 
+# Using ThreadPool:
+# results = ThreadPool([session1, session2]).Run([ (function, arg1, arg2), (function, arg3, arg4) ])
+# calls function(session, arg1, arg2) and function(session, arg3, arg4) on up to two threads, passing each thread's
+# own resource (here a xapi session, as sessions aren't thread-safe) as the first argument.  results holds the
+# return values in the order of the jobs.  If any job raises an exception, Run raises the first one after all
+# jobs have finished
+
+class ThreadPool:
+    def __init__(self, inResources):
+        if len(inResources) == 0:
+            raise Exception("ThreadPool needs at least one resource")
+        self.resources = inResources
+        
+    def Run(self, inJobs):
+        self.jobs = Queue.Queue()
+        for i in range(len(inJobs)):
+            self.jobs.put( (i, inJobs[i]) )
+        self.results = [ None ] * len(inJobs)
+        self.exceptions = [ None ] * len(inJobs)
+
+        numThreads = min(len(self.resources), len(inJobs))
+        if numThreads <= 1:
+            # Not worth a thread
+            self.RunJobs(self.resources[0])
+        else:
+            threads = [ threading.Thread(target = self.RunJobs, args = (resource, )) for resource in self.resources[:numThreads] ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        
+        for exception in self.exceptions:
+            if exception is not None:
+                raise exception
+        return self.results
+    
+    def RunJobs(self, inResource):
+        while True:
+            try:
+                i, job = self.jobs.get_nowait()
+            except Queue.Empty:
+                break
+            try:
+                self.results[i] = job[0](inResource, *job[1:])
+            except Exception, e:
+                self.exceptions[i] = e
+
+# Using ShellProbe:
+# probe = ShellProbe(10, ["/sbin/lspci", "-m"], ["/usr/bin/lspci", "-m"]) # Starts immediately in the background
+#   ... start other probes or do something else ...
+# lines = probe.Lines() # Waits for the result
+# runs each command in turn until one succeeds, and Lines() returns the stdout of the successful command, or None if
+# none succeeded.  Commands still running inTimeoutSecs after the probe was created are killed.  IsDone() checks
+# for a result without waiting
+
+class ShellProbe(threading.Thread):
+    def __init__(self, inTimeoutSecs, *inCommands):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.commands = inCommands
+        self.deadline = time.time() + inTimeoutSecs
+        self.pipe = None
+        self.lines = None
+        self.timedOut = False
+        self.start()
+    
+    def run(self):
+        for command in self.commands:
+            if self.timedOut:
+                break
+            try:
+                self.pipe = ShellPipe(command)
+                if self.pipe.CallRC() == 0:
+                    self.lines = self.pipe.Stdout()
+                    break
+            except Exception, e:
+                pass # Command not present - try the next one
+    
+    def Kill(self):
+        self.timedOut = True
+        pipe = self.pipe
+        if pipe is not None:
+            try:
+                os.kill(pipe.pipe.pid, signal.SIGKILL)
+            except OSError:
+                pass # Already exited
+        self.join()
+    
+    def IsDone(self):
+        if self.isAlive() and time.time() >= self.deadline:
+            self.Kill()
+        return not self.isAlive()
+    
+    def Lines(self):
+        self.join(max(0, self.deadline - time.time()))
+        if self.isAlive():
+            self.Kill()
+        if self.timedOut:
+            retVal = None # Partial output is unreliable
+        else:
+            retVal = self.lines
+        return retVal
+
 class ShellUtils:
     @classmethod
     def MakeSafeParam(cls, inParam):
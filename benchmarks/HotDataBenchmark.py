@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2007-2009 Citrix Systems Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# Measures the memory used by HotData for a large pool, and the time taken by the HotAccessor
+# lookups that a frame of the UI makes.  No xapi connection is needed, as the records are synthetic.
+# Run from the xsconsole directory:  python benchmarks/HotDataBenchmark.py [number of VMs]
+
+import os, sys, time, xmlrpclib
+
+sys.path.insert(0, os.path.join(os.path.dirname(sys.argv[0]), '..'))
+
+from XSConsoleHotData import *
+
+def ResidentKB():
+    retVal = 0
+    for line in open('/proc/self/status'):
+        if line.startswith('VmRSS:'):
+            retVal = int(line.split()[1])
+    return retVal
+
+def MakeVMRecord(inIndex):
+    return {
+        'uuid' : '%08x-0000-0000-0000-000000000000' % inIndex,
+        'name_label' : 'VM %d' % inIndex,
+        'name_description' : '',
+        'power_state' : ('Running', 'Halted')[inIndex % 2],
+        'is_a_template' : False,
+        'is_control_domain' : False,
+        'resident_on' : 'OpaqueRef:host-%d' % (inIndex % 16),
+        'affinity' : 'OpaqueRef:host-%d' % (inIndex % 16),
+        'metrics' : 'OpaqueRef:vm-metrics-%d' % inIndex,
+        'guest_metrics' : 'OpaqueRef:vm-guest-metrics-%d' % inIndex,
+        'consoles' : [ 'OpaqueRef:console-%d' % inIndex ],
+        'VBDs' : [ 'OpaqueRef:vbd-%d-%d' % (inIndex, i) for i in range(2) ],
+        'VIFs' : [ 'OpaqueRef:vif-%d-0' % inIndex ],
+        'current_operations' : {},
+        'allowed_operations' : [ 'start', 'clean_shutdown', 'clean_reboot', 'suspend' ],
+        'memory_static_max' : '1073741824',
+        'VCPUs_max' : '2',
+        'other_config' : { 'mac_seed' : '%08x' % inIndex },
+        'domid' : str(inIndex + 1),
+        'snapshot_of' : 'OpaqueRef:NULL',
+        'suspend_VDI' : 'OpaqueRef:NULL',
+    }
+
+def Main(inNumVMs):
+    records = {}
+    for i in range(inNumVMs):
+        records['OpaqueRef:vm-%d' % i] = MakeVMRecord(i)
+    message = xmlrpclib.dumps((records,))
+    records = None
+    
+    startKB = ResidentKB()
+    # Unmarshal as xapi's get_all_records would, so that every key and reference is a separate string
+    records = xmlrpclib.loads(message)[0][0]
+    message = None
+    startTime = time.time()
+    collection = {}
+    for opaqueRef, record in records.iteritems():
+        collection[HotOpaqueRef(opaqueRef, 'vm')] = HotData.ConvertVM(record)
+    records = None
+    convertSecs = time.time() - startTime
+    memoryKB = ResidentKB() - startKB
+
+    def FetchVM(inOpaqueRef):
+        if inOpaqueRef is None:
+            retVal = collection
+        else:
+            retVal = collection[inOpaqueRef]
+        return retVal
+    HotData.Inst().AddFetcher('vm', FetchVM, 3600)
+    
+    # A frame reads a few fields from every VM, as the VM list and status panes do
+    frames = 5
+    startTime = time.time()
+    for i in range(frames):
+        for vm in HotAccessor().vm:
+            vm.name_label()
+            vm.power_state()
+            vm.resident_on()
+    frameSecs = (time.time() - startTime) / frames
+
+    print('VMs:                    %d' % inNumVMs)
+    print('Convert time:           %.3f s' % convertSecs)
+    print('Resident memory growth: %d KB (%d bytes per VM)' % (memoryKB, memoryKB * 1024 / inNumVMs))
+    print('Frame time:             %.3f s (%.1f us per VM)' % (frameSecs, frameSecs * 1000000 / inNumVMs))
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        numVMs = int(sys.argv[1])
+    else:
+        numVMs = 10000
+    Main(numVMs)
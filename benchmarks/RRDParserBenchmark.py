@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2007-2009 Citrix Systems Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# Compares the streaming rrd_updates parser in HotMetrics with the minidom parser that it replaced, on a
+# synthetic document for a host with many VMs.  Each parser runs in a child process so that its peak memory
+# can be measured separately.
+# Run from the xsconsole directory:  python benchmarks/RRDParserBenchmark.py [number of VMs]
+
+import os, sys, time
+import xml.dom.minidom
+
+sys.path.insert(0, os.path.join(os.path.dirname(sys.argv[0]), '..'))
+
+from XSConsoleMetrics import *
+
+ROWS = 3 # As for a 10 second window with a 5 second step
+
+def StatusKB(inName):
+    retVal = 0
+    for line in open('/proc/self/status'):
+        if line.startswith(inName+':'):
+            retVal = int(line.split()[1])
+    return retVal
+
+def MakeDocument(inNumVMs):
+    entries = [ 'AVERAGE:host:host-uuid:'+name for name in
+        [ 'cpu%d' % i for i in range(8) ] + [ 'memory_total_kib', 'memory_free_kib', 'loadavg' ] +
+        [ 'pif_eth%d_%s' % (i, dir) for i in range(4) for dir in ('rx', 'tx') ] ]
+    for vm in range(inNumVMs):
+        prefix = 'AVERAGE:vm:%08x-0000-0000-0000-000000000000:' % vm
+        entries += [ prefix+name for name in
+            [ 'cpu%d' % i for i in range(2) ] + [ 'memory', 'memory_internal_free', 'memory_target' ] +
+            [ 'vif_0_rx', 'vif_0_tx', 'vbd_xvda_read', 'vbd_xvda_write', 'vbd_xvdb_read', 'vbd_xvdb_write' ] ]
+
+    end = 1250000000
+    lines = [ '<xport><meta><start>%d</start><step>5</step><end>%d</end><rows>%d</rows><columns>%d</columns><legend>'
+        % (end - 5 * ROWS, end, ROWS, len(entries)) ]
+    lines += [ '<entry>%s</entry>' % entry for entry in entries ]
+    lines.append('</legend></meta><data>')
+    for row in range(ROWS):
+        lines.append('<row><t>%d</t>' % (end - 5 * row))
+        lines += [ '<v>%.4E</v>' % (0.001 * (i + row)) for i in range(len(entries)) ]
+        lines.append('</row>')
+    lines.append('</data></xport>')
+    return ''.join(lines)
+
+def MinidomParse(inXML):
+    # HotMetrics.ParseXML before the streaming parser
+    xmlDoc = xml.dom.minidom.parseString(inXML)
+    metaNode = xmlDoc.getElementsByTagName('meta')[0]
+    valuesNode = xmlDoc.getElementsByTagName('data')[0]
+    legendNode = metaNode.getElementsByTagName('legend')[0]
+    entries = [ str(entry.firstChild.nodeValue.strip()) for entry in legendNode.getElementsByTagName('entry') ]
+    mostRecentRow = None
+    mostRecentTime = None
+    for row in valuesNode.getElementsByTagName('row'):
+        rowTime = int(row.getElementsByTagName('t')[0].firstChild.nodeValue.strip())
+        if mostRecentTime is None or mostRecentTime < rowTime:
+            mostRecentRow = row
+            mostRecentTime = rowTime
+    if mostRecentRow is None:
+        values = []
+    else:
+        values = [ str(v.firstChild.nodeValue.strip()) for v in mostRecentRow.getElementsByTagName('v') ]
+    retVal = {}
+    for entry, value in zip(entries, values):
+        retVal[entry] = value
+    return retVal
+
+def Measure(inParse, inXML, inRuns):
+    # Returns (seconds per parse, peak memory growth in KB, result), measured in a child process
+    readFD, writeFD = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(readFD)
+        startKB = StatusKB('VmHWM')
+        startTime = time.time()
+        for i in range(inRuns):
+            result = inParse(inXML)
+        secs = (time.time() - startTime) / inRuns
+        os.write(writeFD, repr((secs, StatusKB('VmHWM') - startKB, result)))
+        os._exit(0)
+    os.close(writeFD)
+    output = ''
+    while True:
+        text = os.read(readFD, 65536)
+        if text == '':
+            break
+        output += text
+    os.close(readFD)
+    os.waitpid(pid, 0)
+    return eval(output)
+
+def Main(inNumVMs):
+    document = MakeDocument(inNumVMs)
+    runs = 5
+    minidomSecs, minidomKB, minidomResult = Measure(MinidomParse, document, runs)
+    streamSecs, streamKB, streamResult = Measure(HotMetrics.Inst().ParseXML, document, runs)
+
+    print('VMs:                    %d' % inNumVMs)
+    print('Document size:          %d KB, %d legend entries' % (len(document) / 1024, len(minidomResult)))
+    print('minidom parse:          %.3f s, peak memory growth %d KB' % (minidomSecs, minidomKB))
+    print('Streaming parse:        %.3f s, peak memory growth %d KB' % (streamSecs, streamKB))
+    print('Results identical:      %s' % (minidomResult == streamResult))
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        numVMs = int(sys.argv[1])
+    else:
+        numVMs = 200
+    Main(numVMs)
@@ -39,7 +39,7 @@ class CrashDumpSRDialogue(SRDialogue):
                 Lang("Crash Dump SR set to '"+inSR['name_label']+"'")))
         except Exception, e:
             Layout.Inst().PushDialogue(InfoDialogue( Lang("Configuration failed: ")+str(e)))
-        Data.Inst().Update()
+        Data.Inst().StartUpdate()
 
 class XSFeatureCrashDumpSR:
     @classmethod
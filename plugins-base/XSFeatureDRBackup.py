@@ -53,7 +53,7 @@ class DRBackupDialogue(SRDialogue):
                 raise Exception(output)
         except Exception, e:
             Layout.Inst().PushDialogue(InfoDialogue(Lang("Metadata Backup failed: ")+Lang(e)))
-        Data.Inst().Update()
+        Data.Inst().StartUpdate()
 
 class XSFeatureDRBackup:
     @classmethod
@@ -172,7 +172,7 @@ class DRRestoreDialogue(SRDialogue):
             Layout.Inst().PushDialogue(DRRestoreSelection(output, vdi_uuid, sr_uuid))
         except Exception, e:
             Layout.Inst().PushDialogue(InfoDialogue( Lang("Metadata Restore failed: ")+Lang(e)))
-        Data.Inst().Update()
+        Data.Inst().StartUpdate()
 
 class XSFeatureDRRestore:
     @classmethod
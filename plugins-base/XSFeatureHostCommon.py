@@ -41,19 +41,26 @@ class HostUtils:
     @classmethod
     def AsyncOperation(cls, inOperation, inHostHandle, *inParams):
         if inOperation == 'evacuate':
-            # Gather the list of VMs to restart on exit of maintenance mode
+            # Gather the list of VMs to restart on exit of maintenance mode.  inParams[0], if present, lists the
+            # OpaqueRefs of VMs already migrated away in preparation for the evacuation
             runningVMs = [ vm.HotOpaqueRef().OpaqueRef() for vm in HotAccessor().local_host.resident_VMs if not vm.is_control_domain() ]
+            if len(inParams) > 0:
+                runningVMs = [ vmRef for vmRef in inParams[0] if vmRef not in runningVMs ] + runningVMs
             task = Task.New(lambda x: x.xenapi.Async.host.evacuate(inHostHandle.OpaqueRef()))
             cls.OtherConfigReplace(inHostHandle, 'MAINTENANCE_MODE_EVACUATED_VMS', ','.join(runningVMs))
             cls.OtherConfigReplace(inHostHandle, 'MAINTENANCE_MODE', 'true')
+            task.HotDataChangesAdd('host', 'vm', 'metrics')
         elif inOperation == 'disable':
             task = Task.New(lambda x: x.xenapi.Async.host.disable(inHostHandle.OpaqueRef()))
+            task.HotDataChangesAdd(inHostHandle)
         elif inOperation == 'enable':
             cls.OtherConfigRemove(inHostHandle, 'MAINTENANCE_MODE')
             cls.OtherConfigRemove(inHostHandle, 'MAINTENANCE_MODE_EVACUATED_VMS')
             task = Task.New(lambda x: x.xenapi.Async.host.enable(inHostHandle.OpaqueRef()))
+            task.HotDataChangesAdd(inHostHandle)
         elif inOperation == 'designate_new_master':
             task = Task.New(lambda x: x.xenapi.Async.pool.designate_new_master(inHostHandle.OpaqueRef()))
+            task.HotDataChangesAdd('pool', 'local_pool', 'host')
         elif inOperation == 'join':
             task = Task.New(lambda x: x.xenapi.Async.pool.join(*inParams))
         elif inOperation == 'join_force':
@@ -66,12 +73,13 @@ class HostUtils:
         return task
         
     @classmethod
-    def DoOperation(cls, inOperation, inHostHandle):
-        task = cls.AsyncOperation(inOperation, inHostHandle)
+    def DoOperation(cls, inOperation, inHostHandle, *inParams):
+        # Blocks until the operation completes.  Dialogues should use AsyncOperation and TaskEntry.WhenComplete
+        # instead, so that the console stays responsive
+        task = cls.AsyncOperation(inOperation, inHostHandle, *inParams)
         
         if task is not None:
-            while task.IsPending():
-                time.sleep(0.1)
+            task.Wait()
             task.RaiseIfFailed()
 
     @classmethod
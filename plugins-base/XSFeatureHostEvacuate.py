@@ -18,11 +18,121 @@ if __name__ == "__main__":
     
 from XSConsoleStandard import *
 
+class EvacuationPlan:
+    # Places the VMs resident on a host onto the other hosts in the pool before anything moves, so that an
+    # evacuation that can't succeed fails up front.  Fetch() reads the VMs' memory requirements and possible hosts
+    # and the hosts' free memory in two round trips, and Place() packs the VMs locally, largest first, each onto
+    # the possible host with the most free memory remaining.  This spreads the load and leaves the most room for
+    # the larger VMs that follow
+    def __init__(self, inHostHandle):
+        self.hostHandle = inHostHandle
+        self.vms = []
+        self.hosts = {}
+        self.moves = []
+        self.failures = []
+    
+    def Fetch(self):
+        Task.Sync(self.FetchWithSession)
+    
+    def FetchWithSession(self, inSession):
+        batch = MultiCall(inSession)
+        vmResults = []
+        def queueVMCalls(inVMRefs):
+            for vmRef in inVMRefs:
+                vmResults.append( (vmRef, batch.xenapi.VM.get_record(vmRef), batch.xenapi.VM.get_possible_hosts(vmRef)) )
+        batch.xenapi.host.get_resident_VMs(self.hostHandle.OpaqueRef()).Then(queueVMCalls)
+        hostResult = batch.xenapi.host.get_all_records()
+        metricsResult = batch.xenapi.host_metrics.get_all_records()
+        batch.Execute()
+        
+        hostMetrics = metricsResult.Value()
+        self.hosts = {}
+        for hostRef, host in hostResult.Value().iteritems():
+            metrics = hostMetrics.get(host['metrics'], {})
+            # Only other hosts that are enabled and live can receive VMs
+            if hostRef != self.hostHandle.OpaqueRef() and host['enabled'] and metrics.get('live', False):
+                self.hosts[hostRef] = Struct(
+                    ref = hostRef,
+                    name = host['name_label'],
+                    memoryFree = long(metrics.get('memory_free', 0)))
+        
+        self.vms = []
+        for vmRef, recordResult, possibleResult in vmResults:
+            record = recordResult.Value()
+            if record['is_control_domain']:
+                continue
+            vm = Struct(
+                ref = vmRef,
+                name = record['name_label'],
+                memory = long(record['memory_dynamic_max']) + long(record.get('memory_overhead', 0)),
+                possibleHosts = [],
+                error = None)
+            if 'pool_migrate' not in record['allowed_operations']:
+                vm.error = Lang('This Virtual Machine cannot be migrated')
+            else:
+                try:
+                    vm.possibleHosts = possibleResult.Value()
+                except XenAPI.Failure, e:
+                    vm.error = Language.XapiError(e.details)
+            self.vms.append(vm)
+    
+    def Place(self):
+        memoryFree = {}
+        for hostRef, host in self.hosts.iteritems():
+            memoryFree[hostRef] = host.memoryFree
+        self.moves = []
+        self.failures = []
+        
+        vms = self.vms[:]
+        vms.sort(lambda x, y: cmp(y.memory, x.memory))
+        for vm in vms:
+            if vm.error is not None:
+                self.failures.append( (vm.name, vm.error) )
+                continue
+            candidates = [ hostRef for hostRef in vm.possibleHosts if hostRef in memoryFree ]
+            if len(candidates) == 0:
+                self.failures.append( (vm.name, Lang('No other host can run this Virtual Machine')) )
+                continue
+            candidates.sort(lambda x, y: cmp(memoryFree[y], memoryFree[x]))
+            hostRef = candidates[0]
+            if memoryFree[hostRef] < vm.memory:
+                self.failures.append( (vm.name, Lang('Needs ')+SizeUtils.MemorySizeString(vm.memory)+
+                    Lang(' but no possible host has more than ')+SizeUtils.MemorySizeString(memoryFree[hostRef])+Lang(' free')) )
+                continue
+            memoryFree[hostRef] -= vm.memory
+            self.moves.append(Struct(vm = vm, host = self.hosts[hostRef]))
+        
+        for hostRef, host in self.hosts.iteritems():
+            host.memoryFreeAfter = memoryFree[hostRef]
+    
+    def IsFeasible(self):
+        return len(self.failures) == 0
+    
+    def HostSummaries(self):
+        # Returns (host name, number of VMs, memory free after migration) for each host receiving VMs
+        numVMs = {}
+        for move in self.moves:
+            numVMs[move.host.ref] = numVMs.get(move.host.ref, 0) + 1
+        retVal = [ (self.hosts[hostRef].name, number, self.hosts[hostRef].memoryFreeAfter)
+            for hostRef, number in numVMs.iteritems() ]
+        retVal.sort()
+        return retVal
+    
+    def MigrateOperation(self):
+        # Returns an unstarted VMBulkOperation that migrates the VMs as planned, in parallel
+        bulk = Importer.GetResource('VMBulkOperation')()
+        for move in self.moves:
+            bulk.Add('pool_migrate', HotOpaqueRef(move.vm.ref, 'vm'), HotOpaqueRef(move.host.ref, 'host'))
+        return bulk
+
 class HostEvacuateDialogue(Dialogue):
     def __init__(self):
         Dialogue.__init__(self)
         db = HotAccessor()
         self.newMaster = None
+        self.plan = None
+        self.planError = None
+        self.progressDialogue = None
         self.hostWasEnabled = db.local_host.enabled(False)
         self.migrateMenu = Menu()
         self.migrateMenu.AddChoice(name = Lang('Migrate, Resume or Restart Virtual Machines on This Host'),
@@ -55,22 +165,30 @@ class HostEvacuateDialogue(Dialogue):
 
     def BuildPaneCHOOSEMASTER(self):
         self.hostMenu = Menu()
-        hostList = {}
-        for host in HotAccessor().host:
-            # Make sortable by name, but keep hosts with identical names by appending uuid. User never sees the dict keys
-            hostList[host.name_label()+host.uuid()] = host
-
-        self.hostMenu = Menu()
-        for hostName in sorted(hostList.keys()):
-            host = hostList[hostName]
-            if host.uuid() != HotAccessor().local_host.uuid():
-                self.hostMenu.AddChoice(name = host.name_label(),
-                    onAction = self.HandleHostChoice,
-                    handle = host)
+        hostsByName = HotAccessor().host.GroupBy('name_label') # Hosts with identical names share an entry
+        localHostRef = HotAccessor().local_host_ref()
+        for hostName in sorted(hostsByName.keys()):
+            for host in hostsByName[hostName]:
+                if host.HotOpaqueRef() != localHostRef:
+                    self.hostMenu.AddChoice(name = hostName,
+                        onAction = self.HandleHostChoice,
+                        handle = host)
                     
         if self.hostMenu.NumChoices() == 0:
             self.hostMenu.AddChoice(name = Lang('<No hosts available>'))
 
+    def BuildPaneCONFIRM(self):
+        if self.hostWasEnabled:
+            # Plan where the VMs will go, so that problems are reported before any VM moves
+            Layout.Inst().TransientBanner(Lang('Planning Virtual Machine Placement...'))
+            self.plan = EvacuationPlan(HotAccessor().local_host_ref())
+            self.planError = None
+            try:
+                self.plan.Fetch()
+                self.plan.Place()
+            except Exception, e:
+                self.planError = Lang(e)
+
     def BuildPane(self):
         pane = self.NewPane(DialoguePane(self.parent))
         pane.ResetPosition()
@@ -110,26 +228,46 @@ class HostEvacuateDialogue(Dialogue):
         pane = self.Pane()
         pane.ResetFields()
 
-        if self.hostWasEnabled:
-
+        helpKeys = { Lang("<F8>") : Lang("OK"), Lang("<Esc>") : Lang("Cancel") }
+        if not self.hostWasEnabled:
+            pane.AddWrappedBoldTextField(Lang('Press <F8> to exit Maintenance Mode and return this host to normal operation'))
+        elif self.planError is not None:
+            pane.AddWrappedBoldTextField(Lang('Unable to plan the placement of the Virtual Machines on this host'))
+            pane.NewLine()
+            pane.AddWrappedTextField(self.planError)
+            helpKeys = { Lang("<Esc>") : Lang("Cancel") }
+        elif not self.plan.IsFeasible():
+            pane.AddWrappedBoldTextField(Lang('This host cannot enter Maintenance Mode because the following Virtual Machines '
+                'cannot be migrated to other hosts.  No Virtual Machines have been moved.'))
+            pane.NewLine()
+            for name, message in self.plan.failures:
+                pane.AddWrappedTextField(name+': '+message)
+            helpKeys = { Lang("<Esc>") : Lang("Cancel") }
+        else:
             pane.AddTitleField(Lang("Press <F8> to confirm the following actions."))
-            numVMs = max(0, len(HotAccessor().local_host.resident_VMs([]))-1) # Subtract 1 for dom0
+            numVMs = len(self.plan.moves)
             pane.AddWrappedTextField(Lang('1.  Prevent new VMs starting on or migrating to this host'))
             pane.AddWrappedTextField(Lang('2.  Migrate ') + str(numVMs) + Language.Quantity(' Virtual Machine', numVMs) +
                 Lang(' to other hosts'))
+            for name, number, memoryFree in self.plan.HostSummaries():
+                pane.AddStatusField(('    '+name)[:24].ljust(24), str(number) + Language.Quantity(' VM', number) +
+                    ', ' + SizeUtils.MemorySizeString(memoryFree) + Lang(' free afterwards'))
             
             if self.newMaster is not None:
                 pane.AddWrappedTextField(Lang('3.  Designate host ') + self.newMaster.name_label(Lang('<Unknown>')) +
                     Lang(' as the new Pool Master'))
-        else:
-            pane.AddWrappedBoldTextField(Lang('Press <F8> to exit Maintenance Mode and return this host to normal operation'))
 
-        pane.AddKeyHelpField( { Lang("<F8>") : Lang("OK"), Lang("<Esc>") : Lang("Cancel") } )
+        if pane.NeedsScroll():
+            helpKeys[ Lang("<Page Up/Down>") ] = Lang("Scroll")
+        pane.AddKeyHelpField( helpKeys )
     
     def UpdateFields(self):
         self.Pane().ResetPosition()
         getattr(self, 'UpdateFields'+self.state)() # Despatch method named 'UpdateFields'+self.state
 
+    def HotDataChanges(self):
+        return [] # The host and VM operations' tasks invalidate HotData when they complete
+
     def ChangeState(self, inState):
         self.state = inState
         self.BuildPane()
@@ -142,8 +280,17 @@ class HostEvacuateDialogue(Dialogue):
         return self.migrateMenu.HandleKey(inKey)
 
     def HandleKeyCONFIRM(self, inKey):
+        handled = True
         if inKey == 'KEY_F(8)':
-            self.Commit()
+            if not self.hostWasEnabled or (self.planError is None and self.plan.IsFeasible()):
+                self.Commit()
+        elif inKey == 'KEY_PPAGE':
+            self.Pane().ScrollPageUp()
+        elif inKey == 'KEY_NPAGE':
+            self.Pane().ScrollPageDown()
+        else:
+            handled = False
+        return handled
 
     def HandleKey(self,  inKey):
         handled = False
@@ -173,26 +320,106 @@ class HostEvacuateDialogue(Dialogue):
         if self.hostWasEnabled:
             try:
                 Layout.Inst().TransientBanner(Lang('Entering Maintenance Mode...'))
-                hostUtils.DoOperation('disable', HotAccessor().local_host_ref())
-                hostUtils.DoOperation('evacuate', HotAccessor().local_host_ref())
-                message = None
-                if self.newMaster is not None:
-                    Layout.Inst().TransientBanner(Lang('Designating New Pool Master...'))
-                    hostUtils.DoOperation('designate_new_master', self.newMaster.HotOpaqueRef())
-                    
-                    message = Lang('Please allow several seconds for the pool to propagate information about the new Master')
-                Layout.Inst().PushDialogue(InfoDialogue(Lang("Host Successfully Entered Maintenance Mode"), message))
+                task = hostUtils.AsyncOperation('disable', HotAccessor().local_host_ref())
+                # Each step starts the next when its task completes, so the console stays responsive
+                task.WhenComplete(self.HandleDisableCompletion)
             except Exception, e:
                 Layout.Inst().PushDialogue(InfoDialogue(Lang("Enter Maintenance Mode Failed to Complete"), Lang(e)))
         else:
             try:
                 Layout.Inst().TransientBanner(Lang('Exiting Maintenance Mode...'))
-                hostUtils.DoOperation('enable', HotAccessor().local_host_ref())
-                vmUtils = Importer.GetResource('VMUtils')
-                vmUtils.ReinstateVMs(HotAccessor().local_host_ref(), self.evacuatedVMs)
-                Layout.Inst().PushDialogue(InfoDialogue(Lang("Host Successfully Exited Maintenance Mode")))
+                task = hostUtils.AsyncOperation('enable', HotAccessor().local_host_ref())
+                task.WhenComplete(self.HandleEnableCompletion)
             except Exception, e:
                 Layout.Inst().PushDialogue(InfoDialogue(Lang("Exit Maintenance Mode Failed"), Lang(e)))
+
+    def HandleEnableCompletion(self, inTask):
+        try:
+            inTask.RaiseIfFailed()
+            vmUtils = Importer.GetResource('VMUtils')
+            bulk = vmUtils.ReinstateOperation(HotAccessor().local_host_ref(), self.evacuatedVMs)
+            if bulk.NumJobs() == 0:
+                Layout.Inst().PushDialogue(InfoDialogue(Lang("Host Successfully Exited Maintenance Mode")))
+            else:
+                # Return the VMs in parallel, showing their progress
+                bulk.Start()
+                progressDialogue = Importer.GetResource('VMBulkProgressDialogue')
+                Layout.Inst().PushDialogue(progressDialogue(bulk, Lang("Host Exited Maintenance Mode.  Returning Virtual Machines")))
+        except Exception, e:
+            Layout.Inst().PushDialogue(InfoDialogue(Lang("Exit Maintenance Mode Failed"), Lang(e)))
+
+    def HandleDisableCompletion(self, inTask):
+        try:
+            inTask.RaiseIfFailed()
+            # Migrate the VMs as planned, in parallel, then complete the evacuation
+            bulk = self.plan.MigrateOperation()
+            bulk.Start()
+            if not bulk.IsComplete():
+                progressDialogue = Importer.GetResource('VMBulkProgressDialogue')
+                self.progressDialogue = progressDialogue(bulk, Lang("Migrating Virtual Machines"))
+                Layout.Inst().PushDialogue(self.progressDialogue)
+            bulk.WhenComplete(self.HandleMigrationCompletion)
+        except Exception, e:
+            Layout.Inst().PushDialogue(InfoDialogue(Lang("Enter Maintenance Mode Failed to Complete"), Lang(e)))
+
+    def HandleMigrationCompletion(self, inBulk):
+        # host.evacuate moves anything the plan didn't cover, e.g. VMs started on this host before it was disabled,
+        # and records the VMs to reinstate on exit
+        hostUtils = Importer.GetResource('HostUtils')
+        migratedRefs = [ vmHandle.OpaqueRef() for vmHandle in inBulk.Succeeded() ]
+        if len(migratedRefs) < inBulk.NumJobs():
+            self.HandleMigrationFailure(inBulk, migratedRefs)
+        else:
+            try:
+                if self.progressDialogue is not None and Layout.Inst().TopDialogue() is self.progressDialogue:
+                    Layout.Inst().PopDialogue()
+                Layout.Inst().TransientBanner(Lang('Entering Maintenance Mode...'))
+                task = hostUtils.AsyncOperation('evacuate', HotAccessor().local_host_ref(), migratedRefs)
+                task.WhenComplete(self.HandleEvacuateCompletion)
+            except Exception, e:
+                Layout.Inst().PushDialogue(InfoDialogue(Lang("Enter Maintenance Mode Failed to Complete"), Lang(e)))
+
+    def HandleMigrationFailure(self, inBulk, inMigratedRefs):
+        # The host stays disabled.  Record the VMs that have moved, so that exiting Maintenance Mode returns them
+        hostUtils = Importer.GetResource('HostUtils')
+        message = Lang('This host has been left disabled.')
+        try:
+            if len(inMigratedRefs) > 0:
+                hostUtils.OtherConfigReplace(HotAccessor().local_host_ref(), 'MAINTENANCE_MODE_EVACUATED_VMS', ','.join(inMigratedRefs))
+                message += (Lang('  Exit Maintenance Mode to enable it and return the ')+str(len(inMigratedRefs))+
+                    Language.Quantity(' Virtual Machine', len(inMigratedRefs))+Lang(' already migrated.'))
+            else:
+                message += Lang('  No Virtual Machines were migrated.  Exit Maintenance Mode to enable it.')
+        except Exception, e:
+            message += Lang('  The list of migrated Virtual Machines could not be recorded: ')+Lang(e)
+        failures = inBulk.Failures()
+        if len(failures) > 0:
+            message += ('  '+str(len(failures))+Lang(' of ')+str(inBulk.NumJobs())+Lang(' migrations failed.  ')+
+                failures[0][0]+': '+failures[0][1])
+        else:
+            message += Lang('  Migration was cancelled.')
+        Layout.Inst().PushDialogue(InfoDialogue(Lang("Enter Maintenance Mode Failed to Complete"), message))
+
+    def HandleEvacuateCompletion(self, inTask):
+        try:
+            inTask.RaiseIfFailed()
+            if self.newMaster is None:
+                Layout.Inst().PushDialogue(InfoDialogue(Lang("Host Successfully Entered Maintenance Mode")))
+            else:
+                Layout.Inst().TransientBanner(Lang('Designating New Pool Master...'))
+                hostUtils = Importer.GetResource('HostUtils')
+                task = hostUtils.AsyncOperation('designate_new_master', self.newMaster.HotOpaqueRef())
+                task.WhenComplete(self.HandleDesignateCompletion)
+        except Exception, e:
+            Layout.Inst().PushDialogue(InfoDialogue(Lang("Enter Maintenance Mode Failed to Complete"), Lang(e)))
+
+    def HandleDesignateCompletion(self, inTask):
+        try:
+            inTask.RaiseIfFailed()
+            Layout.Inst().PushDialogue(InfoDialogue(Lang("Host Successfully Entered Maintenance Mode"),
+                Lang('Please allow several seconds for the pool to propagate information about the new Master')))
+        except Exception, e:
+            Layout.Inst().PushDialogue(InfoDialogue(Lang("Enter Maintenance Mode Failed to Complete"), Lang(e)))
             
 class XSFeatureHostEvacuate:
     @classmethod
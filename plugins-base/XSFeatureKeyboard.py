@@ -41,9 +41,9 @@ class KeyboardDialogue(Dialogue):
         keys = sorted(keymaps.keys())
         
         for key in keys:
-            choiceDefs.append(ChoiceDef(key, lambda: self.HandleKeymapChoice(keys[self.keymapMenu.ChoiceIndex()]) ))
+            choiceDefs.append(ChoiceDef(key, lambda key: self.HandleKeymapChoice(key), handle = key))
         
-        self.keymapMenu = Menu(self, None, Lang("Select Keymap File"), choiceDefs)
+        self.keymapMenu = FilterMenu(self, None, Lang("Select Keymap File"), choiceDefs, Data.Inst().KeymapSearch)
     
         self.ChangeState('INITIAL')
         
@@ -67,7 +67,7 @@ class KeyboardDialogue(Dialogue):
         
         pane.AddTitleField(Lang("Please Select Your Keymap Name"))
         pane.AddMenuField(self.keymapMenu, 12) # There are a lot of keymaps so make this menu high
-        pane.NewLine()
+        pane.AddStatusField(Lang("Filter", 8), self.keymapMenu.FilterText())
         pane.AddKeyHelpField( { Lang("<Enter>") : Lang("OK"), Lang("<Esc>") : Lang("Cancel") } )
             
     def UpdateFields(self):
@@ -82,7 +82,10 @@ class KeyboardDialogue(Dialogue):
         return self.layoutMenu.HandleKey(inKey)
      
     def HandleKeyKEYMAP(self, inKey):
-        return self.keymapMenu.HandleKey(inKey)
+        handled = self.keymapMenu.HandleKey(inKey)
+        if handled:
+            self.UpdateFields() # Show the new filter text
+        return handled
      
     def HandleKey(self, inKey):
         handled = False
@@ -119,7 +122,7 @@ class KeyboardDialogue(Dialogue):
         except Exception, e:
             Layout.Inst().PushDialogue(InfoDialogue( Lang("Configuration failed: ")+Lang(e)))
 
-        data.Update()
+        data.StartUpdate()
 
 
 class XSFeatureKeyboard: 
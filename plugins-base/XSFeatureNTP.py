@@ -159,7 +159,7 @@ class NTPDialogue(Dialogue):
         except Exception, e:
             Layout.Inst().PushDialogue(InfoDialogue( Lang("Operation Failed"), Lang(e)))
             
-        data.Update()
+        data.StartUpdate()
 
     def HandleRemoveChoice(self,  inChoice):
         Layout.Inst().PopDialogue()
@@ -182,7 +182,7 @@ class NTPDialogue(Dialogue):
         except Exception, e:
             Layout.Inst().PushDialogue(InfoDialogue( Lang("Update failed: ")+Lang(e)))
 
-        data.Update()
+        data.StartUpdate()
 
 class XSFeatureNTP:
     @classmethod
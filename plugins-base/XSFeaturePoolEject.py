@@ -93,7 +93,15 @@ class PoolEjectDialogue(Dialogue):
 
         try:
             Layout.Inst().TransientBanner(Lang('Removing This Host from the Pool...'))
-            hostUtils.DoOperation('eject', HotAccessor().local_host_ref())
+            task = hostUtils.AsyncOperation('eject', HotAccessor().local_host_ref())
+            # Act on the result when the task completes, rather than blocking the console until then
+            task.WhenComplete(self.HandleTaskCompletion)
+        except Exception, e:
+            Layout.Inst().PushDialogue(InfoDialogue(Lang("Failed to Remove Host from Pool"), Lang(e)))
+
+    def HandleTaskCompletion(self, inTask):
+        try:
+            inTask.RaiseIfFailed()
             Layout.Inst().ExitBannerSet(Lang('Removal Successful.  This Host Will Now Reboot...'))
             Layout.Inst().ExitCommandSet('/bin/sleep 120')
         except Exception, e:
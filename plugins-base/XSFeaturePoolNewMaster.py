@@ -100,7 +100,15 @@ class PoolNewMasterDialogue(Dialogue):
 
         try:
             Layout.Inst().TransientBanner(Lang('Designating New Pool Master...'))
-            hostUtils.DoOperation('designate_new_master', self.newMaster.HotOpaqueRef())
+            task = hostUtils.AsyncOperation('designate_new_master', self.newMaster.HotOpaqueRef())
+            # Report the result when the task completes, rather than blocking the console until then
+            task.WhenComplete(self.HandleTaskCompletion)
+        except Exception, e:
+            Layout.Inst().PushDialogue(InfoDialogue(Lang("Failed to Designate New Pool Master"), Lang(e)))
+
+    def HandleTaskCompletion(self, inTask):
+        try:
+            inTask.RaiseIfFailed()
             Layout.Inst().PushDialogue(InfoDialogue(Lang("The Pool Master Has Been Changed"), Lang('Please allow several seconds for the change to propagate throughout the Pool.')))
         except Exception, e:
             Layout.Inst().PushDialogue(InfoDialogue(Lang("Failed to Designate New Pool Master"), Lang(e)))
@@ -72,7 +72,7 @@ class RemoteShellDialogue(Dialogue):
         except Exception, e:
             Layout.Inst().PushDialogue(InfoDialogue( Lang("Failed: ")+Lang(e)))
             
-        data.Update()
+        data.StartUpdate()
 
 
 class XSFeatureRemoteShell:
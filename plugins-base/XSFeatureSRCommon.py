@@ -98,16 +98,21 @@ class SRUtils:
         else:
             raise Exception("Unknown SR operation "+str(inOperation))
         
+        if task is not None:
+            task.HotDataChangesAdd(inSRHandle, 'pbd')
         return task
         
     @classmethod
     def DoOperation(cls, inOperation, inSRHandle):
-        task = cls.AsyncOperation(inOperation, inSRHandle)
-        
-        if task is not None:
-            while task.IsPending():
-                time.sleep(0.1)
-            task.RaiseIfFailed()
+        try:
+            task = cls.AsyncOperation(inOperation, inSRHandle)
+            
+            if task is not None:
+                task.Wait()
+                task.RaiseIfFailed()
+        finally:
+            # Synchronous operations may have changed the SR and its PBDs, even if they failed
+            HotData.Inst().Invalidate(inSRHandle, 'pbd')
 
     @classmethod
     def OperationStruct(cls, inOperation):
@@ -136,12 +141,15 @@ class SRUtils:
     @classmethod
     def SRFlags(cls, inSR):
         retVal = []
-        if inSR.uuid() in [ pool.default_SR.uuid() for pool in HotAccessor().pool ]:
-            retVal.append('default')
-        if inSR.uuid() in [ pool.suspend_image_SR.uuid() for pool in HotAccessor().pool ]:
-            retVal.append('suspend')
-        if inSR.uuid() in [ pool.crash_dump_SR.uuid() for pool in HotAccessor().pool ]:
-            retVal.append('crashdump')
+        srRef = HotAccessor().sr.ByUUID(inSR.uuid()) # inSR may be a HotAccessor via another object, e.g. pool.default_SR
+        if srRef is not None:
+            srRef = srRef.HotOpaqueRef()
+            if len(HotAccessor().pool.Where(default_SR = srRef)) > 0:
+                retVal.append('default')
+            if len(HotAccessor().pool.Where(suspend_image_SR = srRef)) > 0:
+                retVal.append('suspend')
+            if len(HotAccessor().pool.Where(crash_dump_SR = srRef)) > 0:
+                retVal.append('crashdump')
         return retVal
         
     @classmethod
@@ -244,6 +252,9 @@ class SRControlDialogue(Dialogue):
                 
         pane.AddKeyHelpField( { Lang("<F8>") : Lang("OK"), Lang("<Esc>") : Lang("Cancel") } )
     
+    def HotDataChanges(self):
+        return [] # SRUtils.DoOperation invalidates HotData after the operation
+    
     def UpdateFields(self):
         self.Pane().ResetPosition()
         getattr(self, 'UpdateFields'+self.state)() # Despatch method named 'UpdateFields'+self.state
@@ -286,12 +297,27 @@ class SRControlDialogue(Dialogue):
         messagePrefix = operationName + Lang(' operation on ') + srName + ' '
         Layout.Inst().TransientBanner(messagePrefix+Lang('in progress...'))
         try:
-            task = SRUtils.DoOperation(self.operation, self.srHandle, *self.opParams)
-            Layout.Inst().PushDialogue(InfoDialogue(messagePrefix + Lang("successful"), ))
+            try:
+                task = SRUtils.AsyncOperation(self.operation, self.srHandle, *self.opParams)
+            finally:
+                # Synchronous operations may have changed the SR and its PBDs, even if they failed
+                HotData.Inst().Invalidate(self.srHandle, 'pbd')
+            if task is None:
+                Layout.Inst().PushDialogue(InfoDialogue(messagePrefix + Lang("successful"), ))
+            else:
+                # Report the result when the task completes, rather than blocking the console until then
+                task.WhenComplete(lambda inTask: self.HandleTaskCompletion(inTask, messagePrefix))
 
         except Exception, e:
             self.ChangeState('INITIAL')
             Layout.Inst().PushDialogue(InfoDialogue(messagePrefix + Lang("failed"), Lang(e)))
+    
+    def HandleTaskCompletion(self, inTask, inMessagePrefix):
+        try:
+            inTask.RaiseIfFailed()
+            Layout.Inst().PushDialogue(InfoDialogue(inMessagePrefix + Lang("successful"), ))
+        except Exception, e:
+            Layout.Inst().PushDialogue(InfoDialogue(inMessagePrefix + Lang("failed"), Lang(e)))
 
 class XSFeatureSRCommon:
     def Register(self):
@@ -53,25 +53,24 @@ class XSFeatureSRInfo:
             inPane.AddStatusField(Lang('Shared', 10), sr.shared() and Lang('Yes') or Lang('No'))
             
             attached = False
-            for pbd in sr.PBDs:
-                if pbd.host.uuid() == db.local_host.uuid():
-                    if pbd.currently_attached(False):
-                        attached = True
-                    devConfig = pbd.device_config
-                    if devConfig.location() is not None:
-                        inPane.AddStatusField(Lang('Location', 10), devConfig.location())
-                    if devConfig.device() is not None:
-                        inPane.AddStatusField(Lang('Device', 10), devConfig.device())
-                    if devConfig.server() is not None and devConfig.serverpath() is not None:
-                        inPane.AddStatusField(Lang('Server', 10), devConfig.server()+':'+devConfig.serverpath())
-                    if devConfig.SCSIid() is not None:
-                        inPane.AddStatusField(Lang('SCSI ID', 10), devConfig.SCSIid())
-                    if devConfig.target() is not None:
-                        inPane.AddStatusField(Lang('Target', 10), devConfig.target())
-                    if devConfig.port() is not None:
-                        inPane.AddStatusField(Lang('Port', 10), devConfig.port())
-                    if devConfig.targetIQN() is not None:
-                        inPane.AddStatusField(Lang('Target IQN', 10), devConfig.targetIQN())
+            for pbd in db.pbd.Where(SR = sr.HotOpaqueRef(), host = db.local_host_ref()):
+                if pbd.currently_attached(False):
+                    attached = True
+                devConfig = pbd.device_config
+                if devConfig.location() is not None:
+                    inPane.AddStatusField(Lang('Location', 10), devConfig.location())
+                if devConfig.device() is not None:
+                    inPane.AddStatusField(Lang('Device', 10), devConfig.device())
+                if devConfig.server() is not None and devConfig.serverpath() is not None:
+                    inPane.AddStatusField(Lang('Server', 10), devConfig.server()+':'+devConfig.serverpath())
+                if devConfig.SCSIid() is not None:
+                    inPane.AddStatusField(Lang('SCSI ID', 10), devConfig.SCSIid())
+                if devConfig.target() is not None:
+                    inPane.AddStatusField(Lang('Target', 10), devConfig.target())
+                if devConfig.port() is not None:
+                    inPane.AddStatusField(Lang('Port', 10), devConfig.port())
+                if devConfig.targetIQN() is not None:
+                    inPane.AddStatusField(Lang('Target IQN', 10), devConfig.targetIQN())
             
 
             flags = srUtils.SRFlags(sr)
@@ -39,7 +39,7 @@ class SuspendSRDialogue(SRDialogue):
                 Lang("Suspend SR set to '"+inSR['name_label']+"'")))
         except Exception, e:
             Layout.Inst().PushDialogue(InfoDialogue( Lang("Configuration failed: ")+str(e)))
-        Data.Inst().Update()
+        Data.Inst().StartUpdate()
 
 
 class XSFeatureSuspendSR:
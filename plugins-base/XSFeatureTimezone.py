@@ -46,12 +46,14 @@ class TimezoneDialogue(Dialogue):
             for city in keys:
                 if cityExp.match(city):
                     self.cityList.append(city)
-                    choiceDefs.append(ChoiceDef(city, lambda: self.HandleCityChoice(self.cityMenu.ChoiceIndex())))
+                    choiceDefs.append(ChoiceDef(city, lambda city: self.HandleCityChoice(city), handle = city))
         
             if len(choiceDefs) == 0:
                 choiceDefs.append(Lang('<None available>'), None)
         
-            self.cityMenu = Menu(self, None, Lang("Select City"), choiceDefs)
+            # Typing filters the cities by name within the continent
+            self.cityMenu = FilterMenu(self, None, Lang("Select City"), choiceDefs,
+                lambda text: Data.Inst().TimezoneSearch(self.continentChoice+'/'+text))
             
         pane = self.NewPane(DialoguePane(self.parent))
         pane.TitleSet(Lang("Set Timezone"))
@@ -72,6 +74,7 @@ class TimezoneDialogue(Dialogue):
         
         pane.AddTitleField(Lang("Please Choose a City Within Your Timezone"))
         pane.AddMenuField(self.cityMenu)
+        pane.AddStatusField(Lang("Filter", 8), self.continentChoice+'/'+self.cityMenu.FilterText())
         pane.AddKeyHelpField( { Lang("<Enter>") : Lang("OK") , Lang("<Esc>") : Lang("Cancel") } )
         
     def UpdateFields(self):
@@ -86,7 +89,10 @@ class TimezoneDialogue(Dialogue):
         return self.continentMenu.HandleKey(inKey)
      
     def HandleKeyCITY(self, inKey):
-        return self.cityMenu.HandleKey(inKey)
+        handled = self.cityMenu.HandleKey(inKey)
+        if handled:
+            self.UpdateFields() # Show the new filter text
+        return handled
         
     def HandleKey(self, inKey):
         handled = False
@@ -104,7 +110,7 @@ class TimezoneDialogue(Dialogue):
         self.ChangeState('CITY')
 
     def HandleCityChoice(self,  inChoice):
-        city = self.cityList[inChoice]
+        city = inChoice
         data=Data.Inst()
         Layout.Inst().PopDialogue()
         try:
@@ -115,7 +121,7 @@ class TimezoneDialogue(Dialogue):
         except Exception, e:
             Layout.Inst().PushDialogue(InfoDialogue( Lang("Configuration failed: ")+Lang(e)))
 
-        data.Update()
+        data.StartUpdate()
 
 
 class XSFeatureTimezone:
@@ -66,15 +66,19 @@ class VMUtils:
         else:
             raise Exception("Unknown VM operation "+str(inOperation))
         
+        if task is not None:
+            # Power operations change the VM, the hosts' resident VM lists and memory metrics
+            task.HotDataChangesAdd(inVMHandle, 'host', 'metrics', 'guest_metrics')
         return task
         
     @classmethod
     def DoOperation(cls, inOperation, inVMHandle, inParam0 = None):
+        # Blocks until the operation completes.  Dialogues should use AsyncOperation and TaskEntry.WhenComplete
+        # instead, so that the console stays responsive
         task = cls.AsyncOperation(inOperation, inVMHandle, inParam0)
         
         if task is not None:
-            while task.IsPending():
-                time.sleep(0.1)
+            task.Wait()
             task.RaiseIfFailed()
 
     @classmethod
@@ -105,15 +109,267 @@ class VMUtils:
 
     @classmethod
     def ReinstateVMs(cls, inHostRef, inVMRefList):
+        bulk = cls.ReinstateOperation(inHostRef, inVMRefList)
+        bulk.Wait()
+        bulk.RaiseIfFailed()
+
+    @classmethod
+    def ReinstateOperation(cls, inHostRef, inVMRefList):
+        # Returns a VMBulkOperation, not yet started, that returns the VMs to inHostRef
+        bulk = VMBulkOperation()
         for vmRef in inVMRefList:
             vm = HotAccessor().vm[vmRef]
             powerState = vm.power_state('').lower()
             if powerState.startswith('halted'):
-                cls.DoOperation('start_on', vmRef, inHostRef)
+                bulk.Add('start_on', vmRef, inHostRef)
             elif powerState.startswith('running'):
-                cls.DoOperation('pool_migrate', vmRef, inHostRef)
+                bulk.Add('pool_migrate', vmRef, inHostRef)
             elif powerState.startswith('suspended'):
-                cls.DoOperation('resume_on', vmRef, inHostRef)
+                bulk.Add('resume_on', vmRef, inHostRef)
+        return bulk
+
+class VMBulkOperation:
+    # Runs operations on many VMs as tasks, at most inConcurrency (by default Config.BulkOperationConcurrency)
+    # at once.  Each task starts the next when it completes, via TaskEntry.WhenComplete, so an operation started
+    # from a dialogue proceeds without blocking the UI.  Wait() runs the operation to completion instead
+    WAIT_SECS = 0.5
+    
+    def __init__(self, inConcurrency = None):
+        self.concurrency = FirstValue(inConcurrency, Config.Inst().BulkOperationConcurrency())
+        self.jobs = []
+        self.startTime = None
+        self.finishTime = None
+        self.cancelled = False
+        self.completionCallbacks = []
+    
+    def Add(self, inOperation, inVMHandle, inParam0 = None):
+        self.jobs.append(Struct(
+            operation = inOperation,
+            vmHandle = inVMHandle,
+            param0 = inParam0,
+            name = HotAccessor().vm[inVMHandle].name_label(Lang('<Unknown>')).encode('utf-8'),
+            task = None,
+            error = None,
+            finished = False))
+    
+    def Start(self):
+        self.startTime = time.time()
+        self.Dispatch()
+    
+    def Dispatch(self):
+        # Notes jobs that have finished and starts waiting jobs, up to the concurrency limit
+        numRunning = 0
+        for job in self.jobs:
+            if job.task is not None and not job.finished:
+                if job.task.IsPending():
+                    numRunning += 1
+                else:
+                    job.finished = True
+        
+        for job in self.jobs:
+            if numRunning >= self.concurrency:
+                break
+            if job.task is None and not job.finished:
+                try:
+                    job.task = VMUtils.AsyncOperation(job.operation, job.vmHandle, job.param0)
+                except Exception, e:
+                    job.error = Lang(e)
+                if job.task is None:
+                    job.finished = True
+                else:
+                    numRunning += 1
+                    job.task.WhenComplete(lambda inTask: self.Dispatch())
+        
+        if self.finishTime is None and self.IsComplete():
+            self.finishTime = time.time()
+            callbacks = self.completionCallbacks
+            self.completionCallbacks = []
+            for callback in callbacks:
+                callback(self)
+    
+    def WhenComplete(self, inCallback):
+        # inCallback(self) is called once, when the last job finishes, or now if they have all finished
+        if self.finishTime is None:
+            self.completionCallbacks.append(inCallback)
+        else:
+            inCallback(self)
+    
+    def Wait(self):
+        if self.startTime is None:
+            self.Start()
+        while not self.IsComplete():
+            running = [ job.task for job in self.jobs if job.task is not None and not job.finished ]
+            if len(running) > 0:
+                running[0].done.wait(self.WAIT_SECS)
+            self.Dispatch()
+    
+    def Cancel(self):
+        # Cancels the jobs that haven't started, and those in progress that xapi allows to be cancelled
+        self.cancelled = True
+        for job in self.jobs:
+            if job.task is None and not job.finished:
+                job.error = Lang('Cancelled')
+                job.finished = True
+            elif job.task is not None and not job.finished and job.task.CanCancel():
+                try:
+                    job.task.Cancel()
+                except Exception, e:
+                    XSLogError('Failed to cancel task: ', e)
+        self.Dispatch()
+    
+    def CanCancel(self):
+        return not self.cancelled and not self.IsComplete()
+    
+    def IsComplete(self):
+        for job in self.jobs:
+            if not job.finished:
+                return False
+        return True
+    
+    def NumFinished(self):
+        return len([ job for job in self.jobs if job.finished ])
+    
+    def NumJobs(self):
+        return len(self.jobs)
+    
+    def ProgressValue(self):
+        if len(self.jobs) == 0:
+            retVal = 1.0
+        else:
+            total = 0.0
+            for job in self.jobs:
+                if job.finished:
+                    total += 1.0
+                elif job.task is not None:
+                    total += job.task.ProgressValue()
+            retVal = total / len(self.jobs)
+        return retVal
+    
+    def DurationSecs(self):
+        if self.startTime is None:
+            retVal = 0.0
+        else:
+            retVal = FirstValue(self.finishTime, time.time()) - self.startTime
+        return retVal
+    
+    def JobMessage(self, inJob):
+        if inJob.error is not None:
+            retVal = Lang('Failed: ')+inJob.error
+        elif inJob.task is None:
+            if inJob.finished:
+                retVal = Lang('No Operation')
+            else:
+                retVal = Lang('Waiting')
+        elif inJob.finished:
+            retVal = inJob.task.Message()
+        else:
+            retVal = Lang('In progress')+' '+str(int(100*inJob.task.ProgressValue()))+'%'
+        return retVal
+    
+    def Results(self):
+        # Returns a list of (VM name, message) for each job
+        return [ (job.name, self.JobMessage(job)) for job in self.jobs ]
+    
+    def Succeeded(self):
+        # Returns the handles of the VMs whose operations succeeded
+        return [ job.vmHandle for job in self.jobs if job.task is not None and job.finished and
+            job.task.Status().lower().startswith('success') ]
+    
+    def Failures(self):
+        retVal = []
+        for job in self.jobs:
+            if job.error is not None:
+                retVal.append( (job.name, job.error) )
+            elif job.task is not None and job.finished and job.task.Status().lower().startswith('failure'):
+                retVal.append( (job.name, Language.XapiError(job.task.errorInfo)) )
+        return retVal
+    
+    def RaiseIfFailed(self):
+        failures = self.Failures()
+        if len(failures) > 0:
+            raise Exception(str(len(failures))+Lang(' of ')+str(len(self.jobs))+Lang(' operations failed.  ')+
+                failures[0][0]+': '+failures[0][1])
+
+class VMBulkProgressDialogue(Dialogue):
+    def __init__(self, inBulk, inText):
+        Dialogue.__init__(self)
+        self.bulk = inBulk
+        self.text = inText
+        
+        self.ChangeState('INITIAL')
+
+    def BuildPane(self):
+        pane = self.NewPane(DialoguePane(self.parent))
+        pane.AddBox()
+
+    def UpdateFieldsBody(self):
+        pane = self.Pane()
+        pane.AddTitleField(self.text)
+        
+        pane.AddStatusField(Lang('Time', 16), TimeUtils.DurationString(self.bulk.DurationSecs()))
+        pane.AddStatusField(Lang('Progress', 16), str(int(100*self.bulk.ProgressValue()))+'% ('+
+            str(self.bulk.NumFinished())+Lang(' of ')+str(self.bulk.NumJobs())+Lang(' complete')+')')
+        pane.NewLine()
+        for name, message in self.bulk.Results():
+            pane.AddStatusField(name[:20].ljust(20), message)
+    
+    def UpdateFieldsINITIAL(self):
+        pane = self.Pane()
+        pane.ResetFields()
+        self.UpdateFieldsBody()
+        
+        helpKeys = { Lang("<Enter>") : Lang("Hide This Window") }
+        if self.bulk.CanCancel():
+            helpKeys[ Lang('<Esc>') ]= Lang('Cancel Remaining')
+        if pane.NeedsScroll():
+            helpKeys[ Lang("<Page Up/Down>") ] = Lang("Scroll")
+        pane.AddKeyHelpField( helpKeys )
+    
+    def UpdateFieldsCOMPLETE(self):
+        pane = self.Pane()
+        pane.ResetFields()
+        self.UpdateFieldsBody()
+        
+        helpKeys = { Lang("<Enter>") : Lang("OK") }
+        if pane.NeedsScroll():
+            helpKeys[ Lang("<Page Up/Down>") ] = Lang("Scroll")
+        pane.AddKeyHelpField( helpKeys )
+    
+    def UpdateFields(self):
+        if self.state != 'COMPLETE' and self.bulk.IsComplete():
+            self.ChangeState('COMPLETE')
+        else:
+            self.Pane().ResetPosition()
+            getattr(self, 'UpdateFields'+self.state)() # Despatch method named 'UpdateFields'+self.state
+    
+    def LiveUpdateFields(self):
+        self.UpdateFields()
+    
+    def HotDataChanges(self):
+        return [] # The tasks invalidate HotData when they complete
+    
+    def ChangeState(self, inState):
+        self.state = inState
+        self.BuildPane()
+        self.UpdateFields()
+        
+    def HandleKey(self, inKey):
+        handled = True
+        if inKey == 'KEY_ESCAPE':
+            if self.bulk.CanCancel():
+                self.bulk.Cancel()
+                self.UpdateFields()
+            else:
+                Layout.Inst().PopDialogue()
+        elif inKey == 'KEY_ENTER':
+            Layout.Inst().PopDialogue()
+        elif inKey == 'KEY_PPAGE':
+            self.Pane().ScrollPageUp()
+        elif inKey == 'KEY_NPAGE':
+            self.Pane().ScrollPageDown()
+        else:
+            handled = False
+        return handled
 
 class VMControlDialogue(Dialogue):
     def __init__(self, inVMHandle):
@@ -195,6 +451,9 @@ class VMControlDialogue(Dialogue):
                 
         pane.AddKeyHelpField( { Lang("<F8>") : Lang("OK"), Lang("<Esc>") : Lang("Cancel") } )
     
+    def HotDataChanges(self):
+        return [] # The operation's task invalidates HotData when it completes
+    
     def UpdateFields(self):
         self.Pane().ResetPosition()
         getattr(self, 'UpdateFields'+self.state)() # Despatch method named 'UpdateFields'+self.state
@@ -255,6 +514,109 @@ class VMControlDialogue(Dialogue):
             self.ChangeState('INITIAL')
             Layout.Inst().PushDialogue(InfoDialogue(messagePrefix + Lang("Failed"), Lang(e)))
 
+class VMBulkControlDialogue(Dialogue):
+    def __init__(self, inVMHandles):
+        self.vmHandles = inVMHandles
+        Dialogue.__init__(self)
+        self.operation = 'none'
+        
+        # Offer the operations allowed on every selected VM.  Migration isn't offered as the VMs' possible hosts differ
+        allowedOps = None
+        for vmHandle in self.vmHandles:
+            vmOps = set(HotAccessor().vm[vmHandle].allowed_operations([]))
+            if allowedOps is None:
+                allowedOps = vmOps
+            else:
+                allowedOps &= vmOps
+        choiceList = [ name for name in FirstValue(allowedOps, []) if name in VMUtils.AllowedOperations() and name != 'pool_migrate' ]
+        
+        choiceList.sort(lambda x, y: cmp(VMUtils.OperationPriority(x), VMUtils.OperationPriority(y)))
+        
+        self.controlMenu = Menu()
+        for choice in choiceList:
+            self.controlMenu.AddChoice(name = VMUtils.OperationName(choice),
+                onAction = self.HandleControlChoice,
+                handle = choice)
+        if self.controlMenu.NumChoices() == 0:
+            self.controlMenu.AddChoice(name = Lang('<No Operations Available For All VMs>'))
+            
+        self.ChangeState('INITIAL')
+        
+    def BuildPane(self):
+        pane = self.NewPane(DialoguePane(self.parent))
+        pane.TitleSet(Lang("Virtual Machine Control"))
+        pane.AddBox()
+        
+    def UpdateFieldsINITIAL(self):
+        pane = self.Pane()
+        pane.ResetFields()
+
+        pane.AddTitleField(str(len(self.vmHandles))+Lang(" Virtual Machines selected"))
+        pane.AddMenuField(self.controlMenu)
+        pane.AddKeyHelpField( { Lang("<Enter>") : Lang("OK"), Lang("<Esc>") : Lang("Cancel") } )
+    
+    def UpdateFieldsCONFIRM(self):
+        pane = self.Pane()
+        pane.ResetFields()
+
+        pane.AddTitleField(Lang('Press <F8> to confirm this operation'))
+        pane.AddStatusField(Lang("Operation", 20), VMUtils.OperationName(self.operation))
+        pane.AddStatusField(Lang("Virtual Machines", 20), str(len(self.vmHandles)))
+        pane.AddStatusField(Lang("At Once", 20), str(Config.Inst().BulkOperationConcurrency()))
+                
+        pane.AddKeyHelpField( { Lang("<F8>") : Lang("OK"), Lang("<Esc>") : Lang("Cancel") } )
+    
+    def HotDataChanges(self):
+        return [] # The operations' tasks invalidate HotData when they complete
+    
+    def UpdateFields(self):
+        self.Pane().ResetPosition()
+        getattr(self, 'UpdateFields'+self.state)() # Despatch method named 'UpdateFields'+self.state
+
+    def ChangeState(self, inState):
+        self.state = inState
+        self.BuildPane()
+        self.UpdateFields()
+    
+    def HandleKeyINITIAL(self, inKey):
+        return self.controlMenu.HandleKey(inKey)
+
+    def HandleKeyCONFIRM(self, inKey):
+        handled = False
+        if inKey == 'KEY_F(8)':
+            self.Commit()
+            handled = True
+        return handled
+
+    def HandleKey(self,  inKey):
+        handled = False
+        if hasattr(self, 'HandleKey'+self.state):
+            handled = getattr(self, 'HandleKey'+self.state)(inKey)
+        
+        if not handled and inKey == 'KEY_ESCAPE':
+            Layout.Inst().PopDialogue()
+            handled = True
+
+        return handled
+    
+    def HandleControlChoice(self, inChoice):
+        self.operation = inChoice
+        self.ChangeState('CONFIRM')
+        
+    def Commit(self):
+        Layout.Inst().PopDialogue()
+
+        bulk = VMBulkOperation()
+        for vmHandle in self.vmHandles:
+            bulk.Add(self.operation, vmHandle)
+        messagePrefix = VMUtils.OperationName(self.operation) + Lang(' operation on ') + str(len(self.vmHandles)) + Lang(' Virtual Machines')
+        try:
+            bulk.Start()
+            Layout.Inst().PushDialogue(VMBulkProgressDialogue(bulk, messagePrefix))
+            
+        except Exception, e:
+            Layout.Inst().PushDialogue(InfoDialogue(messagePrefix + Lang(" Failed"), Lang(e)))
+
 class XSFeatureVMCommon:
     def Register(self):
         Importer.RegisterResource(
@@ -262,6 +624,9 @@ class XSFeatureVMCommon:
             'VM_COMMON', # Name of this item for replacement, etc.
             {
                 'VMControlDialogue' : VMControlDialogue,
+                'VMBulkControlDialogue' : VMBulkControlDialogue,
+                'VMBulkOperation' : VMBulkOperation,
+                'VMBulkProgressDialogue' : VMBulkProgressDialogue,
                 'VMUtils' : VMUtils
             }
         )
@@ -92,7 +92,7 @@ class XSFeatureVMInfo:
                 except Exception, e:
                     inPane.AddStatusField(Lang('Network Info', 16), Lang('<Unavailable>'))
                     
-        inPane.AddKeyHelpField( { Lang("<Enter>") : Lang("Control This Virtual Machine") } )
+        inPane.AddKeyHelpField( { Lang("<Enter>") : Lang("Control This VM or Selected VMs"), Lang("<Space>") : Lang("Select") } )
     
     @classmethod
     def ResidentActivateHandler(cls):
@@ -111,9 +111,20 @@ class XSFeatureVMInfo:
         dialogue = Importer.GetResource('VMControlDialogue')
         DialogueUtils.AuthenticatedOnly(lambda: Layout.Inst().PushDialogue(dialogue(inHandle)))
     
+    @classmethod
+    def BulkActivateHandler(cls, inHandles):
+        dialogue = Importer.GetResource('VMBulkControlDialogue')
+        DialogueUtils.AuthenticatedOnly(lambda: Layout.Inst().PushDialogue(dialogue(inHandles)))
+    
     @classmethod
     def MenuRegenerator(cls, inList, inMenu):
-        retVal = copy.copy(inMenu)
+        if isinstance(inMenu, MultiSelectMenu):
+            retVal = copy.copy(inMenu)
+        else:
+            # Replace the plain menu that the root menu creates
+            retVal = MultiSelectMenu(inMenu.owner, inMenu.Parent(), inMenu.Title(), None, cls.BulkActivateHandler)
+            retVal.CurrentChoiceSet(inMenu.ChoiceIndex())
+        selected = retVal.Selected()
         retVal.RemoveChoices()
         # inList is a list of HotOpaqueRef objects
         vmList = [ HotAccessor().vm[x] for x in inList ]
@@ -131,6 +142,8 @@ class XSFeatureVMInfo:
         if retVal.NumChoices() == 0:
             retVal.AddChoice(name = Lang('<No Virtual Machines Present>'),
                                         statusUpdateHandler = cls.NoVMStatusUpdateHandler)
+        
+        retVal.SelectedSet(selected) # Drops VMs that have gone
             
         return retVal
     